@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import json
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Optional, Callable
 
 import openai
 import tiktoken
@@ -30,28 +33,132 @@ def ensure_api(api_key):
         Api_loaded = True
 
 
+class RateLimiter:
+    """Token buckets for the requests per minute and the tokens per
+    minute allowed by the API. A limit of None is not enforced. It can
+    be shared between threads.
+    """
+
+    def __init__(self,
+                 requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None):
+        self.capacity = {'requests': requests_per_minute, 'tokens': tokens_per_minute}
+        self.available = {name: float(limit)
+                          for name, limit in self.capacity.items() if limit is not None}
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        for name in self.available:
+            self.available[name] = min(self.capacity[name],
+                                       self.available[name] +
+                                       (now - self.last_refill) * self.capacity[name] / 60)
+        self.last_refill = now
+
+    def acquire(self, tokens: int = 0):
+        """Block until a request with this number of tokens can be sent.
+        """
+        wanted = {'requests': 1, 'tokens': tokens}
+        # A request larger than the bucket waits for the bucket to be full.
+        wanted = {name: min(wanted[name], self.capacity[name]) for name in self.available}
+        while True:
+            with self.lock:
+                self._refill()
+                missing = {name: wanted[name] - self.available[name] for name in wanted}
+                if all(value <= 0 for value in missing.values()):
+                    for name in wanted:
+                        self.available[name] -= wanted[name]
+                    return
+                wait = max(value * 60 / self.capacity[name]
+                           for name, value in missing.items() if value > 0)
+            time.sleep(wait)
+
+
 @retry(
     wait=wait_random_exponential(min=1, max=20),
     stop=stop_after_attempt(6),
     retry=retry_if_not_exception_type(openai.InvalidRequestError),
 )
-def fetch_embeddings(text_or_tokens_array: List[str], model_name: str) -> List[List[float]]:
+def fetch_embeddings(text_or_tokens_array: List[str],
+                     model_name: str,
+                     rate_limiter: Optional[RateLimiter] = None,
+                     n_tokens: int = 0) -> List[List[float]]:
+    if rate_limiter is not None:
+        rate_limiter.acquire(n_tokens)
     return [
         r['embedding']
         for r in openai.Embedding.create(input=text_or_tokens_array, model=model_name)["data"]
     ]
 
 
-def get_embeddings(chunked_texts: List[str], model_name: str) -> List[float]:
-    # Split text_chunks into shorter arrays of max length 100
-    max_batch_size = 100
-    text_chunks_arrays = [
-        chunked_texts[i : i + max_batch_size] for i in range(0, len(chunked_texts), max_batch_size)
-    ]
+def make_batches(token_counts: List[int],
+                 max_batch_size: int,
+                 max_batch_tokens: Optional[int] = None) -> List[range]:
+    """Group consecutive texts, given their token counts, in batches
+    of up to max_batch_size texts and max_batch_tokens tokens. A text
+    with more than max_batch_tokens tokens gets a batch of its own.
+    """
+    batches = []
+    start = 0
+    batch_tokens = 0
+    for end, n_tokens in enumerate(token_counts):
+        if end > start and (end - start >= max_batch_size or
+                            (max_batch_tokens is not None and
+                             batch_tokens + n_tokens > max_batch_tokens)):
+            batches.append(range(start, end))
+            start = end
+            batch_tokens = 0
+        batch_tokens += n_tokens
+    if start < len(token_counts):
+        batches.append(range(start, len(token_counts)))
+    return batches
+
+
+def get_embeddings(chunked_texts: List[str],
+                   model_name: str,
+                   max_in_flight: int = 1,
+                   rate_limiter: Optional[RateLimiter] = None,
+                   count_tokens: Optional[Callable[[str], int]] = None,
+                   max_batch_size: int = 100,
+                   max_batch_tokens: Optional[int] = None) -> List[float]:
+    """Embed the texts in batches of up to max_batch_size texts and,
+    if count_tokens is given, max_batch_tokens tokens, with up to
+    max_in_flight requests running at the same time. Each batch is
+    retried on its own, and split in two if the API rejects it for
+    having too many tokens. The embeddings come in the same order as
+    the texts.
+    """
+    token_counts = ([count_tokens(text) for text in chunked_texts] if count_tokens
+                    else [0] * len(chunked_texts))
+    batches = make_batches(token_counts,
+                           max_batch_size,
+                           max_batch_tokens if count_tokens else None)
+
+    def _fetch(batch: range):
+        try:
+            return fetch_embeddings([chunked_texts[k] for k in batch],
+                                    model_name,
+                                    rate_limiter=rate_limiter,
+                                    n_tokens=sum(token_counts[k] for k in batch))
+        except openai.InvalidRequestError as exc:
+            if len(batch) < 2 or 'token' not in str(exc).lower():
+                raise
+            logger = logging.getLogger(__name__)
+            logger.warning('Splitting a batch of %d texts rejected by the API: %s',
+                           len(batch), str(exc))
+            middle = len(batch) // 2
+            return _fetch(batch[:middle]) + _fetch(batch[middle:])
 
     embeddings = []
-    for text_chunks_array in text_chunks_arrays:
-        embeddings += fetch_embeddings(text_chunks_array, model_name)
+    if max_in_flight <= 1 or len(batches) <= 1:
+        for batch in batches:
+            embeddings += _fetch(batch)
+    else:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            # map returns the results in the order of the batches
+            for batch_embeddings in executor.map(_fetch, batches):
+                embeddings += batch_embeddings
 
     return embeddings
 
@@ -8,7 +8,7 @@ import logging
 import configparser
 from datetime import datetime
 from importlib import import_module
-from typing import Dict, List, Union, Optional
+from typing import Dict, Iterable, List, Union, Optional
 
 from dotenv import load_dotenv
 from pytz import utc
@@ -61,7 +61,10 @@ class Awd:
         self._vector_store = {}
         self._source_unit_cache = None
         self._chunk_cache = None
+        self._embedding_cache = None
+        self._query_embedding_cache = None
         self._chat = None
+        self._reindex = None
 
     def getenv(self, varname):
         return self.environment.get(varname.upper(), '')
@@ -149,18 +152,32 @@ class Awd:
 
         return self.config.get(section, {})
 
+    def get_embedding_dimensions(self) -> int:
+        """The dimensions of the embedding model, from its
+        configuration if available, so that the model is not loaded.
+        """
+        # Merged as in make_embedder, so that the embedding section
+        # can override the model.
+        config = {**self.get_model_config(), **self.get_config('embedding')}
+        if 'dimensions' in config:
+            return config['dimensions']
+        return self.get_embedder().dimensions
+
     def get_embedder(self):
         embedding_config = self.get_config('embedding').copy()
         model_name = embedding_config['model_name']
 
         if model_name not in self._embedder:
-            from aword.model.embedder import make_embedder
-
-            model_config = self.get_json_config('models').get(model_name, {})
-            self._embedder[model_name] = make_embedder(self, {**model_config, **embedding_config})
+            self._embedder[model_name] = self.make_embedder(embedding_config)
 
         return self._embedder[model_name]
 
+    def make_embedder(self, embedding_config: Dict):
+        from aword.model.embedder import make_embedder
+
+        model_config = self.get_json_config('models').get(embedding_config['model_name'], {})
+        return make_embedder(self, {**model_config, **embedding_config})
+
     def get_respondent(self, respondent_name: str):
         if respondent_name not in self._respondents:
             respondents_config = self.get_json_config('respondents')
@@ -250,7 +267,32 @@ class Awd:
 
     def create_vector_namespace(self):
         vector_store = self.get_vector_store()
-        vector_store.create_namespace(dimensions=self.get_embedder().dimensions)
+        vector_store.create_namespace(dimensions=self.get_embedding_dimensions())
+        self.get_chunk_cache().delete_namespace_model(vector_store.collection_name)
+
+    def reset_embedded(self, source: str = None, source_unit_id: str = None):
+        """Flag the source units as unembedded, and their chunks as not
+        stored, so that embed_and_store stores them from scratch.
+        """
+        self.get_source_unit_cache().reset_embedded(source=source,
+                                                    source_unit_id=source_unit_id)
+        self.get_chunk_cache().reset_vector_db_ids(source=source,
+                                                   source_unit_id=source_unit_id)
+
+    def check_vector_namespace_model(self):
+        """Raise an error if the vector namespace was reindexed with a
+        model other than the configured one, whose vectors would not
+        be comparable with those in it.
+        """
+        vector_store = self.get_vector_store()
+        namespace_model = self.get_chunk_cache().get_namespace_model(vector_store.collection_name)
+        model_name = self.get_config('embedding')['model_name']
+        if namespace_model is not None and namespace_model != model_name:
+            raise E.AwordError(f'The vector namespace {vector_store.collection_name} was '
+                               f'reindexed with the model {namespace_model}, but the '
+                               f'configured model is {model_name}. Set model_name = '
+                               f'{namespace_model} in the embedding section, and the chunk '
+                               'size and distance of the reindex.')
 
     def get_source_unit_cache(self):
         if self._source_unit_cache is None:
@@ -268,13 +310,45 @@ class Awd:
 
     def get_chunk_cache(self):
         if self._chunk_cache is None:
+            self._chunk_cache = self.make_chunk_cache()
+
+        return self._chunk_cache
+
+    def make_chunk_cache(self, **config):
+        cache_config = {**self.get_config('cache'), **config}
+        provider = cache_config.get('provider', 'edge')
+        processor = import_module(f'aword.cache.{provider}')
+
+        return processor.make_chunk_cache(**cache_config)
+
+    def get_embedding_cache(self):
+        """Returns None if the embedding cache is disabled, setting
+        embedding_cache_size to 0 in the cache configuration.
+        """
+        if self._embedding_cache is None:
             cache_config = self.get_config('cache').copy()
             provider = cache_config.get('provider', 'edge')
             processor = import_module(f'aword.cache.{provider}')
 
-            self._chunk_cache = processor.make_chunk_cache(**cache_config)
+            self._embedding_cache = processor.make_embedding_cache(**cache_config)
 
-        return self._chunk_cache
+        return self._embedding_cache
+
+    def get_query_embedding_cache(self):
+        """Returns None if the query embedding cache is disabled,
+        setting query_cache_size to 0 in the embedding configuration.
+        """
+        if self._query_embedding_cache is None:
+            from aword.model.embedder import QueryEmbeddingCache
+
+            embedding_config = self.get_config('embedding')
+            max_size = embedding_config.get('query_cache_size', 1024)
+            if max_size:
+                self._query_embedding_cache = QueryEmbeddingCache(
+                    max_size=max_size,
+                    ttl=embedding_config.get('query_cache_ttl', 3600))
+
+        return self._query_embedding_cache
 
     def get_chat(self):
         if self._chat is None:
@@ -290,22 +364,133 @@ class Awd:
             processor = import_module(f'aword.source.{source_name}')
             processor.update_cache(self)
 
-    def embed_and_store(self):
+    def embed_and_store(self, bulk_load: bool = False) -> Optional[Dict[str, float]]:
+        """Chunks the unembedded source units and embeds the chunks of
+        several source units together, in batches of about
+        embedding_batch_size chunks (embedding section), so that the
+        number of embedding requests depends on the number of chunks
+        and not on the number of segments.
+
+        The chunks of a source unit that are already in the chunk
+        cache, embedded with the same model, and whose points are in
+        the vector store, keep their vectors and their points; only
+        the new chunks are embedded and upserted, and the chunks that
+        are gone deleted. Otherwise, and for the source units reset
+        with Awd.reset_embedded, all the points of the source unit are
+        replaced.
+
+        Source units with at least streaming_min_chars characters
+        (embedding section) are chunked, embedded and stored a batch
+        at a time, so that memory does not grow with their size.
+
+        With bulk_load, for vector stores that support it, the vector
+        store is not indexed until all the chunks are stored, which is
+        faster when there are many, and it returns the seconds taken by
+        the load and by the indexing.
+        """
+        if bulk_load:
+            vector_store = self.get_vector_store()
+            if not hasattr(vector_store, 'bulk_load'):
+                self.logger.warning('The vector store does not support bulk loads')
+            else:
+                with vector_store.bulk_load() as timings:
+                    self.embed_and_store()
+                return timings
+
+        self.check_vector_namespace_model()
         source_unit_cache = self.get_source_unit_cache()
         chunk_cache = self.get_chunk_cache()
 
         vector_store = self.get_vector_store()
         embedder = self.get_embedder()
+        embedding_batch_size = self.get_config('embedding').get('embedding_batch_size', 1000)
 
+        pending = []
         total_chunks = 0
+
+        def _embed_and_store_pending():
+            embedder.embed_chunks([chunk
+                                   for _, _, chunks, _ in pending
+                                   for chunk in chunks
+                                   if chunk.vector is None])
+
+            for k, (source_unit, now, chunks, stored_chunks) in enumerate(pending):
+                # Only the last source unit waits for the vector store
+                # to apply the updates, so the rest do not pay a round trip.
+                if stored_chunks:
+                    chunks = vector_store.update_chunks(chunks,
+                                                        stored_chunks,
+                                                        wait=k == len(pending) - 1)
+                else:
+                    chunks = vector_store.store_chunks(source_unit['source_unit_id'],
+                                                       chunks,
+                                                       wait=k == len(pending) - 1)
+                source_unit_cache.flag_as_embedded([source_unit], now=now)
+
+                # First remove the chunks for this source unit. Otherwise
+                # old chunks will be left if this is an edit.
+                chunk_cache.delete_source_unit(
+                    source=source_unit['source'],
+                    source_unit_id=source_unit['source_unit_id'],
+                )
+                chunk_cache.add(
+                    source=source_unit['source'],
+                    source_unit_id=source_unit['source_unit_id'],
+                    chunks=chunks,
+                    model_name=embedder.model_name,
+                )
+            if self._reindex is not None:
+                self._store_in_shadow([source_unit for source_unit, _, _, _ in pending])
+            pending.clear()
+
+        def _stream_source_unit(source_unit, now):
+            chunk_cache.delete_source_unit(
+                source=source_unit['source'],
+                source_unit_id=source_unit['source_unit_id'],
+            )
+            n_chunks = 0
+            for chunks in vector_store.store_source_unit_in_batches(
+                embedder,
+                batch_size=embedding_batch_size,
+                source=source_unit['source'],
+                source_unit_id=source_unit['source_unit_id'],
+                source_unit_uri=source_unit['uri'],
+                categories=source_unit['categories'],
+                scope=source_unit['scope'],
+                context=source_unit['context'],
+                language=source_unit['language'],
+                segments=source_unit['segments'],
+            ):
+                chunk_cache.add(
+                    source=source_unit['source'],
+                    source_unit_id=source_unit['source_unit_id'],
+                    chunks=chunks,
+                    model_name=embedder.model_name,
+                )
+                n_chunks += len(chunks)
+            source_unit_cache.flag_as_embedded([source_unit], now=now)
+            if self._reindex is not None:
+                self._stream_in_shadow(source_unit, embedding_batch_size)
+            return n_chunks
+
+        pending_chunks = 0
         for source_unit in source_unit_cache.list_unembedded_rows():
             now = datetime.now(utc)
+            if self.is_large_source_unit(source_unit):
+                self.logger.info(
+                    'Streaming large source unit (%s, %s)',
+                    str(source_unit['source']),
+                    str(source_unit['source_unit_id']),
+                )
+                total_chunks += _stream_source_unit(source_unit, now)
+                continue
+
             self.logger.info(
-                'Embedding and storing source unit (%s, %s)',
+                'Chunking source unit (%s, %s)',
                 str(source_unit['source']),
                 str(source_unit['source_unit_id']),
             )
-            chunks = vector_store.store_source_unit(
+            chunks = vector_store.make_source_unit_chunks(
                 embedder,
                 source=source_unit['source'],
                 source_unit_id=source_unit['source_unit_id'],
@@ -316,23 +501,207 @@ class Awd:
                 language=source_unit['language'],
                 segments=source_unit['segments'],
             )
-            source_unit_cache.flag_as_embedded([source_unit], now=now)
-
-            # First remove the chunks for this source unit. Otherwise
-            # old chunks will be left if this is an edit.
-            chunk_cache.delete_source_unit(
-                source=source_unit['source'],
-                source_unit_id=source_unit['source_unit_id'],
-            )
-            chunk_cache.add(
+            # The chunks of source units reset with reset_embedded have
+            # no vector_db_id, so they are stored from scratch.
+            stored_chunks = vector_store.filter_stored(chunk_cache.get_by_source_unit(
                 source=source_unit['source'],
                 source_unit_id=source_unit['source_unit_id'],
-                chunks=chunks,
-            )
+                model_name=embedder.model_name,
+            ))
+            pending.append((source_unit, now, chunks, stored_chunks))
+            pending_chunks += len(vector_store.reuse_stored_vectors(chunks, stored_chunks))
             total_chunks += len(chunks)
 
+            if pending_chunks >= embedding_batch_size:
+                self.logger.info('Embedding and storing %d chunks from %d source units',
+                                 pending_chunks, len(pending))
+                _embed_and_store_pending()
+                pending_chunks = 0
+
+        if pending:
+            self.logger.info('Embedding and storing %d chunks from %d source units',
+                             pending_chunks, len(pending))
+            _embed_and_store_pending()
+        vector_store.flush()
+
         self.logger.info('Added %d chunks', total_chunks)
 
+    def reindex(self,
+                model_name: str = None,
+                embedding_chunk_size: int = None,
+                distance: str = None,
+                workers: int = 4):
+        """Index the source units again in a new collection, with
+        another embedding model, chunk size or distance, while the
+        namespace is searched as it is, and then switch the namespace
+        to it.
+
+        The source units in the cache are chunked and embedded in
+        batches of embedding_batch_size chunks (embedding section), and
+        upserted by at most workers threads, so that the collection
+        that is being searched keeps most of the capacity of the
+        server. The new collection is built in this process, which
+        waits for it, rather than in the background.
+
+        While the new collection catches up with the cache,
+        embed_and_store writes the source units to both in this
+        process. Other processes only write to the namespace, so the
+        source units embedded since the reindex started are stored
+        again in the new collection before the switch, and those
+        embedded while catching up, once more after it.
+
+        The namespace is an alias, so the switch is atomic, and the
+        collections of earlier reindexes are deleted afterwards. A
+        namespace created before aliases is a plain collection, which
+        is deleted at the first switch, so it cannot be searched until
+        the alias is created. The chunk cache is replaced with the
+        chunks of the new collection.
+
+        The model of the new collection is recorded, and
+        embed_and_store refuses to write to the namespace until the
+        configuration is changed to it, along with the chunk size and
+        distance.
+        """
+        vector_store = self.get_vector_store()
+        if not hasattr(vector_store, 'switch_to'):
+            raise E.AwordError('The vector store does not support reindexing')
+
+        embedding_config = self.get_config('embedding').copy()
+        if model_name:
+            embedding_config['model_name'] = model_name
+        if embedding_chunk_size:
+            embedding_config['embedding_chunk_size'] = embedding_chunk_size
+        embedder = self.make_embedder(embedding_config)
+        embedding_batch_size = embedding_config.get('embedding_batch_size', 1000)
+        source_unit_cache = self.get_source_unit_cache()
+
+        shadow_chunk_cache = self.make_chunk_cache(table_name='chunk_reindex')
+        shadow_chunk_cache.reset_table(only_in_memory=False)
+        vector_store.collect_garbage()
+        start = datetime.now(utc)
+        shadow_store = vector_store.create_shadow(dimensions=embedder.dimensions,
+                                                  distance=distance,
+                                                  upsert_workers=workers)
+        self._reindex = (shadow_store, embedder, shadow_chunk_cache)
+
+        try:
+            self._store_in_shadow_in_batches(source_unit_cache.list_rows(),
+                                             embedding_batch_size)
+
+            # Catch up with the source units that changed meanwhile.
+            self.embed_and_store()
+            caught_up = datetime.now(utc)
+            self._store_in_shadow_in_batches(source_unit_cache.list_embedded_rows(since=start),
+                                             embedding_batch_size)
+        except BaseException:
+            self._reindex = None
+            vector_store.collect_garbage()
+            raise
+
+        try:
+            vector_store.switch_to(shadow_store)
+            self._store_in_shadow_in_batches(
+                source_unit_cache.list_embedded_rows(since=caught_up),
+                embedding_batch_size)
+        finally:
+            self._reindex = None
+        self.get_chunk_cache().replace_with(shadow_chunk_cache)
+        self.get_chunk_cache().set_namespace_model(vector_store.collection_name,
+                                                   embedder.model_name)
+        self._embedder[embedder.model_name] = embedder
+        vector_store.collect_garbage()
+
+    def is_large_source_unit(self, source_unit: Dict) -> bool:
+        """Whether the source unit has at least streaming_min_chars
+        characters (embedding section), so that it is streamed.
+        """
+        streaming_min_chars = self.get_config('embedding').get('streaming_min_chars', 1000000)
+        return sum(len(segment.body) for segment in source_unit['segments']) >= streaming_min_chars
+
+    def _store_in_shadow_in_batches(self, source_units: Iterable[Dict], batch_size: int):
+        """Store the source units in the collection that is being
+        built by reindex, embedding about batch_size chunks at a time.
+        Large source units are streamed.
+        """
+        chunked = []
+        pending_chunks = 0
+        n_source_units = 0
+        for source_unit in source_units:
+            if self.is_large_source_unit(source_unit):
+                self._stream_in_shadow(source_unit, batch_size)
+                n_source_units += 1
+                continue
+            chunked.append((source_unit, self._make_shadow_chunks(source_unit)))
+            pending_chunks += len(chunked[-1][1])
+            if pending_chunks >= batch_size:
+                self._store_chunked_in_shadow(chunked)
+                n_source_units += len(chunked)
+                self.logger.info('Reindexed %d source units', n_source_units)
+                chunked = []
+                pending_chunks = 0
+        if chunked:
+            self._store_chunked_in_shadow(chunked)
+
+    def _stream_in_shadow(self, source_unit: Dict, batch_size: int):
+        """Chunk, embed and store a large source unit in the collection
+        that is being built by reindex, batch_size chunks at a time.
+        """
+        shadow_store, embedder, shadow_chunk_cache = self._reindex
+        shadow_chunk_cache.delete_source_unit(source=source_unit['source'],
+                                              source_unit_id=source_unit['source_unit_id'])
+        for chunks in shadow_store.store_source_unit_in_batches(
+            embedder,
+            batch_size=batch_size,
+            source=source_unit['source'],
+            source_unit_id=source_unit['source_unit_id'],
+            source_unit_uri=source_unit['uri'],
+            categories=source_unit['categories'],
+            scope=source_unit['scope'],
+            context=source_unit['context'],
+            language=source_unit['language'],
+            segments=source_unit['segments'],
+        ):
+            shadow_chunk_cache.add(source=source_unit['source'],
+                                   source_unit_id=source_unit['source_unit_id'],
+                                   chunks=chunks,
+                                   model_name=embedder.model_name)
+
+    def _store_in_shadow(self, source_units: List[Dict]):
+        """Chunk, embed and store the source units in the collection
+        that is being built by reindex.
+        """
+        self._store_chunked_in_shadow([(source_unit, self._make_shadow_chunks(source_unit))
+                                       for source_unit in source_units])
+
+    def _make_shadow_chunks(self, source_unit: Dict) -> List:
+        shadow_store, embedder, _ = self._reindex
+        return shadow_store.make_source_unit_chunks(
+            embedder,
+            source=source_unit['source'],
+            source_unit_id=source_unit['source_unit_id'],
+            source_unit_uri=source_unit['uri'],
+            categories=source_unit['categories'],
+            scope=source_unit['scope'],
+            context=source_unit['context'],
+            language=source_unit['language'],
+            segments=source_unit['segments'],
+        )
+
+    def _store_chunked_in_shadow(self, chunked: List):
+        shadow_store, embedder, shadow_chunk_cache = self._reindex
+        embedder.embed_chunks([chunk for _, chunks in chunked for chunk in chunks])
+
+        for k, (source_unit, chunks) in enumerate(chunked):
+            chunks = shadow_store.store_chunks(source_unit['source_unit_id'],
+                                               chunks,
+                                               wait=k == len(chunked) - 1)
+            shadow_chunk_cache.delete_source_unit(source=source_unit['source'],
+                                                  source_unit_id=source_unit['source_unit_id'])
+            shadow_chunk_cache.add(source=source_unit['source'],
+                                   source_unit_id=source_unit['source_unit_id'],
+                                   chunks=chunks,
+                                   model_name=embedder.model_name)
+
 
 def add_args(parser):
     parser.add_argument(
@@ -343,6 +712,14 @@ def add_args(parser):
         ),
         action='store_true',
     )
+    parser.add_argument(
+        '--bulk-load',
+        help=(
+            'With --embed-cache or --refresh, index the vector database '
+            'only after storing all the chunks, and report how long each took'
+        ),
+        action='store_true',
+    )
     parser.add_argument(
         '--update-cache',
         help=('Updates the cache from all sources.'),
@@ -358,11 +735,47 @@ def add_args(parser):
         help=('Updates the cache from all sources and embeds it.'),
         type=str,
     )
+    parser.add_argument(
+        '--reindex',
+        help=(
+            'Embeds the cache again in a new collection, and switches '
+            'the vector namespace to it when it is complete. The first '
+            'time, a namespace that is not an alias yet is deleted before '
+            'the switch, and cannot be searched for a moment'
+        ),
+        action='store_true',
+    )
+    parser.add_argument(
+        '--reindex-model',
+        help=('Embedding model for --reindex, by default the configured one.'),
+        type=str,
+    )
+    parser.add_argument(
+        '--reindex-chunk-size',
+        help=('Embedding chunk size for --reindex, by default the configured one.'),
+        type=int,
+    )
+    parser.add_argument(
+        '--reindex-distance',
+        help=('Distance for --reindex (cosine, dot or euclid), by default the configured one.'),
+        type=str,
+    )
+    parser.add_argument(
+        '--reindex-workers',
+        help=('Maximum number of upsert workers for --reindex.'),
+        type=int,
+        default=4,
+    )
+
+
+def print_timings(timings):
+    if timings:
+        print(f"Loaded in {timings['load']:.1f} s, indexed in {timings['indexing']:.1f} s")
 
 
 def main(awd, args):
     if args['embed_cache']:
-        awd.embed_and_store()
+        print_timings(awd.embed_and_store(bulk_load=args['bulk_load']))
 
     if args['update_cache']:
         awd.update_cache()
@@ -372,7 +785,15 @@ def main(awd, args):
 
     if args['refresh']:
         awd.update_cache()
-        awd.embed_and_store()
+        print_timings(awd.embed_and_store(bulk_load=args['bulk_load']))
+
+    if args['reindex']:
+        awd.reindex(
+            model_name=args['reindex_model'],
+            embedding_chunk_size=args['reindex_chunk_size'],
+            distance=args['reindex_distance'],
+            workers=args['reindex_workers'],
+        )
 
 
 def app():
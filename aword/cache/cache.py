@@ -66,6 +66,9 @@ def add_args(parser):
                         help=('Count the rows in the chunk cache, '
                               'possibly restricted to a source [, source unit].'),
                         action='store_true')
+    parser.add_argument('--count-embeddings',
+                        help='Count the embeddings in the embedding cache.',
+                        action='store_true')
     parser.add_argument('--reset-embedded',
                         help=('Set the last embedded datetime to None, forcing the next embed, '
                               'possibly restricted to a source [, source unit].'),
@@ -97,7 +100,7 @@ def main(awd, args):
         for row in chunk_cache.list_rows(source=source,
                                          source_unit_id=source_unit_id):
             row_copy = row.copy()
-            if row_copy['vector']:
+            if row_copy['vector'] is not None and len(row_copy['vector']):
                 row_copy['vector'] = [row_copy['vector'][0], '...', row_copy['vector'][-1]]
             pprint(row_copy)
 
@@ -109,9 +112,12 @@ def main(awd, args):
         print(chunk_cache.count_rows(source=source,
                                      source_unit_id=source_unit_id))
 
+    if args['count_embeddings']:
+        embedding_cache = awd.get_embedding_cache()
+        print(embedding_cache.count_rows() if embedding_cache is not None else 0)
+
     if args['reset_embedded']:
-        source_unit_cache.reset_embedded(source=source,
-                                         source_unit_id=source_unit_id)
+        awd.reset_embedded(source=source, source_unit_id=source_unit_id)
 
     if args['reset_chunk_table']:
         chunk_cache.reset_table(only_in_memory=False)
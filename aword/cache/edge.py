@@ -2,6 +2,7 @@
 
 import pickle
 import json
+import hashlib
 from itertools import groupby
 import uuid
 import logging
@@ -9,8 +10,9 @@ import logging
 import sqlite3
 from sqlite3 import Error
 from datetime import datetime
-from typing import Optional, Dict, Any, List, Union
+from typing import Optional, Dict, Any, List, Union, Iterator, Tuple
 
+import numpy as np
 from pytz import utc
 
 import aword.errors as E
@@ -18,9 +20,7 @@ import aword.tools as T
 from aword.segment import Segment
 from aword.chunk import Payload, Chunk
 from aword.cache.cache import Cache, combine_segments, guess_language
-
-
-DbConnection = None
+from aword.dbpool import PoolRegistry
 
 
 def make_source_unit_cache(summarizer=None, **kw):
@@ -28,29 +28,45 @@ def make_source_unit_cache(summarizer=None, **kw):
 
 
 def make_chunk_cache(**kw):
-    return ChunkDB(db_file=kw.get('db_file', None))
+    return ChunkDB(db_file=kw.get('db_file', None), table_name=kw.get('table_name', 'chunk'))
 
 
-def get_connection(fname=None):
-    global DbConnection
-    if DbConnection is None:
-        logger = logging.getLogger(__name__)
-        try:
-            connect_to = ':memory:' if fname is None else fname
-            DbConnection = sqlite3.connect(connect_to)
-            DbConnection.row_factory = sqlite3.Row
-            logger.info('Created sqlite connection to %s', connect_to)
-        except sqlite3.Error as exc:
-            logger.error('Failed trying to connect to sqlite database %s', fname)
-            raise E.AwordError(f'Cannot connect to sqlite database {fname}') from exc
-    return DbConnection
+def make_embedding_cache(**kw):
+    max_rows = kw.get('embedding_cache_size', 100000)
+    if not max_rows:
+        return None
+    return EmbeddingDB(db_file=kw.get('db_file', None), max_rows=max_rows)
+
+
+Pools = PoolRegistry()
+get_pool = Pools.get_pool
+get_connection = Pools.get_connection
+close_connection = Pools.close_connection
 
 
-def close_connection():
-    global DbConnection
-    if DbConnection is not None:
-        DbConnection.close()
-        DbConnection = None
+def dump_vector(vector) -> Optional[bytes]:
+    """The raw float32 bytes of vector, which do not depend on the
+    version of numpy, unlike pickles.
+    """
+    if vector is None:
+        return None
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def load_vector(blob: Optional[bytes]) -> Optional[np.ndarray]:
+    """Vectors are raw float32 bytes. Older rows hold pickled lists of
+    floats or pickled arrays, which are converted.
+    """
+    if blob is None:
+        return None
+    if blob[:1] == b'\x80' and blob[-1:] == b'.':
+        try:
+            vector = pickle.loads(blob)
+        except Exception:  # pylint: disable=broad-except
+            pass
+        else:
+            return None if vector is None else np.asarray(vector, dtype=np.float32)
+    return np.frombuffer(blob, dtype=np.float32)
 
 
 def timestamp_str(ts, default=''):
@@ -103,12 +119,20 @@ class SourceUnitDB(Cache):
     def __init__(self, summarizer=None, db_file=None):
         super().__init__(summarizer)
 
-        self.conn = get_connection(db_file)
+        self.pool = get_pool(db_file)
         self.logger = logging.getLogger(__name__)
         self.create_table()
         self.create_history_table()
         self.db_file = db_file
 
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.pool.connection()
+
+    @property
+    def reader(self) -> sqlite3.Connection:
+        return self.pool.reader()
+
     def create_table(self):
         self.conn.execute("""
             CREATE TABLE IF NOT EXISTS source_unit (
@@ -263,21 +287,21 @@ class SourceUnitDB(Cache):
     def count_rows(self,
                    source: str = None,
                    source_unit_id: str = None) -> int:
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         query, args, _ = limit_query('SELECT COUNT(*) FROM source_unit', source, source_unit_id)
         cursor.execute(query, args)
         # fetchone will return a tuple with one element
         return cursor.fetchone()[0]
 
     def get_by_uri(self, source: str, uri: str) -> Optional[Dict[str, Any]]:
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         cursor.execute("SELECT * FROM source_unit WHERE uri=? AND source=?", (uri, source))
         return timestamps_to_datetimes(cursor.fetchone())
 
     def list_rows(self,
                   source: str = None,
                   source_unit_id: str = None) -> List[Dict[str, Any]]:
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         query, args, _ = limit_query('SELECT * FROM source_unit', source, source_unit_id)
         cursor.execute(query, args)
         return [timestamps_to_datetimes(dict(row)) for row in cursor.fetchall()]
@@ -288,7 +312,7 @@ class SourceUnitDB(Cache):
 
     def list_unembedded_rows(self,
                              source: str = None) -> List[Dict[str, Any]]:
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         query, args, _ = limit_query(('SELECT * FROM source_unit '
                                       'WHERE embedded_timestamp IS NULL '
                                       'OR embedded_timestamp < last_edited_timestamp'),
@@ -296,6 +320,17 @@ class SourceUnitDB(Cache):
         cursor.execute(query, args)
         return [timestamps_to_datetimes(row) for row in cursor.fetchall()]
 
+    def list_embedded_rows(self,
+                           since: datetime,
+                           source: str = None) -> List[Dict[str, Any]]:
+        """The source units embedded at or after since."""
+        cursor = self.reader.cursor()
+        query, args, _ = limit_query('SELECT * FROM source_unit WHERE embedded_timestamp >= ?',
+                                     source,
+                                     args=[timestamp_str(since)])
+        cursor.execute(query, args)
+        return [timestamps_to_datetimes(row) for row in cursor.fetchall()]
+
     def flag_as_embedded(self, rows: List[Dict[str, Any]], now: datetime = None):
         query = """
             UPDATE source_unit
@@ -321,7 +356,7 @@ class SourceUnitDB(Cache):
     def get_last_edited_timestamp(self,
                                   source: str,
                                   source_unit_id: str) -> Optional[datetime]:
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         cursor.execute("""
             SELECT last_edited_timestamp
             FROM source_unit
@@ -336,7 +371,7 @@ class SourceUnitDB(Cache):
         return None
 
     def get_most_recent_last_edited_timestamp(self) -> Optional[Chunk]:
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         cursor.execute("SELECT * FROM source_unit ORDER BY last_edited_timestamp DESC LIMIT 1")
         row = cursor.fetchone()
         if not row:
@@ -356,7 +391,7 @@ class SourceUnitDB(Cache):
         Returns:
             A list of dictionaries representing the history of the source unit.
         """
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         cursor.execute("""
             SELECT * FROM source_unit_history
             WHERE source = ? AND source_unit_id = ?
@@ -371,7 +406,7 @@ class SourceUnitDB(Cache):
     def get_state_at_date(self, date: datetime) -> List[Dict[str, Any]]:
         date_str = timestamp_str(date)
 
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         cursor.execute("""
             SELECT * FROM source_unit
             WHERE last_edited_timestamp <= ?
@@ -408,15 +443,23 @@ class SourceUnitDB(Cache):
 
 class ChunkDB:
 
-    def __init__(self, db_file=None):
-        self.conn = get_connection(db_file)
-        self.table_name = 'chunk'
+    def __init__(self, db_file=None, table_name='chunk'):
+        self.pool = get_pool(db_file)
+        self.table_name = table_name
 
         self.logger = logging.getLogger(__name__)
 
         self.create_table()
         self.db_file = db_file
 
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.pool.connection()
+
+    @property
+    def reader(self) -> sqlite3.Connection:
+        return self.pool.reader()
+
     def create_table(self):
         self.conn.execute(f"""
         CREATE TABLE IF NOT EXISTS {self.table_name} (
@@ -427,10 +470,35 @@ class ChunkDB:
           payload TEXT,
           vector_db_id TEXT,
           added_timestamp TIMESTAMP,
+          model_name TEXT,
           PRIMARY KEY(source, source_unit_id, chunk_id),
           FOREIGN KEY(source, source_unit_id) REFERENCES source_unit(source, source_unit_id)
         )
         """)
+        columns = [row['name'] for row in
+                   self.conn.execute(f"PRAGMA table_info({self.table_name})").fetchall()]
+        if 'model_name' not in columns:
+            # Tables from before the model was recorded.
+            self.conn.execute(f"ALTER TABLE {self.table_name} ADD COLUMN model_name TEXT")
+        self.conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS {self.table_name}_vector_db_id
+        ON {self.table_name} (vector_db_id)
+        """)
+        self.conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {self.table_name}_rebuild (
+          vector_namespace TEXT PRIMARY KEY,
+          last_rowid INTEGER,
+          n_points INTEGER,
+          updated_timestamp TIMESTAMP
+        )
+        """)
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS vector_namespace_model (
+          vector_namespace TEXT PRIMARY KEY,
+          model_name TEXT,
+          updated_timestamp TIMESTAMP
+        )
+        """)
         self.logger.info('Attempted %s table creation', self.table_name)
 
     def reset_table(self, only_in_memory=True):
@@ -442,6 +510,7 @@ class ChunkDB:
             return
         try:
             self.conn.execute(f"DROP TABLE IF EXISTS {self.table_name}")
+            self.conn.execute(f"DROP TABLE IF EXISTS {self.table_name}_rebuild")
             self.logger.info('Dropped table %s', self.table_name)
             self.create_table()
         except Error as e:
@@ -452,17 +521,20 @@ class ChunkDB:
             source: str,
             source_unit_id: str,
             chunks: List[Chunk],
-            now=None):
+            now=None,
+            model_name: str = None):
+        """model_name is the embedding model of the vectors."""
         self.conn.executemany(f"""
         INSERT OR REPLACE INTO {self.table_name}
-        VALUES (?, ?, ?, ?, ?, ?, ?)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """, [(chunk.chunk_id or str(uuid.uuid5(uuid.NAMESPACE_URL, chunk.text)),
                source,
                source_unit_id,
-               pickle.dumps(chunk.vector),
+               dump_vector(chunk.vector),
                json.dumps(chunk.payload),
                chunk.vector_db_id,
-               timestamp_str(now or datetime.now(utc)))
+               timestamp_str(now or datetime.now(utc)),
+               model_name)
               for chunk in chunks])
         self.conn.commit()
         self.logger.info('Inserted %d chunks in %s (%s, %s)',
@@ -484,7 +556,7 @@ class ChunkDB:
         SourceUnitDB.get_unembedded.  It enables quick selection of
         all the unembedded source units for any given model.
         """
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         cursor.execute(f"SELECT * FROM {self.table_name} ORDER BY added_timestamp DESC LIMIT 1")
         row = cursor.fetchone()
         if not row:
@@ -497,7 +569,7 @@ class ChunkDB:
     def count_rows(self,
                    source: str = None,
                    source_unit_id: str = None) -> int:
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         query, args, _ = limit_query(f'SELECT COUNT(*) FROM {self.table_name}',
                                      source,
                                      source_unit_id)
@@ -506,10 +578,10 @@ class ChunkDB:
         return cursor.fetchone()[0]
 
     def get(self, chunk_id: str) -> Optional[Chunk]:
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         cursor.execute(f"SELECT * FROM {self.table_name} WHERE chunk_id=?", (chunk_id,))
         row = cursor.fetchone()
-        return Chunk(vector=pickle.loads(row['vector']),
+        return Chunk(vector=load_vector(row['vector']),
                      payload=Payload(**(json.loads(row['payload']))),
                      chunk_id=row['chunk_id'],
                      vector_db_id=row['vector_db_id']) if row else None
@@ -517,28 +589,164 @@ class ChunkDB:
     def list_rows(self,
                   source: str = None,
                   source_unit_id: str = None) -> List[Dict[str, Any]]:
-        cursor = self.conn.cursor()
+        cursor = self.reader.cursor()
         query, args, _ = limit_query(f'SELECT * FROM {self.table_name}',
                                      source,
                                      source_unit_id)
         cursor.execute(query, args)
-        return [Chunk(vector=pickle.loads(row['vector']),
+        return [Chunk(vector=load_vector(row['vector']),
                       payload=Payload(**(json.loads(row['payload']))),
                       chunk_id=row['chunk_id'],
                       vector_db_id=row['vector_db_id'])
                 for row in cursor.fetchall()]
 
-    def get_by_source_unit(self, source: str, source_unit_id: str) -> List[Chunk]:
-        cursor = self.conn.cursor()
+    def get_by_source_unit(self,
+                           source: str,
+                           source_unit_id: str,
+                           model_name: str = None) -> List[Chunk]:
+        """With model_name, the chunks are only returned if all of them
+        were embedded with that model, since otherwise their vectors
+        cannot be reused.
+        """
+        cursor = self.reader.cursor()
         cursor.execute(f"SELECT * FROM {self.table_name} WHERE source=? AND source_unit_id=?",
                        (source, source_unit_id))
         rows = cursor.fetchall()
-        return [Chunk(vector=pickle.loads(row['vector']),
+        if model_name is not None and any(row['model_name'] != model_name for row in rows):
+            return []
+        return [Chunk(vector=load_vector(row['vector']),
                       payload=Payload(**(json.loads(row['payload']))),
                       chunk_id=row['chunk_id'],
                       vector_db_id=row['vector_db_id'])
                 for row in rows]
 
+    def get_payloads_by_vector_db_id(self, vector_db_ids: List[str]) -> Dict[str, Payload]:
+        """Return the payload of the chunks stored in the vector
+        database with these ids, by id. Ids without a chunk are left out.
+        """
+        found = {}
+        cursor = self.reader.cursor()
+        # Stay below the sqlite limit of variables per statement.
+        batch_size = 500
+        for k in range(0, len(vector_db_ids), batch_size):
+            batch = list(set(vector_db_ids[k:k + batch_size]))
+            cursor.execute(f"""
+            SELECT vector_db_id, payload FROM {self.table_name}
+            WHERE vector_db_id IN ({', '.join('?' * len(batch))})
+            """, batch)
+            found.update((row['vector_db_id'], Payload(**(json.loads(row['payload']))))
+                         for row in cursor.fetchall())
+        return found
+
+    def iter_batches(self,
+                     batch_size: int = 10000,
+                     after_rowid: int = 0,
+                     model_name: str = None) -> Iterator[Tuple[int, List[Chunk]]]:
+        """Yield the chunks in batches of batch_size, in the order in
+        which they were added, together with the rowid of the last
+        chunk of each batch. Passing it as after_rowid continues after
+        that batch. With model_name, only the chunks embedded with that
+        model, or with an unknown one, from before models were
+        recorded.
+        """
+        model_query = '' if model_name is None else 'AND (model_name = ? OR model_name IS NULL)'
+        model_args = () if model_name is None else (model_name,)
+        cursor = self.reader.cursor()
+        while True:
+            cursor.execute(f"""
+            SELECT rowid, * FROM {self.table_name}
+            WHERE rowid > ? {model_query}
+            ORDER BY rowid
+            LIMIT ?
+            """, (after_rowid, *model_args, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            after_rowid = rows[-1]['rowid']
+            yield after_rowid, [Chunk(vector=load_vector(row['vector']),
+                                      payload=Payload(**(json.loads(row['payload']))),
+                                      chunk_id=row['chunk_id'],
+                                      vector_db_id=row['vector_db_id'])
+                                for row in rows]
+
+    def get_rebuild_checkpoint(self, vector_namespace: str) -> Optional[Dict[str, Any]]:
+        """Return the last_rowid and n_points stored by an unfinished
+        rebuild of vector_namespace, or None.
+        """
+        cursor = self.reader.cursor()
+        cursor.execute(f"SELECT * FROM {self.table_name}_rebuild WHERE vector_namespace = ?",
+                       (vector_namespace,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    def set_rebuild_checkpoint(self, vector_namespace: str, last_rowid: int, n_points: int):
+        self.conn.execute(f"""
+        INSERT OR REPLACE INTO {self.table_name}_rebuild
+        VALUES (?, ?, ?, ?)
+        """, (vector_namespace, last_rowid, n_points, timestamp_str(datetime.now(utc))))
+        self.conn.commit()
+
+    def delete_rebuild_checkpoint(self, vector_namespace: str):
+        self.conn.execute(f"DELETE FROM {self.table_name}_rebuild WHERE vector_namespace = ?",
+                          (vector_namespace,))
+        self.conn.commit()
+
+    def get_namespace_model(self, vector_namespace: str) -> Optional[str]:
+        """The model that the vectors of vector_namespace were embedded
+        with by a reindex, or None if it was not reindexed.
+        """
+        cursor = self.reader.cursor()
+        cursor.execute("SELECT model_name FROM vector_namespace_model WHERE vector_namespace = ?",
+                       (vector_namespace,))
+        row = cursor.fetchone()
+        return row['model_name'] if row else None
+
+    def set_namespace_model(self, vector_namespace: str, model_name: str):
+        self.conn.execute("""
+        INSERT OR REPLACE INTO vector_namespace_model
+        VALUES (?, ?, ?)
+        """, (vector_namespace, model_name, timestamp_str(datetime.now(utc))))
+        self.conn.commit()
+
+    def delete_namespace_model(self, vector_namespace: str):
+        self.conn.execute("DELETE FROM vector_namespace_model WHERE vector_namespace = ?",
+                          (vector_namespace,))
+        self.conn.commit()
+
+    def replace_with(self, other: 'ChunkDB'):
+        """Replace the chunks with those of other, in another table of
+        the same database, in a single transaction. Other is left
+        empty, and the checkpoints of rebuilds are forgotten, since the
+        chunks are in a different order.
+        """
+        try:
+            with self.conn:
+                self.conn.execute(f"DELETE FROM {self.table_name}")
+                self.conn.execute(f"INSERT INTO {self.table_name} "
+                                  f"SELECT * FROM {other.table_name}")
+                self.conn.execute(f"DELETE FROM {other.table_name}")
+                self.conn.execute(f"DELETE FROM {self.table_name}_rebuild")
+        except sqlite3.Error as e:
+            raise E.AwordError(f'Failed trying to replace {self.table_name} '
+                               f'with {other.table_name}') from e
+        self.logger.info('Replaced %s with %s', self.table_name, other.table_name)
+
+    def reset_vector_db_ids(self,
+                            source: str = None,
+                            source_unit_id: str = None):
+        """Flag the chunks as not stored, so that embed_and_store stores
+        their source units from scratch.
+        """
+        query, args, logstr = limit_query(f'UPDATE {self.table_name} SET vector_db_id = null',
+                                          source,
+                                          source_unit_id)
+        try:
+            self.conn.execute(query, args)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            raise E.AwordError(f'Failed trying to reset vector_db_id{logstr}') from e
+        self.logger.info('Resetted vector_db_id in %s%s', self.table_name, logstr)
+
     def reset_vector_db_id_by_source_unit(self, source: str, source_unit_id: str):
         try:
             self.conn.execute(f"""
@@ -550,3 +758,127 @@ class ChunkDB:
         except sqlite3.Error as e:
             raise E.AwordError('Failed trying to resent vector_db_id by source unit '
                                f'({source}, {source_unit_id})') from e
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingDB:
+    """Content addressed cache of embeddings, keyed by the model name
+    and the hash of the embedded text. When it holds more than
+    max_rows embeddings the least recently used are evicted.
+    """
+
+    def __init__(self, db_file=None, max_rows: int = 100000):
+        self.pool = get_pool(db_file)
+        self.table_name = 'embedding'
+        self.max_rows = max_rows
+
+        self.logger = logging.getLogger(__name__)
+
+        self.create_table()
+        self.db_file = db_file
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.pool.connection()
+
+    @property
+    def reader(self) -> sqlite3.Connection:
+        return self.pool.reader()
+
+    def create_table(self):
+        self.conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {self.table_name} (
+          model_name TEXT,
+          text_hash TEXT,
+          vector BLOB,
+          last_used_timestamp TIMESTAMP,
+          PRIMARY KEY(model_name, text_hash)
+        )
+        """)
+        self.conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS {self.table_name}_last_used
+        ON {self.table_name} (last_used_timestamp)
+        """)
+        self.logger.info('Attempted %s table creation', self.table_name)
+
+    def reset_table(self, only_in_memory=True):
+        logger = logging.getLogger(__name__)
+
+        if self.db_file is not None and only_in_memory:
+            logger.warning('Refusing to drop persistent embedding table '
+                           'without `only_in_memory` argument')
+            return
+        try:
+            self.conn.execute(f"DROP TABLE IF EXISTS {self.table_name}")
+            self.logger.info('Dropped table %s', self.table_name)
+            self.create_table()
+        except Error as e:
+            logger.error('Failed trying to recreate %s table', self.table_name)
+            raise E.AwordError(f'Failed trying to create {self.table_name} table') from e
+
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Return the cached embedding of each text, or None for the
+        texts that are not cached, and flag the hits as recently used.
+        """
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        cursor = self.reader.cursor()
+        # Stay below the sqlite limit of variables per statement.
+        batch_size = 500
+        for k in range(0, len(hashes), batch_size):
+            batch = list(set(hashes[k:k + batch_size]))
+            cursor.execute(f"""
+            SELECT text_hash, vector FROM {self.table_name}
+            WHERE model_name = ? AND text_hash IN ({', '.join('?' * len(batch))})
+            """, [model_name, *batch])
+            found.update((row['text_hash'], load_vector(row['vector']))
+                         for row in cursor.fetchall())
+
+        if found:
+            now = timestamp_str(datetime.now(utc))
+            self.conn.executemany(f"""
+            UPDATE {self.table_name} SET last_used_timestamp = ?
+            WHERE model_name = ? AND text_hash = ?
+            """, [(now, model_name, h) for h in found])
+            self.conn.commit()
+
+        self.logger.debug('Found %d of %d embeddings for %s in %s',
+                          len([h for h in hashes if h in found]),
+                          len(hashes),
+                          model_name,
+                          self.table_name)
+        return [found.get(h) for h in hashes]
+
+    def add_many(self, model_name: str, texts: List[str], vectors: np.ndarray):
+        now = timestamp_str(datetime.now(utc))
+        self.conn.executemany(f"""
+        INSERT OR REPLACE INTO {self.table_name}
+        VALUES (?, ?, ?, ?)
+        """, [(model_name, text_hash(text), dump_vector(vector), now)
+              for text, vector in zip(texts, vectors)])
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        excess = self.count_rows() - self.max_rows
+        if excess > 0:
+            self.conn.execute(f"""
+            DELETE FROM {self.table_name} WHERE rowid IN (
+              SELECT rowid FROM {self.table_name}
+              ORDER BY last_used_timestamp ASC, rowid ASC LIMIT ?
+            )
+            """, (excess,))
+            self.conn.commit()
+            self.logger.info('Evicted %d embeddings from %s', excess, self.table_name)
+
+    def count_rows(self, model_name: str = None) -> int:
+        cursor = self.reader.cursor()
+        if model_name is None:
+            cursor.execute(f'SELECT COUNT(*) FROM {self.table_name}')
+        else:
+            cursor.execute(f'SELECT COUNT(*) FROM {self.table_name} WHERE model_name = ?',
+                           (model_name,))
+        return cursor.fetchone()[0]
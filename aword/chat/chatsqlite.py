@@ -4,43 +4,22 @@
 
 from typing import Dict, List
 import uuid
-import logging
 import sqlite3
 from datetime import datetime
 from pytz import utc
 
-import aword.errors as E
-
 from aword.chat.chat import Chat
-
-
-DbConnection = None
+from aword.dbpool import PoolRegistry
 
 
 def make_chat(awd, **kw):
     return ChatSQLite(awd, db_file=kw.get('db_file', None))
 
 
-def get_connection(fname=None):
-    global DbConnection
-    if DbConnection is None:
-        logger = logging.getLogger(__name__)
-        try:
-            connect_to = ':memory:' if fname is None else fname
-            DbConnection = sqlite3.connect(connect_to)
-            DbConnection.row_factory = sqlite3.Row
-            logger.info('Created sqlite connection to %s', connect_to)
-        except sqlite3.Error as exc:
-            logger.error('Failed trying to connect to sqlite database %s', fname)
-            raise E.AwordError(f'Cannot connect to sqlite database {fname}') from exc
-    return DbConnection
-
-
-def close_connection():
-    global DbConnection
-    if DbConnection is not None:
-        DbConnection.close()
-        DbConnection = None
+Pools = PoolRegistry()
+get_pool = Pools.get_pool
+get_connection = Pools.get_connection
+close_connection = Pools.close_connection
 
 
 class ChatSQLite(Chat):
@@ -50,9 +29,17 @@ class ChatSQLite(Chat):
         self.vector_namespace = awd.get_vector_namespace()
         awd.logger.info('Initializing sqlite chat for vector namespace %s', self.vector_namespace)
         self.db_file = db_file
-        self.connection = get_connection(self.db_file)
+        self.pool = get_pool(self.db_file)
         self._init_tables()
 
+    @property
+    def connection(self) -> sqlite3.Connection:
+        return self.pool.connection()
+
+    @property
+    def reader(self) -> sqlite3.Connection:
+        return self.pool.reader()
+
     def _init_tables(self):
         cursor = self.connection.cursor()
         cursor.execute('''
@@ -122,7 +109,7 @@ class ChatSQLite(Chat):
         user's permisions to access a vector_namespace are revoked
         they could still access it if they knew a chat_id.
         """
-        cursor = self.connection.cursor()
+        cursor = self.reader.cursor()
         cursor.execute('''
         SELECT role, said, background,total_tokens FROM message WHERE chat_id = ?
         ORDER BY created_timestamp ASC
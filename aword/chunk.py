@@ -6,6 +6,8 @@ from datetime import datetime
 import copy
 from typing import List, Dict, Union
 
+import numpy as np
+
 import aword.tools as T
 
 
@@ -89,10 +91,11 @@ class Chunk(dict):
     def __init__(self,
                  payload: Union[Payload, dict],
                  chunk_id: str = None,
-                 vector: List[float] = None,
+                 vector: np.ndarray = None,
                  vector_db_id: str = None):
         """The payload dictionary should include a source and a
-        source_unit_id. Possibly also a category and a scope.
+        source_unit_id. Possibly also a category and a scope. The
+        vector is a float32 array.
         """
         self.vector = vector
         self.payload = payload if isinstance(payload, Payload) else Payload(**payload)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""SQLite connections for several threads.
+
+A sqlite3 connection cannot be shared across threads, so each thread
+gets its own from the pool, one that writes and one that only reads.
+Databases in files are in WAL mode, so that readers do not wait for
+the writer nor block it. In-memory databases are shared by all the
+connections of the pool, so that they all see the same tables.
+"""
+
+import os
+import logging
+import sqlite3
+import pathlib
+import threading
+import itertools
+from typing import Dict, Tuple
+
+import aword.errors as E
+
+
+_memory_ids = itertools.count()
+
+
+class ConnectionPool:
+
+    def __init__(self,
+                 fname: str = None,
+                 busy_timeout: int = 5000,
+                 cache_size: int = 64 * 1024,
+                 mmap_size: int = 256 * 1024 * 1024):
+        """The database is in fname, or in memory if it is None.
+        Connections wait at most busy_timeout milliseconds for a lock,
+        and keep cache_size KiB of pages in memory, and mmap_size
+        bytes of the database memory mapped.
+        """
+        self.fname = fname
+        self.busy_timeout = busy_timeout
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.logger = logging.getLogger(__name__)
+
+        if fname is None:
+            self.uri = f'file:aword-{next(_memory_ids)}?mode=memory&cache=shared'
+        else:
+            self.uri = pathlib.Path(os.path.abspath(fname)).as_uri()
+
+        self._connections: Dict[Tuple[threading.Thread, bool], sqlite3.Connection] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.closed = False
+
+        # The in-memory database lives while it has a connection.
+        self._keeper = self._connect(read_only=False)
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        try:
+            # Only this thread uses the connection, but close may be
+            # called from another one.
+            conn = sqlite3.connect(self.uri,
+                                   uri=True,
+                                   timeout=self.busy_timeout / 1000,
+                                   check_same_thread=False)
+        except sqlite3.Error as exc:
+            self.logger.error('Failed trying to connect to sqlite database %s', self.fname)
+            raise E.AwordError(f'Cannot connect to sqlite database {self.fname}') from exc
+
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size)}')
+        if self.fname is None:
+            if read_only:
+                # Shared cache connections lock tables, unless they
+                # read uncommitted changes.
+                conn.execute('PRAGMA read_uncommitted = 1')
+        else:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        if read_only:
+            conn.execute('PRAGMA query_only = 1')
+
+        self.logger.info('Created %s sqlite connection to %s',
+                         'read-only' if read_only else 'read-write',
+                         self.fname or ':memory:')
+        return conn
+
+    def _get(self, read_only: bool) -> sqlite3.Connection:
+        if self.closed:
+            # Like a closed sqlite3 connection, rather than opening a
+            # new, and for :memory: empty, database.
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        attr = 'reader' if read_only else 'writer'
+        conn = getattr(self._local, attr, None)
+        if conn is None:
+            conn = self._connect(read_only)
+            setattr(self._local, attr, conn)
+            with self._lock:
+                # Close the connections of the threads that are gone.
+                for key in [key for key in self._connections if not key[0].is_alive()]:
+                    self._connections.pop(key).close()
+                self._connections[(threading.current_thread(), read_only)] = conn
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """The read-write connection of this thread."""
+        return self._get(read_only=False)
+
+    def reader(self) -> sqlite3.Connection:
+        """The read-only connection of this thread. It sees what the
+        writers have committed.
+        """
+        return self._get(read_only=True)
+
+    def close(self):
+        """Close all the connections. The pool cannot be used after."""
+        with self._lock:
+            self.closed = True
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+            self._keeper.close()
+        self._local = threading.local()
+
+
+class PoolRegistry:
+    """The pools of a module, one per database file."""
+
+    def __init__(self):
+        self._pools: Dict[str, ConnectionPool] = {}
+        self._lock = threading.Lock()
+
+    def get_pool(self, fname: str = None) -> ConnectionPool:
+        with self._lock:
+            if fname not in self._pools:
+                self._pools[fname] = ConnectionPool(fname)
+            return self._pools[fname]
+
+    def get_connection(self, fname: str = None) -> sqlite3.Connection:
+        return self.get_pool(fname).connection()
+
+    def close_connection(self):
+        """Close all the pools. Objects that still hold one get an
+        error if they use it, and get_pool opens new ones.
+        """
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
-from typing import Callable, Any, List, Dict
+import math
+import hashlib
+import time
+import atexit
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Callable, Any, List, Dict, Iterator, Optional
 
 import numpy as np
 
+import aword.tools as T
 from aword.chunk import Payload, Chunk
 from aword.apis import oai
 
@@ -15,20 +25,131 @@ def make_embedder(awd, config: Dict):
     if provider == 'huggingface':
         return HuggingFaceEmbedder(awd, **config)
 
+    if provider == 'huggingface-int8':
+        return QuantizedHuggingFaceEmbedder(awd, **config)
+
     if provider == 'openai':
         return OAIEmbedder(awd, **config)
 
+    if provider in ('hash', 'synthetic'):
+        return HashEmbedder(awd, **config)
+
     raise ValueError(f"Unknown model provider '{provider}'")
 
 
-def get_col_average_from_list_of_lists(list_of_lists: List[List]):
+def as_vectors(embeddings) -> np.ndarray:
+    """Return the embeddings as a float32 matrix, one row per
+    embedding. Vectors are float32 arrays everywhere in aword, they
+    only become lists when sent to a vector database client.
+    """
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def get_col_average_from_list_of_lists(list_of_lists: np.ndarray) -> np.ndarray:
     """Return the average of each column in a list of lists."""
     if len(list_of_lists) == 1:
         return list_of_lists[0]
 
-    list_of_lists_array = np.array(list_of_lists)
-    average_embedding = np.average(list_of_lists_array, axis=0)
-    return average_embedding.tolist()
+    return np.average(as_vectors(list_of_lists), axis=0).astype(np.float32)
+
+
+def scan_chunk_boundaries(tokenizer: Any, tokens: List[int], n: int, complete: bool = True):
+    """Yield (chunk_tokens, chunk_text) decoding every candidate chunk
+    to look for the end of a paragraph or a sentence. It is slow, but
+    it works with any tokenizer that has a decode.
+
+    If complete is False more tokens will follow, and it stops when
+    there are not enough tokens left to be sure of the next boundary.
+    """
+    i = 0
+    while i < len(tokens) and (complete or i + int(1.5 * n) <= len(tokens)):
+        # Find the nearest end of paragraph within a range of 0.5 * n and 1.5 * n tokens
+        j = min(i + int(1.5 * n), len(tokens))
+        while j > i + int(0.5 * n):
+            # Decode the tokens and check for full stop or newline
+            chunk = tokenizer.decode(tokens[i:j])
+            if chunk.endswith("\n"):
+                break
+            j -= 1
+
+        # If no end of paragraph found, try to find end of sentence
+        if j == i + int(0.5 * n):
+            j = min(i + int(1.5 * n), len(tokens))
+            while j > i + int(0.5 * n):
+                # Decode the tokens and check for full stop or newline
+                chunk = tokenizer.decode(tokens[i:j])
+                if chunk.endswith("."):
+                    break
+                j -= 1
+
+        # If no end of sentence found, use n tokens as the chunk size
+        if j == i + int(0.5 * n):
+            j = min(i + n, len(tokens))
+        yield tokens[i:j], tokenizer.decode(tokens[i:j])
+        i = j
+
+
+def index_chunk_boundaries(n_tokens: int,
+                           n: int,
+                           paragraph_ends: List[int],
+                           sentence_ends: List[int],
+                           complete: bool = True):
+    """Yield the (start, end) token positions of the chunks, picking
+    the same boundaries as scan_chunk_boundaries. paragraph_ends and
+    sentence_ends are the sorted end positions of the token slices that
+    finish with a newline and with a full stop respectively.
+    """
+
+    def _last_in_range(ends, lo, hi):
+        k = bisect_right(ends, hi)
+        if k and ends[k - 1] > lo:
+            return ends[k - 1]
+        return None
+
+    i = 0
+    while i < n_tokens and (complete or i + int(1.5 * n) <= n_tokens):
+        lo = i + int(0.5 * n)
+        hi = min(i + int(1.5 * n), n_tokens)
+        j = _last_in_range(paragraph_ends, lo, hi)
+        if j is None:
+            j = _last_in_range(sentence_ends, lo, hi)
+        if j is None:
+            j = min(i + n, n_tokens)
+        yield i, j
+        i = j
+
+
+def sentence_transformers_path(model_name: str) -> str:
+    """The path of a sentence transformers model in the HuggingFace
+    hub, resolved as SentenceTransformer does it.
+    """
+    if '/' in model_name or os.path.exists(model_name):
+        return model_name
+    return 'sentence-transformers/' + model_name
+
+
+def hash_vector(text: str, dimensions: int) -> np.ndarray:
+    """A pseudo-random unit vector seeded by a hash of the text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimensions, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def normalize_query(query: str) -> str:
+    """Queries that only differ in case or in white space get the
+    same embedding.
+    """
+    return ' '.join(query.split()).casefold()
+
+
+class QueryEmbeddingCache(T.TTLCache):
+    """Query embeddings, keyed by model name and query."""
+
+    def get(self, model_name: str, query: str) -> Optional[np.ndarray]:
+        return super().get((model_name, query))
+
+    def put(self, model_name: str, query: str, vector: np.ndarray):
+        super().put((model_name, query), vector)
 
 
 class Embedder:
@@ -39,9 +160,13 @@ class Embedder:
                  chunk_size: int,
                  model_name: str,
                  max_sequence_length: int,
-                 dimensions: int):
+                 dimensions: int,
+                 embedding_cache: Any = None,
+                 query_cache: QueryEmbeddingCache = None):
         self.tokenizer = tokenizer
         self.embedding_fn = embedding_fn
+        self.embedding_cache = embedding_cache
+        self.query_cache = query_cache
 
         # TODO Suppoprt larger chunk sizes, and do an average of the vectors.
         assert chunk_size <= max_sequence_length
@@ -50,6 +175,13 @@ class Embedder:
         self.model_name = model_name
         self.max_sequence_length = max_sequence_length
         self.dimensions = dimensions
+        self.logger = logging.getLogger(__name__)
+
+    def warmup(self):
+        """Load whatever is loaded lazily, like model weights, so that
+        the first request does not wait for it. Servers should call it
+        when starting.
+        """
 
     def encode(self, text):
         return self.tokenizer.encode(text)
@@ -67,36 +199,165 @@ class Embedder:
 
         #! tokenizer is an object with an encode and a decode
         tokens = self.tokenizer.encode(re.sub(r'[ \t]+', ' ', text))
-        i = 0
-        while i < len(tokens):
-            # Find the nearest end of paragraph within a range of 0.5 * n and 1.5 * n tokens
-            j = min(i + int(1.5 * n), len(tokens))
-            while j > i + int(0.5 * n):
-                # Decode the tokens and check for full stop or newline
-                chunk = self.tokenizer.decode(tokens[i:j])
-                if chunk.endswith("\n"):
-                    break
-                j -= 1
-
-            # If no end of paragraph found, try to find end of sentence
-            if j == i + int(0.5 * n):
-                j = min(i + int(1.5 * n), len(tokens))
-                while j > i + int(0.5 * n):
-                    # Decode the tokens and check for full stop or newline
-                    chunk = self.tokenizer.decode(tokens[i:j])
-                    if chunk.endswith("."):
-                        break
-                    j -= 1
-
-            # If no end of sentence found, use n tokens as the chunk size
-            if j == i + int(0.5 * n):
-                j = min(i + n, len(tokens))
-            yield tokens[i:j], self.tokenizer.decode(tokens[i:j])
-            i = j
+        yield from self.split_tokens_in_chunks(tokens, n)
+
+    def split_tokens_in_chunks(self,
+                               tokens: List[int],
+                               n: int,
+                               complete: bool = True):
+        """Yield successive n-sized (chunk_tokens, chunk_text) from
+        tokens. If complete is False more tokens will follow, and it
+        stops before the tokens at the end that could belong to a chunk
+        with the tokens to come.
+        """
+        if not hasattr(self.tokenizer, 'decode_single_token_bytes'):
+            yield from scan_chunk_boundaries(self.tokenizer, tokens, n, complete)
+            return
+
+        # Byte level tokenizers (tiktoken) decode a slice of tokens as
+        # the concatenation of the bytes of each token, so a slice
+        # ends with a newline or a full stop if and only if the byte
+        # before its end offset is one. We decode all the tokens once,
+        # index the token offsets where a paragraph or a sentence
+        # ends, and look the boundaries up in the index.
+        text_bytes = self.tokenizer.decode_bytes(tokens)
+        token_length = {token: len(self.tokenizer.decode_single_token_bytes(token))
+                        for token in set(tokens)}
+        offsets = [0, *accumulate(map(token_length.__getitem__, tokens))]
+
+        def _ends_at(byte):
+            ends = []
+            for match in re.finditer(re.escape(byte), text_bytes):
+                j = bisect_left(offsets, match.end())
+                if offsets[j] == match.end():
+                    ends.append(j)
+            return ends
+
+        paragraph_ends = _ends_at(b'\n')
+        sentence_ends = _ends_at(b'.')
+
+        for i, j in index_chunk_boundaries(len(tokens),
+                                           n,
+                                           paragraph_ends,
+                                           sentence_ends,
+                                           complete):
+            yield tokens[i:j], text_bytes[offsets[i]:offsets[j]].decode('utf-8', errors='replace')
 
     def get_embeddings(self,
-                       chunked_texts: List[str]) -> List[float]:
-        return self.embedding_fn(chunked_texts, self.model_name)
+                       chunked_texts: List[str]) -> np.ndarray:
+        """Returns a float32 matrix with the embedding of each text in
+        a row. Only the texts that are not in the embedding cache, if
+        there is one, are sent to the embedding function.
+        """
+        if self.embedding_cache is None:
+            return as_vectors(self.embedding_fn(chunked_texts, self.model_name))
+
+        embeddings = self.embedding_cache.get_many(self.model_name, chunked_texts)
+        missing_texts = list(dict.fromkeys(text
+                                           for text, embedding in zip(chunked_texts, embeddings)
+                                           if embedding is None))
+        if missing_texts:
+            missing_embeddings = as_vectors(self.embedding_fn(missing_texts, self.model_name))
+            self.embedding_cache.add_many(self.model_name, missing_texts, missing_embeddings)
+            fetched = dict(zip(missing_texts, missing_embeddings))
+            embeddings = [fetched[text] if embedding is None else embedding
+                          for text, embedding in zip(chunked_texts, embeddings)]
+
+        return as_vectors(embeddings)
+
+    def get_query_embedding(self, query: str) -> np.ndarray:
+        """Returns the embedding of the query. Recent queries are
+        answered from the query cache, where queries that only differ
+        in case or in white space share an entry; the rest go through
+        get_embeddings, and so through the embedding cache, which is
+        shared by all the processes that use the same cache database.
+        """
+        return self.get_query_embeddings([query])[0]
+
+    def get_query_embeddings(self,
+                             queries: List[str],
+                             uncached: List[str] = None) -> np.ndarray:
+        """Like get_query_embedding, embedding all the queries that are
+        not in the query cache in a single call to get_embeddings. The
+        uncached texts, long one-off texts like a conversation history,
+        are embedded in the same call without going through the query
+        cache, and their embeddings follow those of the queries.
+        """
+        uncached = list(uncached or [])
+        if self.query_cache is None:
+            return self.get_embeddings(list(queries) + uncached)
+
+        # The normalized queries are only the keys, the models get the
+        # queries as they come.
+        keys = [normalize_query(query) for query in queries]
+        vectors = [self.query_cache.get(self.model_name, key) for key in keys]
+        missing = {}
+        for key, query, vector in zip(keys, queries, vectors):
+            if vector is None:
+                missing.setdefault(key, query)
+        if missing or uncached:
+            embeddings = self.get_embeddings(list(missing.values()) + uncached)
+            fetched = dict(zip(missing, embeddings))
+            for key, vector in fetched.items():
+                self.query_cache.put(self.model_name, key, vector)
+            vectors = [fetched[key] if vector is None else vector
+                       for key, vector in zip(keys, vectors)]
+            vectors += list(embeddings[len(missing):])
+        return as_vectors(vectors)
+
+    def get_chunks(self, text: str) -> List[Chunk]:
+        """Returns a list of Chunk objects without vectors, to be
+        embedded later with embed_chunks.
+        """
+        return list(self.iter_chunks(text))
+
+    def iter_chunks(self, text: str, window_chars: int = 65536) -> Iterator[Chunk]:
+        """Yield Chunk objects without vectors, tokenizing the text one
+        window of about window_chars characters at a time, so that the
+        tokens of a large text are never all in memory. Windows end at
+        a newline followed by a word character, where tokenizers do not
+        join the characters at each side in a token, so the chunks are
+        the same as if the whole text was tokenized at once.
+        """
+        window_end = re.compile(r'\n(?=\w)')
+        tokens = []
+        start = 0
+        while start < len(text):
+            boundary = window_end.search(text, start + window_chars)
+            end = boundary.end() if boundary else len(text)
+            window = re.sub(r'[ \t]+', ' ', re.sub('\n+', '\n', text[start:end]))
+            tokens += self.tokenizer.encode(window)
+
+            consumed = 0
+            for chunk_tokens, chunk_text in self.split_tokens_in_chunks(
+                    tokens, self.chunk_size, complete=end == len(text)):
+                consumed += len(chunk_tokens)
+                yield Chunk(payload=Payload(body=chunk_text))
+            tokens = tokens[consumed:]
+            start = end
+
+    def iter_embedded_chunks(self, text: str, batch_size: int = 100) -> Iterator[Chunk]:
+        """Yield embedded Chunk objects, embedding batch_size chunks at a
+        time, so that memory does not grow with the length of the text.
+        """
+        batch = []
+        for chunk in self.iter_chunks(text):
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                yield from self.embed_chunks(batch)
+                batch = []
+        yield from self.embed_chunks(batch)
+
+    def embed_chunks(self, chunks: List[Chunk]) -> List[Chunk]:
+        """Sets the vector of each chunk, embedding all of them in as
+        few requests as the embedding function allows. Chunks can come
+        from any number of segments and source units.
+        """
+        if chunks:
+            embeddings = self.get_embeddings([chunk.payload.body for chunk in chunks])
+            for chunk, embedding in zip(chunks, embeddings):
+                chunk.vector = embedding
+        return chunks
 
     def get_embedded_chunks(self,
                             text: str,
@@ -138,14 +399,72 @@ class OAIEmbedder(Embedder):
                  encoding: str = 'cl100k_base',
                  max_sequence_length: int = 8191,
                  dimensions: int = 1536,
+                 max_in_flight_requests: int = 4,
+                 max_batch_size: int = 2048,
+                 max_batch_tokens: int = 100000,
+                 requests_per_minute: int = 3000,
+                 tokens_per_minute: int = 1000000,
                  **_):
         oai.ensure_api(awd.getenv('OPENAI_API_KEY'))
+        tokenizer = oai.get_tokenizer(encoding)
+
+        # The rate limiter is shared by all the calls from this
+        # embedder, so that concurrent requests respect the limits.
+        rate_limiter = oai.RateLimiter(requests_per_minute=requests_per_minute,
+                                       tokens_per_minute=tokens_per_minute)
+
+        def _get_embeddings(chunked_texts, _model_name):
+            return oai.get_embeddings(chunked_texts,
+                                      _model_name,
+                                      max_in_flight=max_in_flight_requests,
+                                      rate_limiter=rate_limiter,
+                                      count_tokens=lambda text: len(tokenizer.encode(text)),
+                                      max_batch_size=max_batch_size,
+                                      max_batch_tokens=max_batch_tokens)
+
+        super().__init__(tokenizer=tokenizer,
+                         embedding_fn=_get_embeddings,
+                         chunk_size=embedding_chunk_size,
+                         model_name=model_name,
+                         max_sequence_length=max_sequence_length,
+                         dimensions=dimensions,
+                         embedding_cache=awd.get_embedding_cache(),
+                         query_cache=awd.get_query_embedding_cache())
+
+
+class HashEmbedder(Embedder):
+    """Embeds texts offline into pseudo-random unit vectors seeded by
+    a hash of the text, so that the same text always gets the same
+    vector. It chunks like OAIEmbedder, with a tiktoken encoding, and
+    can sleep latency seconds per request plus latency_per_text
+    seconds per text, to profile ingestion and retrieval without a
+    network or a model.
+    """
+
+    def __init__(self,
+                 awd,
+                 embedding_chunk_size: int,
+                 model_name: str = 'hash',
+                 encoding: str = 'cl100k_base',
+                 max_sequence_length: int = 8191,
+                 dimensions: int = 1536,
+                 latency: float = 0.0,
+                 latency_per_text: float = 0.0,
+                 **_):
+
+        def _get_embeddings(chunked_texts, _model_name):
+            if latency or latency_per_text:
+                time.sleep(latency + latency_per_text * len(chunked_texts))
+            return np.stack([hash_vector(text, dimensions) for text in chunked_texts])
+
         super().__init__(tokenizer=oai.get_tokenizer(encoding),
-                         embedding_fn=oai.get_embeddings,
+                         embedding_fn=_get_embeddings,
                          chunk_size=embedding_chunk_size,
                          model_name=model_name,
                          max_sequence_length=max_sequence_length,
-                         dimensions=dimensions)
+                         dimensions=dimensions,
+                         embedding_cache=awd.get_embedding_cache(),
+                         query_cache=awd.get_query_embedding_cache())
 
 
 class HuggingFaceEmbedder(Embedder):
@@ -156,10 +475,27 @@ class HuggingFaceEmbedder(Embedder):
                  model_name: str = 'multi-qa-mpnet-base-dot-v1',
                  max_sequence_length: int = 512,
                  dimensions: int = 768,
+                 tokenizer_name: str = None,
+                 batch_size: int = 32,
+                 sort_by_length: bool = True,
+                 processes: int = 0,
+                 multi_process_min_texts: int = 256,
                  **_):
-
-        # Imported here because it is a rather expensive import
-        from sentence_transformers import SentenceTransformer
+        """The dimensions and the maximum sequence length come from the
+        configuration. The tokenizer is loaded the first time it is
+        used, and the model weights the first time something is
+        embedded, or when calling warmup.
+
+        Batches of at least multi_process_min_texts texts are encoded
+        by a pool of processes (one per core if processes is 0), each
+        with its own copy of the model. With sort_by_length the texts
+        are sorted by length before being split between the processes,
+        so that each batch has texts of similar length and little
+        padding.
+        """
+        self.tokenizer_name = tokenizer_name or sentence_transformers_path(model_name)
+        self._model = None
+        self._model_lock = threading.Lock()
 
         # The HuggingFace tokenizer
         # https://huggingface.co/transformers/v4.4.2/_modules/transformers/models/mpnet/tokenization_mpnet_fast.html
@@ -168,8 +504,15 @@ class HuggingFaceEmbedder(Embedder):
 
         class _Tokenizer:
 
-            def __init__(self, tokenizer):
-                self.tokenizer = tokenizer
+            def __init__(self, load_tokenizer):
+                self.load_tokenizer = load_tokenizer
+                self._tokenizer = None
+
+            @property
+            def tokenizer(self):
+                if self._tokenizer is None:
+                    self._tokenizer = self.load_tokenizer()
+                return self._tokenizer
 
             def encode(self, txt):
                 return self.tokenizer.encode(txt)[1:-1]
@@ -177,15 +520,99 @@ class HuggingFaceEmbedder(Embedder):
             def decode(self, token_array):
                 return self.tokenizer.decode(token_array)
 
-        model = SentenceTransformer(model_name)
+        processes = processes or os.cpu_count() or 1
+        sort_by_length = T.as_bool(sort_by_length)
+        pool = {}
+        pool_lock = threading.Lock()
+
+        def _encode_in_pool(chunked_texts):
+            model = self.get_model()
+            with pool_lock:
+                if 'pool' not in pool:
+                    pool['pool'] = model.start_multi_process_pool(
+                        target_devices=['cpu'] * processes)
+                    atexit.register(model.stop_multi_process_pool, pool['pool'])
+
+            order = (np.argsort([-len(text) for text in chunked_texts], kind='stable')
+                     if sort_by_length else np.arange(len(chunked_texts)))
+            # Several chunks per process, so that the processes that
+            # get the longest texts do not hold back the rest.
+            chunk_size = max(batch_size, math.ceil(len(chunked_texts) / (4 * processes)))
+            sorted_embeddings = model.encode_multi_process([chunked_texts[k] for k in order],
+                                                           pool['pool'],
+                                                           batch_size=batch_size,
+                                                           chunk_size=chunk_size)
+            embeddings = np.empty_like(sorted_embeddings)
+            embeddings[order] = sorted_embeddings
+            return embeddings
 
         # It is called with model_name as the second argument
         def _get_embeddings(chunked_texts, _):
-            return model.encode(chunked_texts).tolist()
+            chunked_texts = list(chunked_texts)
+            if processes > 1 and len(chunked_texts) >= multi_process_min_texts:
+                return _encode_in_pool(chunked_texts)
+            # SentenceTransformer.encode sorts each call by length.
+            return self.get_model().encode(chunked_texts, batch_size=batch_size)
 
-        super().__init__(tokenizer=_Tokenizer(model.tokenizer),
+        super().__init__(tokenizer=_Tokenizer(self.load_tokenizer),
                          embedding_fn=_get_embeddings,
                          chunk_size=embedding_chunk_size,
                          model_name=model_name,
                          max_sequence_length=max_sequence_length,
-                         dimensions=dimensions)
+                         dimensions=dimensions,
+                         embedding_cache=awd.get_embedding_cache(),
+                         query_cache=awd.get_query_embedding_cache())
+
+    def load_tokenizer(self):
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(self.tokenizer_name)
+
+    def load_model(self, model_name: str):
+        # Imported here because it is a rather expensive import
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(model_name)
+
+    def get_model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self.logger.info('Loading model %s', self.model_name)
+                    self._model = self.load_model(self.model_name)
+        return self._model
+
+    def warmup(self):
+        self.tokenizer.encode('warmup')
+        self.get_model()
+
+
+class QuantizedHuggingFaceEmbedder(HuggingFaceEmbedder):
+    """Runs a sentence transformer on the CPU with the weights of its
+    linear layers quantized to int8. base_model_name is the sentence
+    transformer, model_name names the quantized model, so that its
+    embeddings are cached apart from the full precision ones.
+    """
+
+    def __init__(self,
+                 awd,
+                 embedding_chunk_size: int,
+                 model_name: str = 'multi-qa-mpnet-base-dot-v1-int8',
+                 base_model_name: str = None,
+                 **config):
+        self.base_model_name = base_model_name or model_name
+        # Quantized inference already uses all the cores in one
+        # process, and quantized modules cannot be shared with a pool.
+        config.setdefault('processes', 1)
+        config.setdefault('tokenizer_name', sentence_transformers_path(self.base_model_name))
+        super().__init__(awd,
+                         embedding_chunk_size=embedding_chunk_size,
+                         model_name=model_name,
+                         **config)
+
+    def load_model(self, model_name: str):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(self.base_model_name, device='cpu')
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
@@ -104,32 +104,37 @@ class Persona(ABC):
         store = self.awd.get_vector_store()
 
         chunks_for_last_query = self.chunks_per_conversation - self.chunks_for_history
-        historical_background = []
+        filter_args = {'sources': sources,
+                       'source_unit_ids': source_unit_ids,
+                       'categories': categories,
+                       'scopes': self.scopes,
+                       'contexts': contexts,
+                       'languages': languages}
+
+        # The history and the query are embedded together, and
+        # searched for together. The history is hardly ever the same
+        # twice, so it is kept out of the query cache.
+        queries = [{'limit': chunks_for_last_query, **filter_args}]
+        history = []
         if message_history:
             self.awd.logger.info('Requesting historical background with %d chunks',
                                  self.chunks_for_history)
-            historical_background = store.search(
-                query_vector=embedder.get_embeddings([' '.join([msg['content']
-                                                               for msg in message_history])])[0],
-                limit=self.chunks_for_history,
-                sources=sources,
-                source_unit_ids=source_unit_ids,
-                categories=categories,
-                scopes=self.scopes,
-                contexts=contexts,
-                languages=languages)
+            queries.append({'limit': self.chunks_for_history, **filter_args})
+            history.append(' '.join([msg['content'] for msg in message_history]))
 
         self.awd.logger.info('Requesting current query background with %d chunks',
                              chunks_for_last_query)
-        user_query_background = store.search(
-            query_vector=embedder.get_embeddings([user_query])[0],
-            limit=chunks_for_last_query,
-            sources=sources,
-            source_unit_ids=source_unit_ids,
-            categories=categories,
-            scopes=self.scopes,
-            contexts=contexts,
-            languages=languages)
+        query_vectors = embedder.get_query_embeddings([user_query], uncached=history)
+        for query, query_vector in zip(queries, query_vectors):
+            query['query_vector'] = query_vector
+
+        backgrounds = store.search_batch(queries)
+        user_query_background = backgrounds[0]
+        historical_background = backgrounds[1] if message_history else []
+        if embedder.query_cache is not None:
+            self.awd.logger.debug('Query embedding cache: %s', embedder.query_cache.stats())
+        if getattr(store, 'search_cache', None) is not None:
+            self.awd.logger.debug('Search result cache: %s', store.search_cache.stats())
 
         background = (self.format_background(historical_background) +
                       self.format_background(user_query_background))
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 import datetime
+import threading
 import urllib
 import urllib.request
-from typing import Dict, List, Union
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
 
 from dateutil.parser import parse as dateutil_parse
 
@@ -16,7 +19,12 @@ def timestamp_as_utc(timestamp: Union[datetime.datetime, str] = None) -> datetim
                              "format or a datetime object.")
 
         if isinstance(timestamp, str):
-            timestamp = dateutil_parse(timestamp)
+            # Most timestamps come in ISO format, which is much faster
+            # to parse than guessing the format.
+            try:
+                timestamp = datetime.datetime.fromisoformat(timestamp)
+            except ValueError:
+                timestamp = dateutil_parse(timestamp)
 
         if timestamp.tzinfo is None or timestamp.tzinfo.utcoffset(timestamp) is None:
             timestamp = timestamp.replace(
@@ -26,6 +34,62 @@ def timestamp_as_utc(timestamp: Union[datetime.datetime, str] = None) -> datetim
     return datetime.datetime.now(datetime.timezone.utc)
 
 
+def as_bool(value: Union[bool, str, int, None]) -> bool:
+    """Configuration values come as strings, like 'true' or 'false'."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', '1')
+    return bool(value)
+
+
+class TTLCache:
+    """In-process LRU cache whose entries expire ttl seconds after
+    being added. It is thread safe, and counts hits and misses.
+    """
+
+    def __init__(self,
+                 max_size: int = 1024,
+                 ttl: float = 3600,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, is_valid: Callable[[Any], bool] = None) -> Optional[Any]:
+        """The value of key, unless it expired or is_valid says it is
+        not valid anymore, in which case it is removed.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and entry[0] > self.clock()
+                    and (is_valid is None or is_valid(entry[1]))):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'size': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / requests if requests else 0.0}
+
+
 def validate_uri(uri, raise_if_invalid=True):
     if uri:
         # Make sure URI is valid
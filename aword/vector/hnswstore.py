@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""An approximate vector store in the process, for namespaces too
+large to scan.
+
+It is a NumpyStore, so it keeps the vectors, the payloads and the
+filter masks the same way, plus an HNSW graph of the rows built with
+hnswlib and saved next to them. Filters that leave few points are
+searched exactly, the rest through the graph.
+"""
+
+import os
+from typing import List, Dict
+
+import numpy as np
+
+from aword.chunk import Payload
+from aword.vector.numpystore import NumpyStore
+
+
+class HnswStore(NumpyStore):
+
+    def __init__(self,
+                 awd,
+                 vector_namespace: str,
+                 hnsw_m: int = 16,
+                 hnsw_ef_construct: int = 200,
+                 hnsw_ef: int = 64,
+                 exact_search_max_points: int = 20000,
+                 flush_min_points: int = 10000,
+                 **config):
+        """hnsw_m and hnsw_ef_construct are the number of neighbours of
+        each node and the breadth of the search when inserting, hnsw_ef
+        the breadth of the search when querying, at least the limit. A
+        search whose filter matches at most exact_search_max_points
+        points scans them instead.
+
+        Saving the graph takes time proportional to its size, so by
+        default it is saved every flush_min_points changed points.
+        """
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construct = hnsw_ef_construct
+        self.hnsw_ef = hnsw_ef
+        self.exact_search_max_points = exact_search_max_points
+        self.index = None
+        super().__init__(awd,
+                         vector_namespace=vector_namespace,
+                         flush_min_points=flush_min_points,
+                         **config)
+
+    def _index_path(self) -> str:
+        return os.path.join(self.directory, 'hnsw.bin')
+
+    def _new_index(self, capacity: int, index_path: str = None):
+        # Imported here because it is an optional dependency
+        import hnswlib
+
+        # Cosine vectors are stored normalized, so inner product
+        # gives the same order.
+        index = hnswlib.Index(space='l2' if self.distance == 'euclid' else 'ip',
+                              dim=self.dimensions)
+        if index_path:
+            index.load_index(index_path, max_elements=capacity)
+        else:
+            index.init_index(max_elements=max(capacity, 1),
+                             M=self.hnsw_m,
+                             ef_construction=self.hnsw_ef_construct)
+        return index
+
+    def _reset(self, dimensions: int, capacity: int):
+        super()._reset(dimensions, capacity)
+        self.index = self._new_index(capacity)
+
+    def _load(self):
+        super()._load()
+        if os.path.exists(self._index_path()):
+            self.index = self._new_index(len(self.alive), self._index_path())
+        else:
+            self.logger.info('Building the graph of namespace %s', self.collection_name)
+            self._added(list(self.rows.values()))
+
+    def _grow(self):
+        super()._grow()
+        self.index.resize_index(len(self.alive))
+
+    def _added(self, rows: List[int]):
+        if rows:
+            self.index.add_items(self.vectors[rows], rows)
+
+    def _removed(self, rows: List[int]):
+        for row in rows:
+            self.index.mark_deleted(row)
+
+    def flush(self):
+        if not self.directory:
+            return
+        with self._lock:
+            self.index.save_index(self._index_path() + '.tmp')
+            os.replace(self._index_path() + '.tmp', self._index_path())
+            super().flush()
+
+    def search_batch(self, queries: List[Dict]) -> List[List[Payload]]:
+        self.logger.info('Searching %s with a batch of %d queries',
+                         self.collection_name,
+                         len(queries))
+        with self._lock:
+            out = [None] * len(queries)
+            exact = []
+            for k, query in enumerate(queries):
+                mask = self.create_query_mask(query)
+                n_matches = int(mask.sum())
+                if n_matches <= self.exact_search_max_points:
+                    exact.append((k, mask))
+                    continue
+                rows = self._approximate_search(query, mask, n_matches)
+                if rows is None:
+                    exact.append((k, mask))
+                else:
+                    out[k] = [Payload(**self.payloads[row]) for row in rows]
+
+            exact_out = self._exact_search_batch([queries[k] for k, _ in exact],
+                                                 [mask for _, mask in exact])
+            for (k, _), payloads in zip(exact, exact_out):
+                out[k] = payloads
+            return out
+
+    def _approximate_search(self, query: Dict, mask: np.ndarray, n_matches: int):
+        """Returns the rows found through the graph, or None if it
+        could not find enough, which can happen with restrictive
+        filters.
+        """
+        limit = min(query['limit'], n_matches)
+        if not limit:
+            return []
+        self.index.set_ef(max(self.hnsw_ef, limit))
+        # Deleted rows are never returned, so only real filters need
+        # a callback.
+        row_filter = None if n_matches == len(self.rows) else (lambda row: bool(mask[row]))
+        try:
+            rows, _ = self.index.knn_query(self._as_stored(query['query_vector']),
+                                           k=limit,
+                                           filter=row_filter)
+        except RuntimeError:
+            self.logger.info('Not enough points found in the graph, searching exactly')
+            return None
+        return rows[0].tolist()
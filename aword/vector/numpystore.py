@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""An exact vector store in the process, for small namespaces and
+tests.
+
+The vectors are the rows of a float32 matrix, memory mapped from a file
+when there is a data_dir, and searched with matrix products. The
+payloads are kept in a list with a row per point, and each value of a
+filterable field has a boolean mask over the rows, so that filters are
+a few vectorized ors and ands.
+"""
+
+import os
+import json
+import atexit
+import shutil
+import threading
+from typing import List, Dict, Union, Iterator, Optional
+
+import numpy as np
+
+import aword.tools as T
+
+from aword.chunk import Chunk, Payload
+from aword.vector.store import Store, FILTER_FIELDS
+
+
+class NumpyStore(Store):
+
+    def __init__(self,
+                 awd,
+                 vector_namespace: str,
+                 data_dir: str = None,
+                 distance: str = 'cosine',
+                 initial_capacity: int = 1024,
+                 bootstrap_from_cache: bool = True,
+                 flush_min_points: int = 10000,
+                 model_name: str = None,
+                 **_):
+        """Without a data_dir the namespace lives only in memory. A
+        namespace that does not exist yet is created and, with
+        bootstrap_from_cache, loaded with the chunks and vectors in the
+        chunk cache, so that nothing needs to be embedded. Chunks
+        embedded with a model other than model_name, the configured
+        one, or with other dimensions, are left out.
+
+        Saving rewrites all the payloads, so writes that wait are saved
+        to the data_dir once at least flush_min_points points have
+        changed since the last time. The rest is saved by flush, which
+        embed_and_store calls at the end, and when the process exits.
+        """
+        super().__init__(awd)
+        self.collection_name = vector_namespace
+        self.distance = distance
+        self.initial_capacity = initial_capacity
+        self.flush_min_points = flush_min_points
+        self.directory = os.path.join(data_dir, vector_namespace) if data_dir else None
+        self._lock = threading.RLock()
+        self._unflushed = 0
+        if self.directory:
+            atexit.register(self._flush_changes)
+
+        if self.directory and os.path.exists(self._points_path()):
+            self._load()
+        else:
+            self.logger.warning('Namespace %s does not exist, creating it', self.collection_name)
+            self.create_namespace(dimensions=awd.get_embedding_dimensions())
+            if T.as_bool(bootstrap_from_cache):
+                self.bootstrap(awd.get_chunk_cache(), model_name)
+
+    def _points_path(self) -> str:
+        return os.path.join(self.directory, 'points.json')
+
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, 'vectors.f32')
+
+    def _open_vectors(self, capacity: int) -> np.ndarray:
+        if not self.directory or not capacity:
+            return np.zeros((capacity, self.dimensions), dtype=np.float32)
+
+        with open(self._vectors_path(), 'ab') as fout:
+            fout.truncate(capacity * self.dimensions * 4)
+        return np.memmap(self._vectors_path(),
+                         dtype=np.float32,
+                         mode='r+',
+                         shape=(capacity, self.dimensions))
+
+    def _reset(self, dimensions: int, capacity: int):
+        self.dimensions = dimensions
+        self.vectors = self._open_vectors(capacity)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.masks = {field: {} for field in FILTER_FIELDS.values()}
+        self.ids = []
+        self.payloads = []
+        self.rows = {}
+        self.free_rows = []
+        self._unflushed = 0
+
+    def _load(self):
+        with open(self._points_path(), encoding='utf-8') as fin:
+            points = json.load(fin)
+        self.distance = points['distance']
+        capacity = max(self.initial_capacity, len(points['ids']))
+        self._reset(points['dimensions'], capacity)
+
+        self.ids = points['ids']
+        self.payloads = points['payloads']
+        for row, (vector_db_id, payload) in enumerate(zip(self.ids, self.payloads)):
+            if vector_db_id is None:
+                self.free_rows.append(row)
+            else:
+                self.rows[vector_db_id] = row
+                self._index(row, payload)
+        self.logger.info('Loaded %d points of namespace %s', len(self.rows), self.collection_name)
+
+    def flush(self):
+        """Write the vectors and the payloads to the data_dir, if there
+        is one.
+        """
+        if not self.directory:
+            return
+        with self._lock:
+            # The payloads replace the old ones at once, before the
+            # vectors, which are written in place.
+            points_path = self._points_path()
+            with open(points_path + '.tmp', 'w', encoding='utf-8') as fout:
+                json.dump({'dimensions': self.dimensions,
+                           'distance': self.distance,
+                           'ids': self.ids,
+                           'payloads': self.payloads}, fout)
+            os.replace(points_path + '.tmp', points_path)
+            self.vectors.flush()
+            self._unflushed = 0
+
+    def _flush_changes(self):
+        if self._unflushed:
+            self.flush()
+
+    def _changed(self, n_points: int, wait: bool):
+        self._unflushed += n_points
+        if wait and self._unflushed >= self.flush_min_points:
+            self.flush()
+
+    def create_namespace(self, dimensions: int):
+        with self._lock:
+            if self.directory:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                os.makedirs(self.directory)
+            self._reset(dimensions, self.initial_capacity)
+            self.flush()
+        self.logger.info('Created namespace %s', self.collection_name)
+
+    def delete_namespace(self):
+        self.logger.warning('Deleting namespace %s', self.collection_name)
+        with self._lock:
+            if self.directory:
+                shutil.rmtree(self.directory, ignore_errors=True)
+            self._reset(self.dimensions, 0)
+
+    def _grow(self):
+        capacity = max(self.initial_capacity, 2 * len(self.alive))
+        if self.directory:
+            self.vectors.flush()
+            self.vectors = self._open_vectors(capacity)
+        else:
+            vectors = self._open_vectors(capacity)
+            vectors[:len(self.vectors)] = self.vectors
+            self.vectors = vectors
+
+        def _extend(mask):
+            return np.concatenate([mask, np.zeros(capacity - len(mask), dtype=bool)])
+
+        self.alive = _extend(self.alive)
+        self.masks = {field: {value: _extend(mask) for value, mask in masks.items()}
+                      for field, masks in self.masks.items()}
+
+    def _index(self, row: int, payload: Dict, indexed: bool = True):
+        self.alive[row] = indexed
+        for field, masks in self.masks.items():
+            values = payload.get(field)
+            for value in (values if isinstance(values, list) else [values]):
+                if value not in masks:
+                    masks[value] = np.zeros(len(self.alive), dtype=bool)
+                masks[value][row] = indexed
+
+    def _as_stored(self, vector: np.ndarray) -> np.ndarray:
+        # Like qdrant, cosine similarity normalizes the vectors when
+        # they are stored, so that it becomes a dot product.
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.distance == 'cosine':
+            norm = np.linalg.norm(vector, axis=-1, keepdims=True)
+            return vector / np.where(norm > 0, norm, 1)
+        return vector
+
+    def upsert_chunks(self, chunks: List[Chunk], wait: bool = True) -> List[Chunk]:
+        """With wait False the points are searchable when it returns,
+        but they are not written to the data_dir until a call with wait
+        True finds flush_min_points changed points, or until flush.
+        """
+        out = []
+        with self._lock:
+            rows = []
+            for chunk in chunks:
+                rows.append(self._put(chunk))
+                out_chunk = chunk.copy()
+                out_chunk.vector_db_id = self.ids[rows[-1]]
+                out.append(out_chunk)
+            self._added(rows)
+            self._changed(len(rows), wait)
+
+        self.logger.info('Upserted %s points to %s', len(out), self.collection_name)
+        return out
+
+    def _added(self, rows: List[int]):
+        """Called with the rows that have been added or updated.
+        Subclasses with an index of the vectors update it here.
+        """
+
+    def _removed(self, rows: List[int]):
+        """Called with the rows that have been deleted."""
+
+    def _put(self, chunk: Chunk) -> int:
+        vector_db_id = self.get_point_id(chunk)
+        row = self.rows.get(vector_db_id)
+        if row is not None:
+            self._index(row, self.payloads[row], indexed=False)
+        elif self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            row = len(self.ids)
+            if row >= len(self.alive):
+                self._grow()
+            self.ids.append(None)
+            self.payloads.append(None)
+
+        self.vectors[row] = self._as_stored(chunk.vector)
+        self.ids[row] = vector_db_id
+        self.payloads[row] = dict(chunk.payload)
+        self.rows[vector_db_id] = row
+        self._index(row, self.payloads[row])
+        return row
+
+    def load_chunks(self, chunks: List[Chunk]) -> int:
+        """Upsert chunks that already have vectors, like the ones in the
+        chunk cache, without copying them. They are saved by flush.
+        """
+        with self._lock:
+            rows = [self._put(chunk) for chunk in chunks
+                    if chunk.vector is not None and len(chunk.vector) == self.dimensions]
+            self._added(rows)
+            self._unflushed += len(rows)
+        return len(rows)
+
+    def bootstrap(self, chunk_cache, model_name: str = None, batch_size: int = 10000):
+        """Load the chunks in chunk_cache embedded with model_name, a
+        batch at a time.
+        """
+        n_chunks = 0
+        for _, chunks in chunk_cache.iter_batches(batch_size, model_name=model_name):
+            n_chunks += self.load_chunks(chunks)
+        self.flush()
+        self.logger.info('Loaded %d chunks to %s', n_chunks, self.collection_name)
+
+    def delete_points(self, vector_db_ids: List[str], wait: bool = True):
+        with self._lock:
+            rows = []
+            for vector_db_id in vector_db_ids:
+                row = self.rows.pop(vector_db_id, None)
+                if row is None:
+                    continue
+                self._index(row, self.payloads[row], indexed=False)
+                self.ids[row] = None
+                self.payloads[row] = None
+                self.free_rows.append(row)
+                rows.append(row)
+            self._removed(rows)
+            self._changed(len(rows), wait)
+
+    def clean_source_unit(self, source_unit_id: str, wait: bool = True):
+        with self._lock:
+            rows = np.flatnonzero(self.create_mask(source_unit_ids=source_unit_id))
+            self.delete_points([self.ids[row] for row in rows], wait=wait)
+
+    def create_mask(self,
+                    sources: Union[List[str], str] = None,
+                    source_unit_ids: Union[List[str], str] = None,
+                    categories: Union[List[str], str] = None,
+                    scopes: Union[List[str], str] = None,
+                    contexts: Union[List[str], str] = None,
+                    languages: Union[List[str], str] = None) -> np.ndarray:
+        """A boolean mask over the rows in use with the points that
+        match the filter, with the semantics of QdrantStore.create_filter.
+        """
+        where = {'sources': sources,
+                 'source_unit_ids': source_unit_ids,
+                 'categories': categories,
+                 'scopes': scopes,
+                 'contexts': contexts,
+                 'languages': languages}
+        n_rows = len(self.ids)
+        mask = self.alive[:n_rows].copy()
+        for argument, values in where.items():
+            if not values:
+                continue
+            masks = self.masks[FILTER_FIELDS[argument]]
+            matches = np.zeros(n_rows, dtype=bool)
+            for value in (values if isinstance(values, list) else [values]):
+                if value in masks:
+                    matches |= masks[value][:n_rows]
+            mask &= matches
+        return mask
+
+    def _top_payloads(self, scores: np.ndarray, rows: np.ndarray, limit: int) -> List[Payload]:
+        if limit < len(rows):
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            rows, scores = rows[top], scores[top]
+        return [Payload(**self.payloads[row]) for row in rows[np.argsort(-scores, kind='stable')]]
+
+    def _scores(self, vectors: np.ndarray, query_vectors: np.ndarray) -> np.ndarray:
+        if self.distance == 'euclid':
+            # The same order as minus the squared distance, without
+            # the squared norm of the query, which does not change it.
+            return 2 * vectors @ query_vectors.T - np.einsum('ij,ij->i', vectors, vectors)[:, None]
+        return vectors @ query_vectors.T
+
+    def search(self,
+               query_vector: np.ndarray,
+               limit: int,
+               sources: Union[List[str], str] = None,
+               source_unit_ids: Union[List[str], str] = None,
+               categories: Union[List[str], str] = None,
+               scopes: Union[List[str], str] = None,
+               contexts: Union[List[str], str] = None,
+               languages: Union[List[str], str] = None) -> List[Payload]:
+        return self.search_batch([{'query_vector': query_vector,
+                                   'limit': limit,
+                                   'sources': sources,
+                                   'source_unit_ids': source_unit_ids,
+                                   'categories': categories,
+                                   'scopes': scopes,
+                                   'contexts': contexts,
+                                   'languages': languages}])[0]
+
+    def search_batch(self, queries: List[Dict]) -> List[List[Payload]]:
+        """Scores the rows that match the filter of any query against
+        all the queries with a single matrix product.
+        """
+        self.logger.info('Searching %s with a batch of %d queries',
+                         self.collection_name,
+                         len(queries))
+        with self._lock:
+            return self._exact_search_batch(queries, [self.create_query_mask(query)
+                                                      for query in queries])
+
+    def create_query_mask(self, query: Dict) -> np.ndarray:
+        return self.create_mask(**{argument: query.get(argument) for argument in FILTER_FIELDS})
+
+    def _exact_search_batch(self,
+                            queries: List[Dict],
+                            masks: List[np.ndarray]) -> List[List[Payload]]:
+        if not queries:
+            return []
+        rows = np.flatnonzero(np.logical_or.reduce(masks))
+        query_vectors = self._as_stored(np.stack([query['query_vector'] for query in queries]))
+        if 2 * len(rows) > len(self.ids):
+            # Copying most of the rows would cost more than
+            # scoring the rows that no query needs.
+            scores = self._scores(self.vectors[:len(self.ids)], query_vectors)[rows]
+        else:
+            scores = self._scores(self.vectors[rows], query_vectors)
+
+        out = []
+        for k, (query, mask) in enumerate(zip(queries, masks)):
+            selected = mask[rows]
+            out.append(self._top_payloads(scores[selected, k], rows[selected], query['limit']))
+        return out
+
+    def count(self,
+              sources: Union[List[str], str] = None,
+              source_unit_ids: Union[List[str], str] = None,
+              categories: Union[List[str], str] = None,
+              scopes: Union[List[str], str] = None,
+              contexts: Union[List[str], str] = None,
+              languages: Union[List[str], str] = None) -> int:
+        with self._lock:
+            return int(self.create_mask(sources=sources,
+                                        source_unit_ids=source_unit_ids,
+                                        categories=categories,
+                                        scopes=scopes,
+                                        contexts=contexts,
+                                        languages=languages).sum())
+
+    def _point(self,
+               row: int,
+               payload_fields: Optional[List[str]] = None,
+               with_vectors: bool = False) -> Dict:
+        payload = self.payloads[row]
+        if payload_fields:
+            payload = {field: payload[field] for field in payload_fields if field in payload}
+        out = {'id': self.ids[row], 'payload': payload}
+        if with_vectors:
+            out['vector'] = np.array(self.vectors[row])
+        return out
+
+    def retrieve(self,
+                 chunk_ids: List[str],
+                 with_payload: bool = True,
+                 with_vectors: bool = False) -> List[Dict]:
+        with self._lock:
+            out = [self._point(self.rows[chunk_id], with_vectors=with_vectors)
+                   for chunk_id in chunk_ids if chunk_id in self.rows]
+        if not with_payload:
+            for point in out:
+                point['payload'] = None
+        return out
+
+    def iter_points(self,
+                    sources: Union[List[str], str] = None,
+                    source_unit_ids: Union[List[str], str] = None,
+                    categories: Union[List[str], str] = None,
+                    scopes: Union[List[str], str] = None,
+                    contexts: Union[List[str], str] = None,
+                    languages: Union[List[str], str] = None,
+                    payload_fields: List[str] = None,
+                    with_vectors: bool = False,
+                    per_page: int = 1000) -> Iterator[Dict]:
+        """Yield the points that match the filter when it is called,
+        taking the lock per_page points at a time.
+        """
+        with self._lock:
+            rows = np.flatnonzero(self.create_mask(sources=sources,
+                                                   source_unit_ids=source_unit_ids,
+                                                   categories=categories,
+                                                   scopes=scopes,
+                                                   contexts=contexts,
+                                                   languages=languages))
+        for start in range(0, len(rows), per_page):
+            with self._lock:
+                page = [self._point(row, payload_fields, with_vectors)
+                        for row in rows[start:start + per_page]
+                        if self.ids[row] is not None]
+            yield from page
@@ -2,19 +2,50 @@
 """Query the vector store.
 """
 
+import copy
+import time
 import uuid
-from typing import List, Dict, Union
+import hashlib
+import itertools
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Union, Iterator, Optional, Any, Tuple
 from pprint import pformat, pprint
 from abc import ABC, abstractmethod
 
+import numpy as np
+from pytz import utc
 from qdrant_client import models
 from qdrant_client import QdrantClient
 from qdrant_client.http.models import Filter, FieldCondition, MatchValue, PointStruct
 
+import aword.tools as T
 from aword.model.embedder import Embedder
 from aword.chunk import Chunk, Payload
 from aword.segment import Segment
 
+# Filter arguments, and the payload field that each filters
+FILTER_FIELDS = {'sources': 'source',
+                 'source_unit_ids': 'source_unit_id',
+                 'categories': 'categories',
+                 'scopes': 'scope',
+                 'contexts': 'context',
+                 'languages': 'language'}
+
+# Payload fields that change when a source unit is chunked again even if
+# it is the same, like the timestamp of segments without one, which is
+# the time they are chunked.
+VOLATILE_FIELDS = ('last_edited_timestamp',)
+
+
+def same_payload(payload: Payload, other: Optional[Payload]) -> bool:
+    """Whether the payloads are equal but for the VOLATILE_FIELDS."""
+    if other is None:
+        return False
+    return ({field: value for field, value in payload.items() if field not in VOLATILE_FIELDS}
+            == {field: value for field, value in other.items() if field not in VOLATILE_FIELDS})
+
 
 def make_vector_store(awd,
                       vector_namespace: str,
@@ -27,6 +58,16 @@ def make_vector_store(awd,
         # vector_namespace can come in the config, overriding it if so.
         return QdrantStore(awd, **{**config, **{'vector_namespace': vector_namespace}})
 
+    if provider == 'numpy':
+        from aword.vector.numpystore import NumpyStore
+
+        return NumpyStore(awd, **{**config, **{'vector_namespace': vector_namespace}})
+
+    if provider == 'hnsw':
+        from aword.vector.hnswstore import HnswStore
+
+        return HnswStore(awd, **{**config, **{'vector_namespace': vector_namespace}})
+
     raise ValueError(f'Unknown vector store provider {provider}')
 
 
@@ -34,6 +75,59 @@ def make_id(source_unit_id, text):
     return str(uuid.uuid5(uuid.NAMESPACE_X500, source_unit_id + text))
 
 
+def as_point(record, with_vectors: bool = False) -> Dict:
+    """A qdrant record as a dictionary with its id, its payload, and
+    with_vectors its vector as a float32 array.
+    """
+    out = {'id': str(record.id), 'payload': record.payload}
+    if with_vectors:
+        out['vector'] = np.asarray(record.vector, dtype=np.float32)
+    return out
+
+
+def normalize_filter(query: Dict) -> Tuple:
+    """The filter arguments of a query, in a canonical form: sorted
+    fields with sorted lists of values, without the empty ones.
+    """
+    out = []
+    for arg in sorted(FILTER_FIELDS):
+        values = query.get(arg)
+        if values:
+            out.append((arg, tuple(sorted([values] if isinstance(values, str) else values))))
+    return tuple(out)
+
+
+def search_key(collection_name: str, query: Dict) -> str:
+    """A hash of the collection, the limit, the filter and the query
+    vector, rounded to float16 so that vectors that only differ in
+    the last digits share results.
+    """
+    key = hashlib.sha1(repr((collection_name,
+                             query['limit'],
+                             normalize_filter(query))).encode('utf-8'))
+    key.update(np.asarray(query['query_vector'], dtype=np.float16).tobytes())
+    return key.hexdigest()
+
+
+class SearchResultCache(T.TTLCache):
+    """Search results, keyed by search_key and stamped with the
+    generation of the namespace when they were searched. An entry of
+    an older generation is never returned, and entries expire ttl
+    seconds after being added anyway, since other processes may write
+    to the namespace too.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300, **kw):
+        super().__init__(max_size=max_size, ttl=ttl, **kw)
+
+    def get(self, key: str, generation: int) -> Optional[List[Payload]]:
+        entry = super().get(key, is_valid=lambda entry: entry[0] == generation)
+        return None if entry is None else list(entry[1])
+
+    def put(self, key: str, generation: int, payloads: List[Payload]):
+        super().put(key, (generation, list(payloads)))
+
+
 class Store(ABC):
 
     def __init__(self, awd):
@@ -41,20 +135,32 @@ class Store(ABC):
 
     @abstractmethod
     def clean_source_unit(self,
-                          source_unit_id: str):
+                          source_unit_id: str,
+                          wait: bool = True):
         """We assume that when a source unit is embedded it will replace
         any previous version of the same unit, so we first need to
         delete all the points belonging to this source_unit_id if any
-        exists.
+        exists. With wait False it may return before they are deleted,
+        and a later write that waits also waits for the delete.
+        """
+
+    @abstractmethod
+    def delete_points(self,
+                      vector_db_ids: List[str],
+                      wait: bool = True):
+        """Delete the points with these ids, if they exist.
         """
 
     @abstractmethod
     def upsert_chunks(self,
-                      chunks: List[Chunk]) -> List[Chunk]:
+                      chunks: List[Chunk],
+                      wait: bool = True) -> List[Chunk]:
         """Upsert a list of extended chunks to the vector
         database. Extended chunks are dictionaries based in Chunks,
         with an id, a source_unit_id, a source, categories, a
-        scope and a context.
+        scope and a context. With wait False it may return before the
+        chunks are searchable, the next upsert with wait True will
+        wait for them too.
         """
 
     @abstractmethod
@@ -67,30 +173,188 @@ class Store(ABC):
         """Delete a vector namespace (collection in qdrant)
         """
 
-    def store_source_unit(self,
-                          embedder: Embedder,
-                          source: str,
-                          source_unit_id: str,
-                          source_unit_uri: str,
-                          categories: str,
-                          scope: str,  # confidential, public
-                          context: str,  # historical, reference, internal_comm...
-                          language: str,
-                          segments: List[Segment]) -> List[Chunk]:
+    def flush(self):
+        """Save the writes that the store keeps in memory. Those sent
+        to a server are saved as they come.
+        """
+
+    @abstractmethod
+    def search(self,
+               query_vector: np.ndarray,
+               limit: int,
+               sources: Union[List[str], str] = None,
+               source_unit_ids: Union[List[str], str] = None,
+               categories: Union[List[str], str] = None,
+               scopes: Union[List[str], str] = None,
+               contexts: Union[List[str], str] = None,
+               languages: Union[List[str], str] = None) -> List[Payload]:
+        """Return the payloads of the limit points most similar to
+        query_vector among those that match the filter. If more than
+        one value comes for a field, any of the values should match.
+        If more than one field comes all should match.
+        """
+
+    @abstractmethod
+    def count(self,
+              sources: Union[List[str], str] = None,
+              source_unit_ids: Union[List[str], str] = None,
+              categories: Union[List[str], str] = None,
+              scopes: Union[List[str], str] = None,
+              contexts: Union[List[str], str] = None,
+              languages: Union[List[str], str] = None) -> int:
+        """Count the points that match the filter.
+        """
+
+    @abstractmethod
+    def retrieve(self,
+                 chunk_ids: List[str],
+                 with_payload: bool = True,
+                 with_vectors: bool = False) -> List[Dict]:
+        """Return the points with these ids.
+        """
+
+    @abstractmethod
+    def iter_points(self,
+                    sources: Union[List[str], str] = None,
+                    source_unit_ids: Union[List[str], str] = None,
+                    categories: Union[List[str], str] = None,
+                    scopes: Union[List[str], str] = None,
+                    contexts: Union[List[str], str] = None,
+                    languages: Union[List[str], str] = None,
+                    payload_fields: List[str] = None,
+                    with_vectors: bool = False,
+                    per_page: int = 1000) -> Iterator[Dict]:
+        """Yield the points that match the filter, each as a dictionary
+        with its id, its payload, only with payload_fields if they are
+        given, and with_vectors its vector as a float32 array.
+        """
 
-        to_upsert = []
+    def fetch_all(self,
+                  sources: Union[List[str], str] = None,
+                  source_unit_ids: Union[List[str], str] = None,
+                  categories: Union[List[str], str] = None,
+                  scopes: Union[List[str], str] = None,
+                  contexts: Union[List[str], str] = None,
+                  languages: Union[List[str], str] = None,
+                  payload_fields: List[str] = None,
+                  per_page: int = 1000) -> List[Dict]:
+        """The payloads of all the points that match the filter. Use
+        iter_points to go through large collections.
+        """
+        return [point['payload']
+                for point in self.iter_points(sources=sources,
+                                              source_unit_ids=source_unit_ids,
+                                              categories=categories,
+                                              scopes=scopes,
+                                              contexts=contexts,
+                                              languages=languages,
+                                              payload_fields=payload_fields,
+                                              per_page=per_page)]
+
+    def search_batch(self, queries: List[Dict]) -> List[List[Payload]]:
+        """Run several searches, each a dictionary with the arguments
+        of search, and return the results of each. Stores that can
+        should run them in a single request.
+        """
+        return [self.search(**query) for query in queries]
+
+    def get_point_id(self, chunk: Chunk) -> str:
+        """Point ids depend only on the source unit and the text of the
+        chunk, so an unchanged chunk keeps its point when its source
+        unit is embedded again.
+        """
+        return make_id(chunk.payload.source + chunk.payload.source_unit_id,
+                       chunk.payload.body)
+
+    def filter_stored(self, stored_chunks: List[Chunk]) -> List[Chunk]:
+        """The chunks, as recorded in the chunk cache, whose points are
+        in the namespace. The chunk cache outlives namespaces, so only
+        these can be taken as stored by reuse_stored_vectors and
+        update_chunks.
+        """
+        ids = [chunk.vector_db_id for chunk in stored_chunks if chunk.vector_db_id]
+        if not ids:
+            return []
+        found = {point['id'] for point in self.retrieve(ids, with_payload=False)}
+        return [chunk for chunk in stored_chunks if chunk.vector_db_id in found]
+
+    def reuse_stored_vectors(self,
+                             chunks: List[Chunk],
+                             stored_chunks: List[Chunk]) -> List[Chunk]:
+        """Set the vector of the chunks whose point is already stored,
+        with the stored_chunks of their source unit, as recorded in the
+        chunk cache, embedded with the current model and filtered with
+        filter_stored. Returns the chunks that still need embedding.
+        """
+        stored_vectors = {chunk.vector_db_id: chunk.vector
+                          for chunk in stored_chunks
+                          if chunk.vector_db_id and chunk.vector is not None}
+        for chunk in chunks:
+            chunk.vector = stored_vectors.get(self.get_point_id(chunk))
+        return [chunk for chunk in chunks if chunk.vector is None]
+
+    def update_chunks(self,
+                      chunks: List[Chunk],
+                      stored_chunks: List[Chunk],
+                      wait: bool = True) -> List[Chunk]:
+        """Like store_chunks, but instead of replacing all the points of
+        the source unit it only upserts the chunks that are new or have
+        a different payload, but for the VOLATILE_FIELDS, and deletes
+        the stored_chunks that are gone. The unchanged chunks remain
+        searchable all along, and keep their stored payload.
+        stored_chunks should be as for reuse_stored_vectors.
+        """
+        stored_payloads = {chunk.vector_db_id: chunk.payload
+                           for chunk in stored_chunks
+                           if chunk.vector_db_id}
+        stale_ids = set(stored_payloads)
+
+        out = []
+        changed = []
+        for chunk in chunks:
+            vector_db_id = self.get_point_id(chunk)
+            stale_ids.discard(vector_db_id)
+            if same_payload(chunk.payload, stored_payloads.get(vector_db_id)):
+                out_chunk = chunk.copy()
+                out_chunk.payload = stored_payloads[vector_db_id]
+                out_chunk.vector_db_id = vector_db_id
+                out.append(out_chunk)
+            else:
+                changed.append(chunk)
+                out.append(None)
+
+        if stale_ids:
+            self.delete_points(list(stale_ids), wait=wait and not changed)
+        upserted = iter(self.upsert_chunks(changed, wait=wait))
+
+        self.logger.info('Updated source unit: %d unchanged, %d upserted, %d deleted points',
+                         len(chunks) - len(changed),
+                         len(changed),
+                         len(stale_ids))
+        return [next(upserted) if chunk is None else chunk for chunk in out]
+
+    def iter_source_unit_chunks(self,
+                                embedder: Embedder,
+                                source: str,
+                                source_unit_id: str,
+                                source_unit_uri: str,
+                                categories: str,
+                                scope: str,  # confidential, public
+                                context: str,  # historical, reference, internal_comm...
+                                language: str,
+                                segments: List[Segment]) -> Iterator[Chunk]:
+        """Yield the chunks of the segments of a source unit with their
+        payloads, but without vectors. Large segments are tokenized a
+        window at a time.
+        """
         for segment in segments:
             # TODO Maybe it should include the headings in the
             # embedding.  Maybe do the embedding separately, and then
             # average it with a weight. It will probably not work with
             # non normalized embeddings.
 
-            chunks = embedder.get_embedded_chunks(segment.body)
-            self.logger.info('Embedding (%s, %s), got %s chunks',
-                             source,
-                             source_unit_id,
-                             len(chunks))
-            for chunk in chunks:
+            n_chunks = 0
+            for chunk in embedder.iter_chunks(segment.body):
                 chunk.payload.source = source
                 chunk.payload.source_unit_id = source_unit_id
                 chunk.payload.uri = segment.uri or source_unit_uri
@@ -104,10 +368,126 @@ class Store(ABC):
                 chunk.payload.last_edited_timestamp = segment.last_edited_timestamp
                 chunk.payload.metadata = segment.metadata
 
-                to_upsert.append(chunk)
+                n_chunks += 1
+                yield chunk
 
-        self.clean_source_unit(source_unit_id)
-        return self.upsert_chunks(to_upsert)
+            self.logger.info('Chunking (%s, %s), got %s chunks',
+                             source,
+                             source_unit_id,
+                             n_chunks)
+
+    def make_source_unit_chunks(self,
+                                embedder: Embedder,
+                                **source_unit) -> List[Chunk]:
+        """Split the segments of a source unit in chunks with their
+        payloads, but without vectors. They should be embedded with
+        embedder.embed_chunks, possibly together with chunks from
+        other source units, before calling store_chunks.
+        """
+        return list(self.iter_source_unit_chunks(embedder, **source_unit))
+
+    def store_chunks(self,
+                     source_unit_id: str,
+                     chunks: List[Chunk],
+                     wait: bool = True) -> List[Chunk]:
+        """Replace the points of a source unit with its embedded chunks.
+        """
+        # Without chunks nothing else waits for the delete.
+        self.clean_source_unit(source_unit_id, wait=not chunks)
+        return self.upsert_chunks(chunks, wait=wait)
+
+    def store_source_unit(self,
+                          embedder: Embedder,
+                          source: str,
+                          source_unit_id: str,
+                          source_unit_uri: str,
+                          categories: str,
+                          scope: str,  # confidential, public
+                          context: str,  # historical, reference, internal_comm...
+                          language: str,
+                          segments: List[Segment]) -> List[Chunk]:
+
+        chunks = self.make_source_unit_chunks(embedder,
+                                              source=source,
+                                              source_unit_id=source_unit_id,
+                                              source_unit_uri=source_unit_uri,
+                                              categories=categories,
+                                              scope=scope,
+                                              context=context,
+                                              language=language,
+                                              segments=segments)
+        return self.store_chunks(source_unit_id, embedder.embed_chunks(chunks))
+
+    def store_source_unit_in_batches(self,
+                                     embedder: Embedder,
+                                     batch_size: int,
+                                     source_unit_id: str,
+                                     **source_unit) -> Iterator[List[Chunk]]:
+        """Like store_source_unit, but it embeds and upserts batch_size
+        chunks at a time, and yields each stored batch, so that memory
+        does not grow with the size of the source unit.
+        """
+        chunks = self.iter_source_unit_chunks(embedder,
+                                              source_unit_id=source_unit_id,
+                                              **source_unit)
+        first = next(chunks, None)
+        # Without chunks nothing else waits for the delete.
+        self.clean_source_unit(source_unit_id, wait=first is None)
+        if first is None:
+            return
+
+        batch = []
+        for chunk in itertools.chain([first], chunks):
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                yield self.upsert_chunks(embedder.embed_chunks(batch))
+                batch = []
+
+        if batch:
+            yield self.upsert_chunks(embedder.embed_chunks(batch))
+
+    def rebuild_from_cache(self,
+                           chunk_cache,
+                           dimensions: int,
+                           batch_size: int = 10000,
+                           restart: bool = False) -> int:
+        """Load the namespace with the chunks in the chunk cache, which
+        keeps their vectors, so that nothing is embedded again. The
+        points get the same ids they would get from store_chunks.
+
+        The namespace is created anew, unless a previous rebuild was
+        interrupted, in which case it goes on after the last batch it
+        stored, unless restart is True. Returns the number of points
+        stored.
+        """
+        checkpoint = None if restart else chunk_cache.get_rebuild_checkpoint(self.collection_name)
+        if checkpoint is None:
+            self.create_namespace(dimensions=dimensions)
+            last_rowid, n_points = 0, 0
+        else:
+            last_rowid, n_points = checkpoint['last_rowid'], checkpoint['n_points']
+            self.logger.info('Resuming the rebuild of %s after %d points',
+                             self.collection_name,
+                             n_points)
+
+        n_total = chunk_cache.count_rows()
+        start = time.perf_counter()
+        n_start = n_points
+        for last_rowid, chunks in chunk_cache.iter_batches(batch_size, after_rowid=last_rowid):
+            chunks = [chunk for chunk in chunks if chunk.vector is not None]
+            self.upsert_chunks(chunks)
+            n_points += len(chunks)
+            chunk_cache.set_rebuild_checkpoint(self.collection_name, last_rowid, n_points)
+
+            elapsed = time.perf_counter() - start
+            self.logger.info('Rebuilt %d of %d points of %s, %.0f points/s',
+                             n_points,
+                             n_total,
+                             self.collection_name,
+                             (n_points - n_start) / elapsed if elapsed else float('inf'))
+
+        chunk_cache.delete_rebuild_checkpoint(self.collection_name)
+        return n_points
 
 
 class QdrantStore(Store):
@@ -118,10 +498,81 @@ class QdrantStore(Store):
                  local_db: str = None,
                  url: str = None,
                  distance: str = 'cosine',
+                 upsert_batch_size: int = 256,
+                 upsert_workers: int = 4,
+                 slim_payloads: bool = False,
+                 quantization: str = None,
+                 quantization_always_ram: bool = True,
+                 quantization_rescore: bool = True,
+                 quantization_oversampling: float = None,
+                 on_disk: bool = None,
+                 on_disk_payload: bool = None,
+                 hnsw_m: int = None,
+                 hnsw_ef_construct: int = None,
+                 hnsw_ef: int = None,
+                 optimizer_segments: int = None,
+                 search_cache_size: int = 0,
+                 search_cache_ttl: float = 300,
                  **_):
+        """Points are upserted in batches of upsert_batch_size, sent by
+        upsert_workers threads to a remote server. The local client
+        keeps its data in a SQLite database that can only be used from
+        the thread that opened it, so it gets a single worker.
+
+        With slim_payloads the points only have the fields that can be
+        filtered, and search takes the rest of the payloads from the
+        chunk cache. Points that are not in the chunk cache are left
+        out of the results.
+
+        The rest of the parameters configure new collections, or
+        existing ones with migrate_namespace, and searches:
+
+        - quantization: scalar (int8), binary or none. The quantized
+          vectors are kept in RAM with quantization_always_ram, and
+          with quantization_rescore the best candidates are scored
+          again with the original vectors, quantization_oversampling
+          times as many as requested.
+        - on_disk and on_disk_payload keep the original vectors and
+          the payloads on disk instead of in RAM.
+        - hnsw_m and hnsw_ef_construct shape the HNSW graph, hnsw_ef
+          is the breadth of the search.
+        - optimizer_segments is the number of segments the optimizer
+          aims for.
+
+        Those that are not set keep the qdrant defaults.
+
+        The results of the last search_cache_size searches are kept for
+        search_cache_ttl seconds, or until the namespace is written to
+        from this store, which increments its generation. Writes from
+        other processes do not, so the cache is disabled by default,
+        with a search_cache_size of 0.
+        """
         super().__init__(awd)
         self.collection_name = vector_namespace
         self.distance = distance
+        self.upsert_batch_size = upsert_batch_size
+        self.upsert_workers = upsert_workers if url else 1
+        self.slim_payloads = T.as_bool(slim_payloads)
+        self.get_chunk_cache = awd.get_chunk_cache if self.slim_payloads else None
+
+        self.quantization = quantization.lower() if quantization else None
+        if self.quantization not in (None, 'none', 'scalar', 'int8', 'binary'):
+            raise ValueError(f'Unknown quantization {quantization}')
+        self.quantization_always_ram = T.as_bool(quantization_always_ram)
+        self.quantization_rescore = T.as_bool(quantization_rescore)
+        self.quantization_oversampling = quantization_oversampling
+        self.on_disk = None if on_disk is None else T.as_bool(on_disk)
+        self.on_disk_payload = None if on_disk_payload is None else T.as_bool(on_disk_payload)
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construct = hnsw_ef_construct
+        self.hnsw_ef = hnsw_ef
+        self.optimizer_segments = optimizer_segments
+
+        self.generation = 0
+        self.search_cache = None
+        if search_cache_size:
+            self.search_cache = SearchResultCache(max_size=search_cache_size,
+                                                  ttl=search_cache_ttl)
 
         if url:
             client_pars = {'url': url}
@@ -139,46 +590,261 @@ class QdrantStore(Store):
             self.client.get_collection(collection_name=self.collection_name)
         except:
             self.logger.warn('Collection %s does not exist, creating it', self.collection_name)
-            self.create_namespace(dimensions=awd.get_embedder().dimensions)
+            self.create_namespace(dimensions=awd.get_embedding_dimensions())
 
     def create_namespace(self, dimensions: int):
+        """Create the collection of the namespace, empty. A namespace
+        that is an alias gets a new collection, named like those of
+        create_shadow, and the alias is moved to it before the old one
+        is deleted.
+        """
+        aliased_collection = self.get_aliased_collection()
+        if aliased_collection is None:
+            self.generation += 1
+            self.create_collection(self.collection_name, dimensions)
+            return
+
+        collection_name = self.make_versioned_name()
+        self.create_collection(collection_name, dimensions)
+        self.client.update_collection_aliases(change_aliases_operations=[
+            models.DeleteAliasOperation(
+                delete_alias=models.DeleteAlias(alias_name=self.collection_name)),
+            models.CreateAliasOperation(
+                create_alias=models.CreateAlias(collection_name=collection_name,
+                                                alias_name=self.collection_name))])
+        self.generation += 1
+        self.client.delete_collection(aliased_collection)
+        self.logger.info('Namespace %s is now collection %s',
+                         self.collection_name,
+                         collection_name)
+
+    def create_collection(self, collection_name: str, dimensions: int):
         distance = {'dot': models.Distance.DOT,
                     'cosine': models.Distance.COSINE,
                     'euclid': models.Distance.EUCLID}[self.distance]
         self.client.recreate_collection(
-            collection_name=self.collection_name,
+            collection_name=collection_name,
             vectors_config=models.VectorParams(size=dimensions,
-                                               distance=distance))
-
-        self.client.create_payload_index(collection_name=self.collection_name,
-                                         field_name='source',
-                                         field_schema="keyword")
-
-        self.client.create_payload_index(collection_name=self.collection_name,
-                                         field_name='source_unit_id',
-                                         field_schema="keyword")
-
-        self.client.create_payload_index(collection_name=self.collection_name,
-                                         field_name='categories',
-                                         field_schema="keyword")
-
-        self.client.create_payload_index(collection_name=self.collection_name,
-                                         field_name='scope',
-                                         field_schema="keyword")
-
-        self.client.create_payload_index(collection_name=self.collection_name,
-                                         field_name='context',
-                                         field_schema="keyword")
-
-        self.client.create_payload_index(collection_name=self.collection_name,
-                                         field_name='language',
-                                         field_schema="keyword")
+                                               distance=distance,
+                                               on_disk=self.on_disk),
+            on_disk_payload=self.on_disk_payload,
+            hnsw_config=self.get_hnsw_config(),
+            optimizers_config=self.get_optimizers_config(),
+            quantization_config=self.get_quantization_config())
+        self.create_payload_indexes(collection_name)
+
+        self.logger.info('Created collection %s', collection_name)
+
+    def create_payload_indexes(self, collection_name: str = None):
+        for field_name in FILTER_FIELDS.values():
+            self.client.create_payload_index(collection_name=collection_name
+                                             or self.collection_name,
+                                             field_name=field_name,
+                                             field_schema="keyword")
+
+    @contextmanager
+    def bulk_load(self, indexing_timeout: float = 3600):
+        """Within the context the collection is not indexed: the
+        indexing threshold is 0, so qdrant does not build HNSW graphs,
+        and the payload indexes are dropped. At the end the indexing
+        threshold and the payload indexes the collection had are
+        restored, with the same types, and it waits at most
+        indexing_timeout seconds for the optimizer to index the
+        collection. It yields a dictionary with the seconds taken
+        by the load and by the indexing, filled in at the end.
+        """
+        collection = self.client.get_collection(collection_name=self.collection_name)
+        # 20000 is the default of qdrant, for collections that do not say.
+        indexing_threshold = collection.config.optimizer_config.indexing_threshold or 20000
+        self.client.update_collection(
+            collection_name=self.collection_name,
+            optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0))
+        for field_name in collection.payload_schema:
+            self.client.delete_payload_index(collection_name=self.collection_name,
+                                             field_name=field_name)
+        self.logger.info('Bulk loading collection %s', self.collection_name)
+
+        timings = {}
+        start = time.perf_counter()
+        try:
+            yield timings
+        finally:
+            timings['load'] = time.perf_counter() - start
 
-        self.logger.info('Created collection %s', self.collection_name)
+            start = time.perf_counter()
+            self.client.update_collection(
+                collection_name=self.collection_name,
+                optimizers_config=models.OptimizersConfigDiff(
+                    indexing_threshold=indexing_threshold))
+            for field_name, index in collection.payload_schema.items():
+                self.client.create_payload_index(collection_name=self.collection_name,
+                                                 field_name=field_name,
+                                                 field_schema=index.params or index.data_type)
+            self.wait_for_optimization(timeout=indexing_timeout)
+            timings['indexing'] = time.perf_counter() - start
+            self.logger.info('Bulk loaded collection %s in %.1f s, indexed in %.1f s',
+                             self.collection_name,
+                             timings['load'],
+                             timings['indexing'])
+
+    def wait_for_optimization(self, timeout: float = 3600, interval: float = 1):
+        """Wait until the collection is green, that is, until the
+        optimizer has nothing left to do.
+        """
+        deadline = time.monotonic() + timeout
+        while self.client.get_collection(
+                collection_name=self.collection_name).status != models.CollectionStatus.GREEN:
+            if time.monotonic() > deadline:
+                self.logger.warning('Collection %s still optimizing after %d s',
+                                    self.collection_name,
+                                    timeout)
+                return
+            time.sleep(interval)
 
     def delete_namespace(self):
+        """Delete the collection of the namespace. A namespace that is
+        an alias is deleted with the collection behind it.
+        """
         self.logger.warn('Deleting namespace %s', self.collection_name)
-        self.client.delete_collection(self.collection_name)
+        aliased_collection = self.get_aliased_collection()
+        self.generation += 1
+        if aliased_collection is None:
+            self.client.delete_collection(self.collection_name)
+            return
+        self.client.update_collection_aliases(change_aliases_operations=[
+            models.DeleteAliasOperation(
+                delete_alias=models.DeleteAlias(alias_name=self.collection_name))])
+        self.client.delete_collection(aliased_collection)
+
+    def get_aliased_collection(self) -> Optional[str]:
+        """The collection that the namespace is an alias of, or None if
+        it is not an alias.
+        """
+        for alias in self.client.get_aliases().aliases:
+            if alias.alias_name == self.collection_name:
+                return alias.collection_name
+        return None
+
+    def make_versioned_name(self) -> str:
+        """A new name for a collection of the namespace, which
+        collect_garbage deletes unless the namespace is an alias of it.
+        """
+        return f'{self.collection_name}-{datetime.now(utc):%Y%m%d%H%M%S%f}'
+
+    def create_shadow(self,
+                      dimensions: int,
+                      distance: str = None,
+                      upsert_workers: int = None) -> 'QdrantStore':
+        """Return a store with the configuration of this one, sharing
+        its client, for a new and empty collection named after the
+        namespace. It is filled while the namespace is searched, and
+        then put in its place with switch_to.
+        """
+        shadow = copy.copy(self)
+        shadow.collection_name = self.make_versioned_name()
+        if distance:
+            shadow.distance = distance
+        if upsert_workers:
+            shadow.upsert_workers = upsert_workers if self.upsert_workers > 1 else 1
+        shadow.create_namespace(dimensions=dimensions)
+        return shadow
+
+    def switch_to(self, shadow: 'QdrantStore'):
+        """Make the namespace an alias of the collection of shadow. The
+        alias is moved in a single operation, so searches go from one
+        collection to the other without a gap. A namespace that is a
+        collection itself, from before aliases, is deleted first, and
+        it cannot be searched until the alias is created.
+        """
+        operations = []
+        if self.get_aliased_collection() is not None:
+            operations.append(models.DeleteAliasOperation(
+                delete_alias=models.DeleteAlias(alias_name=self.collection_name)))
+        elif self.collection_name in [collection.name for collection
+                                      in self.client.get_collections().collections]:
+            self.logger.warning('Replacing collection %s with an alias', self.collection_name)
+            self.client.delete_collection(self.collection_name)
+        operations.append(models.CreateAliasOperation(
+            create_alias=models.CreateAlias(collection_name=shadow.collection_name,
+                                            alias_name=self.collection_name)))
+        self.client.update_collection_aliases(change_aliases_operations=operations)
+        self.generation += 1
+        self.distance = shadow.distance
+        self.logger.info('Namespace %s is now collection %s',
+                         self.collection_name,
+                         shadow.collection_name)
+
+    def collect_garbage(self) -> List[str]:
+        """Delete the collections created by create_shadow for the
+        namespace that it is not an alias of, left by earlier or
+        interrupted reindexes. Returns their names.
+        """
+        current = self.get_aliased_collection()
+        prefix = self.collection_name + '-'
+        deleted = []
+        for collection in self.client.get_collections().collections:
+            suffix = collection.name[len(prefix):]
+            if (collection.name.startswith(prefix) and suffix.isdigit()
+                    and collection.name != current):
+                self.logger.info('Deleting old collection %s', collection.name)
+                self.client.delete_collection(collection.name)
+                deleted.append(collection.name)
+        return deleted
+
+    def get_hnsw_config(self) -> Optional[models.HnswConfigDiff]:
+        if self.hnsw_m is None and self.hnsw_ef_construct is None:
+            return None
+        return models.HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct)
+
+    def get_optimizers_config(self) -> Optional[models.OptimizersConfigDiff]:
+        if self.optimizer_segments is None:
+            return None
+        return models.OptimizersConfigDiff(default_segment_number=self.optimizer_segments)
+
+    def get_quantization_config(self):
+        if self.quantization in ('scalar', 'int8'):
+            return models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8,
+                                                       always_ram=self.quantization_always_ram))
+        if self.quantization == 'binary':
+            return models.BinaryQuantization(
+                binary=models.BinaryQuantizationConfig(always_ram=self.quantization_always_ram))
+        return None
+
+    def get_search_params(self) -> Optional[models.SearchParams]:
+        quantization = None
+        if self.quantization not in (None, 'none'):
+            quantization = models.QuantizationSearchParams(
+                rescore=self.quantization_rescore,
+                oversampling=self.quantization_oversampling)
+        if self.hnsw_ef is None and quantization is None:
+            return None
+        return models.SearchParams(hnsw_ef=self.hnsw_ef, quantization=quantization)
+
+    def migrate_namespace(self):
+        """Apply the configuration to an existing collection. Qdrant
+        rebuilds what needs to change in the background. A quantization
+        of none removes the quantization of the collection. What is not
+        set, quantization, on_disk or on_disk_payload among others, is
+        left as it is.
+        """
+        quantization_config = self.get_quantization_config()
+        if self.quantization == 'none':
+            quantization_config = models.Disabled.DISABLED
+        vectors_config = None
+        if self.on_disk is not None:
+            vectors_config = {'': models.VectorParamsDiff(on_disk=self.on_disk)}
+        collection_params = None
+        if self.on_disk_payload is not None:
+            collection_params = models.CollectionParamsDiff(on_disk_payload=self.on_disk_payload)
+        self.client.update_collection(
+            collection_name=self.collection_name,
+            vectors_config=vectors_config,
+            collection_params=collection_params,
+            hnsw_config=self.get_hnsw_config(),
+            optimizers_config=self.get_optimizers_config(),
+            quantization_config=quantization_config)
+        self.logger.info('Migrated collection %s', self.collection_name)
 
     def create_filter(self,
                       sources: Union[List[str], str] = None,
@@ -226,7 +892,7 @@ class QdrantStore(Store):
         return models.Filter(must=conditions)
 
     def search(self,
-               query_vector: List[float],
+               query_vector: np.ndarray,
                limit: int,
                sources: Union[List[str], str] = None,
                source_unit_ids: Union[List[str], str] = None,
@@ -238,19 +904,92 @@ class QdrantStore(Store):
         self.logger.info('Searching %s %s',
                          self.collection_name,
                          ('with scopes ' + ', '.join(scopes)) if scopes else 'without scopes')
+        key = None
+        if self.search_cache is not None:
+            key = search_key(self.collection_name, {'query_vector': query_vector,
+                                                    'limit': limit,
+                                                    'sources': sources,
+                                                    'source_unit_ids': source_unit_ids,
+                                                    'categories': categories,
+                                                    'scopes': scopes,
+                                                    'contexts': contexts,
+                                                    'languages': languages})
+            payloads = self.search_cache.get(key, self.generation)
+            if payloads is not None:
+                return payloads
+
+        generation = self.generation
         out = self.client.search(collection_name=self.collection_name,
-                                 query_vector=query_vector,
+                                 query_vector=np.asarray(query_vector).tolist(),
                                  query_filter=self.create_filter(sources=sources,
                                                                  source_unit_ids=source_unit_ids,
                                                                  categories=categories,
                                                                  scopes=scopes,
                                                                  contexts=contexts,
                                                                  languages=languages),
-                                 limit=limit)
+                                 limit=limit,
+                                 search_params=self.get_search_params(),
+                                 with_payload=not self.slim_payloads)
 
         self.logger.debug('Vector search replied:\n\n%s', pformat(out))
 
-        return [Payload(**(r.payload)) for r in out]
+        payloads = self.get_payloads([out])[0]
+        if key is not None:
+            self.search_cache.put(key, generation, payloads)
+        return payloads
+
+    def get_payloads(self, results: List[List]) -> List[List[Payload]]:
+        """The payloads of the points in the results of each search,
+        from the chunk cache with slim_payloads, in a single lookup.
+        """
+        if not self.slim_payloads:
+            return [[Payload(**(r.payload)) for r in result] for result in results]
+
+        payloads = self.get_chunk_cache().get_payloads_by_vector_db_id(
+            [str(r.id) for result in results for r in result])
+        missing = [str(r.id) for result in results for r in result if str(r.id) not in payloads]
+        if missing:
+            self.logger.warning('Points not found in the chunk cache: %s', ', '.join(missing))
+        return [[payloads[str(r.id)] for r in result if str(r.id) in payloads]
+                for result in results]
+
+    def search_batch(self, queries: List[Dict]) -> List[List[Payload]]:
+        self.logger.info('Searching %s with a batch of %d queries',
+                         self.collection_name,
+                         len(queries))
+        out = [None] * len(queries)
+        keys = [None] * len(queries)
+        if self.search_cache is not None:
+            for k, query in enumerate(queries):
+                keys[k] = search_key(self.collection_name, query)
+                out[k] = self.search_cache.get(keys[k], self.generation)
+        missing = [k for k, payloads in enumerate(out) if payloads is None]
+        if not missing:
+            return out
+
+        generation = self.generation
+        queries = [queries[k] for k in missing]
+        requests = [models.SearchRequest(
+            vector=np.asarray(query['query_vector']).tolist(),
+            filter=self.create_filter(sources=query.get('sources'),
+                                      source_unit_ids=query.get('source_unit_ids'),
+                                      categories=query.get('categories'),
+                                      scopes=query.get('scopes'),
+                                      contexts=query.get('contexts'),
+                                      languages=query.get('languages')),
+            limit=query['limit'],
+            params=self.get_search_params(),
+            with_payload=not self.slim_payloads) for query in queries]
+        results = self.client.search_batch(collection_name=self.collection_name,
+                                           requests=requests)
+
+        self.logger.debug('Vector batch search replied:\n\n%s', pformat(results))
+
+        for k, payloads in zip(missing, self.get_payloads(results)):
+            out[k] = payloads
+            if keys[k] is not None:
+                self.search_cache.put(keys[k], generation, payloads)
+        return out
 
     def count(self,
               sources: Union[List[str], str] = None,
@@ -269,34 +1008,80 @@ class QdrantStore(Store):
                                  exact=True).count
 
 
-    def clean_source_unit(self, source_unit_id: str):
+    def clean_source_unit(self, source_unit_id: str, wait: bool = True):
+        # Qdrant applies the upserts that follow after the delete, so
+        # with wait False the first of them that waits waits for both.
         self.client.delete(collection_name=self.collection_name,
                            points_selector=Filter(must=[
                                FieldCondition(key='source_unit_id',
-                                              match=MatchValue(value=source_unit_id))]))
+                                              match=MatchValue(value=source_unit_id))]),
+                           wait=wait)
+        self.generation += 1
+
+    def delete_points(self, vector_db_ids: List[str], wait: bool = True):
+        self.generation += 1
+        self.client.delete(collection_name=self.collection_name,
+                           points_selector=models.PointIdsList(points=vector_db_ids),
+                           wait=wait)
+        self.generation += 1
 
-    def upsert_chunks(self, chunks: List[Chunk]) -> List[Chunk]:
+    def upsert_chunks(self, chunks: List[Chunk], wait: bool = True) -> List[Chunk]:
         """Uploads and inserts chunks to the vector database. It
         returns a copy of the list of chunks, where each chunk
         includes a vector_db_id field with a newly generated id with
         which it can be retrieved from the vector database.
+
+        The batches are sent without waiting for qdrant to apply them,
+        possibly in parallel. Qdrant applies the updates to a
+        collection in order, so if wait is True a last batch sent when
+        all the others have been accepted, waiting for it to be
+        applied, works as a barrier for all of them.
         """
+        # The generation is incremented before and after the upserts, so
+        # that no search that overlaps with them is served from the cache.
+        self.generation += 1
         out = []
         points = []
         for chunk in chunks:
-            vector_db_id = make_id(chunk.payload.source + chunk.payload.source_unit_id,
-                                   chunk.payload.body)
+            vector_db_id = self.get_point_id(chunk)
+            payload = chunk.payload
+            if self.slim_payloads:
+                payload = {field: payload[field] for field in FILTER_FIELDS.values()}
             points.append(PointStruct(id=vector_db_id,
-                                      vector=chunk.vector,
-                                      payload=chunk.payload))
+                                      vector=chunk.vector.tolist(),
+                                      payload=payload))
 
             out_chunk = chunk.copy()
             out_chunk.vector_db_id = vector_db_id
             out.append(out_chunk)
 
-        self.client.upsert(collection_name=self.collection_name,
-                           points=points)
-        self.logger.info('Upserted %s points to %s', len(points), self.collection_name)
+        if not points:
+            return out
+
+        start = time.perf_counter()
+        batches = [points[i:i + self.upsert_batch_size]
+                   for i in range(0, len(points), self.upsert_batch_size)]
+
+        def _upsert(batch, wait_batch=False):
+            self.client.upsert(collection_name=self.collection_name,
+                               points=batch,
+                               wait=wait_batch)
+
+        if self.upsert_workers > 1 and len(batches) > 2:
+            with ThreadPoolExecutor(max_workers=self.upsert_workers) as executor:
+                list(executor.map(_upsert, batches[:-1]))
+        else:
+            for batch in batches[:-1]:
+                _upsert(batch)
+        _upsert(batches[-1], wait_batch=wait)
+        self.generation += 1
+
+        elapsed = time.perf_counter() - start
+        self.logger.info('Upserted %s points to %s in %d batches, %.0f points/s',
+                         len(points),
+                         self.collection_name,
+                         len(batches),
+                         len(points) / elapsed if elapsed else float('inf'))
         return out
 
     def retrieve(self,
@@ -304,40 +1089,44 @@ class QdrantStore(Store):
                  with_payload: bool = True,
                  with_vectors: bool = False) -> List[Dict]:
 
-        return self.client.retrieve(collection_name=self.collection_name,
-                                    ids=chunk_ids,
-                                    with_payload=with_payload,
-                                    with_vectors=with_vectors)
-
-    def fetch_all(self,
-                  sources: Union[List[str], str] = None,
-                  source_unit_ids: Union[List[str], str] = None,
-                  categories: Union[List[str], str] = None,
-                  scopes: Union[List[str], str] = None,
-                  contexts: Union[List[str], str] = None,
-                  languages: Union[List[str], str] = None,
-                  with_payload: bool = True,
-                  with_vectors: bool = False,
-                  per_page: int = 10) -> List[Dict]:
-
-        all_points = []
-        offset = 0
-        while offset is not None:
+        return [as_point(point, with_vectors)
+                for point in self.client.retrieve(collection_name=self.collection_name,
+                                                  ids=chunk_ids,
+                                                  with_payload=with_payload,
+                                                  with_vectors=with_vectors)]
+
+    def iter_points(self,
+                    sources: Union[List[str], str] = None,
+                    source_unit_ids: Union[List[str], str] = None,
+                    categories: Union[List[str], str] = None,
+                    scopes: Union[List[str], str] = None,
+                    contexts: Union[List[str], str] = None,
+                    languages: Union[List[str], str] = None,
+                    payload_fields: List[str] = None,
+                    with_vectors: bool = False,
+                    per_page: int = 1000) -> Iterator[Dict]:
+        """Scroll through the points that match the filter, per_page
+        points per request.
+        """
+        scroll_filter = self.create_filter(sources=sources,
+                                           source_unit_ids=source_unit_ids,
+                                           categories=categories,
+                                           scopes=scopes,
+                                           contexts=contexts,
+                                           languages=languages)
+        offset = None
+        while True:
             points, offset = self.client.scroll(
                 collection_name=self.collection_name,
                 limit=per_page,
                 offset=offset,
-                scroll_filter=self.create_filter(sources=sources,
-                                                 source_unit_ids=source_unit_ids,
-                                                 categories=categories,
-                                                 scopes=scopes,
-                                                 contexts=contexts,
-                                                 languages=languages),
-                with_payload=with_payload,
+                scroll_filter=scroll_filter,
+                with_payload=payload_fields or True,
                 with_vectors=with_vectors)
-            all_points += [point.payload for point in points]
-
-        return all_points
+            for point in points:
+                yield as_point(point, with_vectors)
+            if offset is None:
+                break
 
 
 def add_args(parser):
@@ -359,6 +1148,38 @@ def add_args(parser):
                         help='List the namespace',
                         action='store_true')
 
+    parser.add_argument('--export',
+                        help=('Export the namespace to this file, with a json '
+                              'line per point.'),
+                        type=str)
+
+    parser.add_argument('--fields',
+                        help='Comma-separated payload fields to list or export.',
+                        type=str)
+
+    parser.add_argument('--with-vectors',
+                        help='Export the vectors too.',
+                        action='store_true')
+
+    parser.add_argument('--rebuild-from-cache',
+                        help=('Create the namespace anew with the vectors in the chunk cache, '
+                              'or go on with an interrupted rebuild.'),
+                        action='store_true')
+
+    parser.add_argument('--rebuild-batch-size',
+                        help='Number of chunks read from the cache at a time when rebuilding.',
+                        type=int,
+                        default=10000)
+
+    parser.add_argument('--restart-rebuild',
+                        help='Start the rebuild from scratch even if one was interrupted.',
+                        action='store_true')
+
+    parser.add_argument('--migrate-namespace',
+                        help=('Apply the quantization, on disk, HNSW and optimizer '
+                              'settings in the configuration to the namespace.'),
+                        action='store_true')
+
     parser.add_argument('--delete-namespace',
                         help='Delete the namespace. Set to "really".',
                         type=str)
@@ -393,12 +1214,37 @@ def main(awd, args):
     if args['count']:
         print(store.count(**filter_args))
 
+    payload_fields = args['fields'].split(',') if args['fields'] else None
     if args['list']:
-        for point in store.fetch_all(**filter_args):
-            pprint(dict(point))
+        for point in store.iter_points(payload_fields=payload_fields, **filter_args):
+            pprint(dict(point['payload']))
+
+    if args['export']:
+        import json
+        with open(args['export'], 'w', encoding='utf-8') as fout:
+            for point in store.iter_points(payload_fields=payload_fields,
+                                           with_vectors=args['with_vectors'],
+                                           **filter_args):
+                if 'vector' in point:
+                    point['vector'] = point['vector'].tolist()
+                fout.write(json.dumps(point) + '\n')
+
+    if args['rebuild_from_cache']:
+        n_points = store.rebuild_from_cache(awd.get_chunk_cache(),
+                                            dimensions=awd.get_embedding_dimensions(),
+                                            batch_size=args['rebuild_batch_size'],
+                                            restart=args['restart_rebuild'])
+        print(f'Stored {n_points} points')
+
+    if args['migrate_namespace']:
+        if not hasattr(store, 'migrate_namespace'):
+            awd.logger.error('The vector store does not support migrations')
+            sys.exit(1)
+        store.migrate_namespace()
 
     if args['delete_namespace'] == 'really':
         store.delete_namespace()
+        awd.get_chunk_cache().delete_namespace_model(store.collection_name)
 
     if args['search']:
         if not args['search_terms']:
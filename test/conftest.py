@@ -30,6 +30,27 @@ def resdir():
     return 'test/res'
 
 
+@pytest.fixture(scope='session')
+def byte_tokenizer():
+    """A small byte level tiktoken encoding, built here so that the
+    tests do not need to download one.
+    """
+    import tiktoken
+
+    mergeable_ranks = {bytes([b]): b for b in range(256)}
+    for pair in ('th', 'he', 'in', 'er', 'an', 're', 'on', 'at', 'en', 'nd',
+                 'es', 'or', 'te', 'ed', 'is', 'e ', 's ', 'd ', ' t', ' a',
+                 '. ', '.\n', ':\n', '\n*', '\n#', '**'):
+        mergeable_ranks[pair.encode('utf-8')] = len(mergeable_ranks)
+
+    return tiktoken.Encoding(
+        name='test_bytes',
+        pat_str=(r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}|"""
+                 r""" ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""),
+        mergeable_ranks=mergeable_ranks,
+        special_tokens={})
+
+
 # pylint: disable=redefined-outer-name
 @pytest.fixture(scope='module')
 def ensure_empty_vector_namespace(awd):
@@ -1,5 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import json
+from datetime import datetime
+
+import pytest
+from pytz import utc
+
+import aword.errors as E
+import aword.model.embedder as embedder_module
+from aword.app import Awd
+from aword.apis import oai
+from aword.model.embedder import hash_vector
+from aword.segment import Segment
+from aword.vector.store import QdrantStore
+
 
 def test_update_cache(awd):
     suc = awd.get_source_unit_cache()
@@ -20,3 +34,186 @@ def test_embed_and_store(awd, ensure_empty_vector_namespace):
     suc = awd.get_source_unit_cache()
     unembedded = suc.list_unembedded_rows()
     assert len(unembedded) == 0
+
+
+@pytest.fixture
+def hash_awd(tmp_path, monkeypatch, byte_tokenizer):
+    """An Awd with the hash embedder, that records the embedded texts
+    in embedded, and with two source units in the cache.
+    """
+    monkeypatch.setattr(oai, 'get_tokenizer', lambda _: byte_tokenizer)
+    embedded = []
+
+    def _hash_vector(text, dimensions):
+        embedded.append(text)
+        return hash_vector(text, dimensions)
+
+    monkeypatch.setattr(embedder_module, 'hash_vector', _hash_vector)
+
+    with open(tmp_path / 'config.ini', 'w', encoding='utf-8') as fout:
+        fout.write(f"""
+[cache]
+provider = edge
+db_file = {tmp_path / 'cache.db'}
+embedding_cache_size = 0
+
+[vector]
+provider = qdrant
+local_db = {tmp_path / 'local.qdrant'}
+default_namespace = test-hash
+
+[embedding]
+model_name = hash
+embedding_chunk_size = 20
+dimensions = 8
+""")
+    with open(tmp_path / 'models.json', 'w', encoding='utf-8') as fout:
+        json.dump({'hash': {'provider': 'hash'}, 'hash2': {'provider': 'hash'}}, fout)
+
+    awd = Awd(config_dir=str(tmp_path))
+    for source_unit_id in ('1', '2'):
+        awd.get_source_unit_cache().add_or_update(
+            source='test',
+            source_unit_id=source_unit_id,
+            uri=f'file://test/{source_unit_id}',
+            created_by='test',
+            last_edited_by='test',
+            last_edited_timestamp=datetime.now(utc),
+            segments=[Segment(f'Source unit {source_unit_id}. ' + 'Some words. ' * 20)])
+    awd.embedded = embedded
+    return awd
+
+
+def test_embed_and_store_again_in_new_namespace(hash_awd):
+    hash_awd.embed_and_store()
+    store = hash_awd.get_vector_store()
+    n_points = store.count()
+    assert n_points == hash_awd.get_chunk_cache().count_rows() > 0
+
+    store.delete_namespace()
+    hash_awd.create_vector_namespace()
+    hash_awd.reset_embedded()
+    hash_awd.embed_and_store()
+    assert store.count() == n_points
+
+
+def test_embed_and_store_with_another_model(hash_awd):
+    hash_awd.embed_and_store()
+    n_embedded = len(hash_awd.embedded)
+
+    hash_awd.get_config('embedding')['model_name'] = 'hash2'
+    hash_awd.reset_embedded()
+    hash_awd.embed_and_store()
+    assert len(hash_awd.embedded) == 2 * n_embedded
+    assert hash_awd.get_vector_store().count() == hash_awd.get_chunk_cache().count_rows()
+
+
+def test_embed_and_store_edited_source_unit(hash_awd):
+    hash_awd.embed_and_store()
+    n_embedded = len(hash_awd.embedded)
+
+    hash_awd.get_source_unit_cache().add_or_update(
+        source='test',
+        source_unit_id='1',
+        uri='file://test/1',
+        created_by='test',
+        last_edited_by='test',
+        last_edited_timestamp=datetime.now(utc),
+        segments=[Segment('Source unit 1. ' + 'Some words. ' * 20 + 'And one more.')])
+    hash_awd.embed_and_store()
+    # Only the last chunk changed.
+    assert len(hash_awd.embedded) == n_embedded + 1
+    assert hash_awd.get_vector_store().count() == hash_awd.get_chunk_cache().count_rows()
+
+
+def test_embed_and_store_unchanged_source_unit(hash_awd, monkeypatch):
+    hash_awd.embed_and_store()
+    store = hash_awd.get_vector_store()
+    upserted = []
+    upsert = store.client.upsert
+
+    def _upsert(collection_name, points, wait):
+        upserted.extend(points)
+        return upsert(collection_name=collection_name, points=points, wait=wait)
+
+    monkeypatch.setattr(store.client, 'upsert', _upsert)
+
+    # Parsed again, like a local file, its segment gets a new timestamp.
+    hash_awd.get_source_unit_cache().add_or_update(
+        source='test',
+        source_unit_id='1',
+        uri='file://test/1',
+        created_by='test',
+        last_edited_by='test',
+        last_edited_timestamp=datetime.now(utc),
+        segments=[Segment('Source unit 1. ' + 'Some words. ' * 20)])
+    hash_awd.embed_and_store()
+    assert upserted == []
+    assert store.count() == hash_awd.get_chunk_cache().count_rows()
+
+
+def test_reindex_catches_up_with_other_writers(hash_awd):
+    hash_awd.embed_and_store()
+    store_chunked_in_shadow = hash_awd._store_chunked_in_shadow
+    calls = []
+
+    def _store_chunked_in_shadow(chunked):
+        calls.append(len(chunked))
+        if len(calls) == 1:
+            # Another process, that only writes to the namespace.
+            reindex, hash_awd._reindex = hash_awd._reindex, None
+            hash_awd.get_source_unit_cache().add_or_update(
+                source='test',
+                source_unit_id='1',
+                uri='file://test/1',
+                created_by='test',
+                last_edited_by='test',
+                last_edited_timestamp=datetime.now(utc),
+                segments=[Segment('Source unit 1, edited elsewhere.')])
+            hash_awd.embed_and_store()
+            hash_awd._reindex = reindex
+        store_chunked_in_shadow(chunked)
+
+    hash_awd._store_chunked_in_shadow = _store_chunked_in_shadow
+    hash_awd.reindex(model_name='hash2')
+
+    store = hash_awd.get_vector_store()
+    assert store.get_aliased_collection() is not None
+    assert [payload['body'] for payload in store.fetch_all(source_unit_ids='1')] == [
+        'Source unit 1, edited elsewhere.']
+    assert store.count() == hash_awd.get_chunk_cache().count_rows()
+
+
+def test_embed_and_store_after_reindex_needs_the_new_model(hash_awd):
+    hash_awd.embed_and_store()
+    hash_awd.reindex(model_name='hash2')
+    with pytest.raises(E.AwordError, match='hash2'):
+        hash_awd.embed_and_store()
+
+    hash_awd.get_config('embedding')['model_name'] = 'hash2'
+    n_embedded = len(hash_awd.embedded)
+    hash_awd.embed_and_store()
+    assert len(hash_awd.embedded) == n_embedded
+
+    # A namespace created anew takes any model.
+    hash_awd.get_config('embedding')['model_name'] = 'hash'
+    hash_awd.create_vector_namespace()
+    hash_awd.reset_embedded()
+    hash_awd.embed_and_store()
+    assert len(hash_awd.embedded) > n_embedded
+
+
+def test_reindex_streams_large_source_units(hash_awd, monkeypatch):
+    hash_awd.get_config('embedding').update({'streaming_min_chars': 10,
+                                             'embedding_batch_size': 2})
+
+    def _make_source_unit_chunks(*_, **__):
+        raise AssertionError('Large source units are streamed')
+
+    monkeypatch.setattr(QdrantStore, 'make_source_unit_chunks', _make_source_unit_chunks)
+    hash_awd.embed_and_store()
+    n_points = hash_awd.get_vector_store().count()
+
+    hash_awd.reindex(model_name='hash2')
+    assert hash_awd.get_vector_store().count() == n_points
+    assert hash_awd.get_chunk_cache().count_rows() == n_points
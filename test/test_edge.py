@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import uuid
+import pickle
 import time
+import sqlite3
 from datetime import datetime
 from pytz import utc
 from dateutil.relativedelta import relativedelta
 
+import numpy as np
+import pytest
+
 import aword.cache.edge as E
+from aword.dbpool import PoolRegistry
 from aword.segment import Segment
 from aword.chunk import Payload, Chunk
 
@@ -208,8 +214,8 @@ def test_recreate_state():
     assert state_at_timestamp_2[0]['uri'] == second_uri
 
 
-def test_chunk_add_and_get():
-    db = E.ChunkDB('test_model')
+def test_chunk_add_and_get(tmp_path):
+    db = E.ChunkDB(str(tmp_path / 'chunks.db'))
     source = "test_source"
     source_unit_id = "test_source_unit_id"
     text = "test_text"
@@ -226,14 +232,102 @@ def test_chunk_add_and_get():
 
     result = db.get(chunk_id)
     assert result.payload.body == text
-    assert result.vector == vector
+    assert result.vector.dtype == np.float32
+    assert result.vector.tolist() == vector
     assert result.vector_db_id == vector_db_id
 
     most_recent_datetime = db.get_most_recent_addition_datetime()
     assert most_recent_datetime == now
 
 
-def test_get_non_existent():
-    db = E.ChunkDB('test_model')
+def test_get_non_existent(tmp_path):
+    db = E.ChunkDB(str(tmp_path / 'chunks.db'))
     result = db.get("non_existent_chunk_id")
     assert result is None
+
+
+def test_embedding_cache_eviction():
+    db = E.EmbeddingDB(max_rows=3)
+    db.reset_table()
+
+    def _as_lists(vectors):
+        return [None if vector is None else vector.tolist() for vector in vectors]
+
+    db.add_many('test_model', ['one', 'two', 'three'], np.array([[1.0], [2.0], [3.0]]))
+    assert _as_lists(db.get_many('test_model', ['one', 'four'])) == [[1.0], None]
+    assert db.get_many('other_model', ['one']) == [None]
+
+    # 'two' is now the least recently used
+    time.sleep(0.01)
+    db.get_many('test_model', ['three'])
+    db.add_many('test_model', ['four'], np.array([[4.0]]))
+
+    assert db.count_rows() == 3
+    assert _as_lists(db.get_many('test_model', ['one', 'two', 'three', 'four'])) == [
+        [1.0], None, [3.0], [4.0]]
+
+
+def test_connections_across_threads(tmp_path):
+    import threading
+
+    db_file = str(tmp_path / 'cache.db')
+    chunk_db = E.ChunkDB(db_file=db_file)
+    assert chunk_db.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert chunk_db.conn is not chunk_db.reader
+
+    def make_chunk(k):
+        return Chunk(vector=np.ones(4, dtype=np.float32) * k,
+                     payload=Payload(body=f'body {k}'),
+                     chunk_id=str(k))
+
+    errors = []
+
+    def write(source_unit_id):
+        try:
+            for k in range(20):
+                chunk_db.add(source='test', source_unit_id=source_unit_id, chunks=[make_chunk(k)])
+        except Exception as exc:  # pylint: disable=broad-except
+            errors.append(exc)
+
+    def read():
+        try:
+            for _ in range(20):
+                chunk_db.count_rows()
+                chunk_db.list_rows(source='test')
+        except Exception as exc:  # pylint: disable=broad-except
+            errors.append(exc)
+
+    threads = ([threading.Thread(target=write, args=(str(k),)) for k in range(2)] +
+               [threading.Thread(target=read) for _ in range(2)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert chunk_db.count_rows() == 40
+
+
+def test_vector_blobs():
+    vector = np.array([0.5, -1, 3], dtype=np.float32)
+    assert E.dump_vector(vector) == vector.tobytes()
+    assert E.load_vector(E.dump_vector(vector)).tolist() == vector.tolist()
+    assert E.dump_vector(None) is None and E.load_vector(None) is None
+
+    # Rows from older versions.
+    assert E.load_vector(pickle.dumps([0.5, -1, 3])).tolist() == vector.tolist()
+    assert E.load_vector(pickle.dumps(vector)).tolist() == vector.tolist()
+    assert E.load_vector(pickle.dumps(None)) is None
+
+
+def test_closed_pool():
+    pools = PoolRegistry()
+    chunk_db = E.ChunkDB()
+    chunk_db.pool = pools.get_pool()
+    chunk_db.create_table()
+    chunk_db.add(source='test', source_unit_id='1', chunks=[Chunk(payload=Payload(body='body'))])
+
+    pools.close_connection()
+    with pytest.raises(sqlite3.ProgrammingError):
+        chunk_db.count_rows()
+    assert pools.get_pool() is not chunk_db.pool
@@ -1,5 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import time
+import threading
+
+import numpy as np
+import pytest
+
+from aword.app import Awd
+from aword.cache.edge import EmbeddingDB
+from aword.apis import oai
+from aword.model.embedder import Embedder, QueryEmbeddingCache, scan_chunk_boundaries
+from aword.model.embedder import make_embedder
+from aword.model.embedder import HuggingFaceEmbedder, QuantizedHuggingFaceEmbedder
+
 
 def test_get_oai_embeddings(awd):
     embedder = awd.get_embedder()
@@ -17,6 +32,182 @@ def test_chunks(awd):
     assert embedder.encode(txt[-1]) == tk[-1]
 
 
+def test_indexed_chunks_match_scanned_chunks(byte_tokenizer, resdir):
+    embedder = Embedder(tokenizer=byte_tokenizer,
+                        embedding_fn=None,
+                        chunk_size=40,
+                        model_name='test_bytes',
+                        max_sequence_length=512,
+                        dimensions=8)
+
+    texts = ['hola que tal. Esto es una prueba de chunk',
+             'Añadir: caña, ñu, 日本語のテキスト。Und dann.\nZweite Zeile.\n' * 20]
+    for dirpath, _, filenames in os.walk(f'{resdir}/local'):
+        for filename in sorted(filenames):
+            with open(os.path.join(dirpath, filename), encoding='utf-8') as fin:
+                texts.append(fin.read())
+
+    for text in texts:
+        tokens = embedder.encode(re.sub(r'[ \t]+', ' ', text))
+        for n in (1, 4, 7, 40, 400):
+            indexed = list(embedder.split_in_chunks(text, n))
+            scanned = list(scan_chunk_boundaries(byte_tokenizer, tokens, n))
+            assert indexed == scanned
+
+
+def test_streamed_chunks_match_chunks(byte_tokenizer, resdir):
+    embedder = Embedder(tokenizer=byte_tokenizer,
+                        embedding_fn=lambda texts, _: [[float(len(text))] for text in texts],
+                        chunk_size=40,
+                        model_name='test_bytes',
+                        max_sequence_length=512,
+                        dimensions=1)
+
+    with open(f'{resdir}/local/butterfly-species.md', encoding='utf-8') as fin:
+        text = fin.read() * 5
+
+    bodies = [chunk_text
+              for _, chunk_text in embedder.split_in_chunks(re.sub('\n+', '\n', text), 40)]
+    for window_chars in (1, 100, 1000, len(text)):
+        assert bodies == [chunk.payload.body
+                          for chunk in embedder.iter_chunks(text, window_chars=window_chars)]
+
+    embedded = list(embedder.iter_embedded_chunks(text, batch_size=7))
+    assert [chunk.payload.body for chunk in embedded] == bodies
+    assert all(chunk.vector.tolist() == [float(len(chunk.payload.body))] for chunk in embedded)
+
+
+def test_embedding_cache_misses(byte_tokenizer):
+    embedded = []
+
+    def _embedding_fn(texts, _):
+        embedded.extend(texts)
+        return [[float(len(text))] for text in texts]
+
+    embedding_cache = EmbeddingDB()
+    embedding_cache.reset_table()
+    embedder = Embedder(tokenizer=byte_tokenizer,
+                        embedding_fn=_embedding_fn,
+                        chunk_size=40,
+                        model_name='test_bytes',
+                        max_sequence_length=512,
+                        dimensions=1,
+                        embedding_cache=embedding_cache)
+
+    embeddings = embedder.get_embeddings(['a', 'bb', 'a'])
+    assert embeddings.dtype == np.float32
+    assert embeddings.tolist() == [[1.0], [2.0], [1.0]]
+    assert embedded == ['a', 'bb']
+
+    assert embedder.get_embeddings(['ccc', 'bb']).tolist() == [[3.0], [2.0]]
+    assert embedded == ['a', 'bb', 'ccc']
+
+
+def test_query_embedding_cache(byte_tokenizer):
+    embedded = []
+
+    def _embedding_fn(texts, _):
+        embedded.extend(texts)
+        return [[float(len(text))] for text in texts]
+
+    now = [0.0]
+    query_cache = QueryEmbeddingCache(max_size=2, ttl=10, clock=lambda: now[0])
+    embedder = Embedder(tokenizer=byte_tokenizer,
+                        embedding_fn=_embedding_fn,
+                        chunk_size=40,
+                        model_name='test_bytes',
+                        max_sequence_length=512,
+                        dimensions=1,
+                        query_cache=query_cache)
+
+    assert embedder.get_query_embedding('What is the  vacation policy?').tolist() == [29.0]
+    assert embedder.get_query_embedding(' what is the vacation policy?\n').tolist() == [29.0]
+    assert embedded == ['What is the  vacation policy?']
+
+    embedder.get_query_embedding('a')
+    embedder.get_query_embedding('bb')
+    embedder.get_query_embedding('what is the vacation policy?')
+    assert embedded == ['What is the  vacation policy?', 'a', 'bb', 'what is the vacation policy?']
+
+    now[0] = 11
+    embedder.get_query_embedding('bb')
+    assert embedded[-1] == 'bb'
+    assert query_cache.stats() == {'size': 2, 'hits': 1, 'misses': 5, 'hit_rate': 1 / 6}
+
+    del embedded[:]
+    embeddings = embedder.get_query_embeddings(['ccc', 'BB', 'dddd', 'ccc'])
+    assert embeddings.tolist() == [[3.0], [2.0], [4.0], [3.0]]
+    assert embedded == ['ccc', 'dddd']
+
+    embeddings = embedder.get_query_embeddings(['ccc', 'eeeee'], uncached=['a long history'])
+    assert embeddings.tolist() == [[3.0], [5.0], [14.0]]
+    assert embedded[-2:] == ['eeeee', 'a long history']
+    assert embedder.get_query_embeddings(['ccc'], uncached=['ff']).tolist() == [[3.0], [2.0]]
+    assert query_cache.get('test_bytes', 'a long history') is None
+
+    embedder.query_cache = None
+    embedder.get_query_embedding('Vacation  Policy')
+    assert embedded[-1] == 'Vacation  Policy'
+
+
+def test_hash_embeddings(monkeypatch, byte_tokenizer):
+
+    class _Awd:
+        def get_embedding_cache(self):
+            return None
+
+        def get_query_embedding_cache(self):
+            return None
+
+    monkeypatch.setattr(oai, 'get_tokenizer', lambda _: byte_tokenizer)
+    embedder = make_embedder(_Awd(), {'provider': 'hash',
+                                      'embedding_chunk_size': 40,
+                                      'dimensions': 64})
+
+    embeddings = embedder.get_embeddings(['a', 'bb', 'a'])
+    assert embeddings.shape == (3, 64)
+    assert embeddings.dtype == np.float32
+    assert np.allclose(np.linalg.norm(embeddings, axis=1), 1)
+    assert embeddings[0].tolist() == embeddings[2].tolist()
+    assert embeddings[0].tolist() != embeddings[1].tolist()
+    assert embeddings[1].tolist() == embedder.get_embeddings(['bb'])[0].tolist()
+
+    text = 'First segment. It has two sentences.'
+    byte_embedder = Embedder(tokenizer=byte_tokenizer,
+                             embedding_fn=None,
+                             chunk_size=40,
+                             model_name='test_bytes',
+                             max_sequence_length=512,
+                             dimensions=64)
+    assert ([c.payload.body for c in embedder.get_chunks(text)] ==
+            [c.payload.body for c in byte_embedder.get_chunks(text)])
+
+
+def test_embed_chunks_in_one_batch(byte_tokenizer):
+    batches = []
+
+    def _embedding_fn(texts, _):
+        batches.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    embedder = Embedder(tokenizer=byte_tokenizer,
+                        embedding_fn=_embedding_fn,
+                        chunk_size=4,
+                        model_name='test_bytes',
+                        max_sequence_length=512,
+                        dimensions=1)
+
+    chunks = (embedder.get_chunks('First segment. It has two sentences.') +
+              embedder.get_chunks('') +
+              embedder.get_chunks('Second segment, from another source unit.'))
+    assert all(chunk.vector is None for chunk in chunks)
+
+    embedder.embed_chunks(chunks)
+    assert len(batches) == 1
+    assert [chunk.payload.body for chunk in chunks] == batches[0]
+    assert all(chunk.vector.tolist() == [float(len(chunk.payload.body))] for chunk in chunks)
+
+
 def test_oai_embedded_chunks(awd, resdir):
     with open(f'{resdir}/local/org/wands.org', encoding='utf-8') as wands_in:
         with open(f'{resdir}/local/org/trees.org', encoding='utf-8') as trees_in:
@@ -43,3 +234,109 @@ def test_oai_embedded_chunks(awd, resdir):
                 'oval.\n'
             )
             assert len(oai_chunks[1].vector) == 1536
+
+
+def test_embedding_dimensions_without_embedder(resdir):
+    awd_without_embedder = Awd(config_dir=resdir)
+    assert awd_without_embedder.get_embedding_dimensions() == 1536
+    # pylint: disable=protected-access
+    assert not awd_without_embedder._embedder
+
+
+def test_embedding_dimensions_override(resdir):
+    awd = Awd(config_dir=resdir)
+    awd.get_config('embedding').update({'model_name': 'hash', 'dimensions': 64})
+    assert awd.get_embedding_dimensions() == 64
+
+
+class _FakeSentenceTransformer:
+    """Encodes a text as its length and the sum of its bytes. The
+    process pool encodes the chunks of texts in reverse order, and
+    gathers them in order, like sentence_transformers does.
+    """
+
+    def __init__(self):
+        self.pools = 0
+
+    @staticmethod
+    def encode(texts, batch_size=32):
+        return np.array([[len(text), sum(text.encode('utf-8'))] for text in texts],
+                        dtype=np.float32)
+
+    def start_multi_process_pool(self, target_devices):
+        time.sleep(0.05)
+        self.pools += 1
+        return {'processes': len(target_devices)}
+
+    def stop_multi_process_pool(self, pool):
+        pass
+
+    def encode_multi_process(self, texts, pool, batch_size, chunk_size):
+        chunks = [texts[k:k + chunk_size] for k in range(0, len(texts), chunk_size)]
+        encoded = {k: self.encode(chunk) for k, chunk in reversed(list(enumerate(chunks)))}
+        return np.concatenate([encoded[k] for k in range(len(chunks))])
+
+
+def test_huggingface_process_pool(monkeypatch):
+    class _Awd:
+        def get_embedding_cache(self):
+            return None
+
+        def get_query_embedding_cache(self):
+            return None
+
+    model = _FakeSentenceTransformer()
+    monkeypatch.setattr(HuggingFaceEmbedder, 'load_model', lambda self, _: model)
+    embedder = HuggingFaceEmbedder(_Awd(),
+                                   embedding_chunk_size=256,
+                                   batch_size=2,
+                                   processes=2,
+                                   multi_process_min_texts=4)
+
+    rng = np.random.default_rng(0)
+    texts = ['x' * int(n) + str(k) for k, n in enumerate(rng.integers(1, 50, 40))]
+    expected = model.encode(texts)
+    assert np.array_equal(embedder.embedding_fn(texts, embedder.model_name), expected)
+
+    # A new embedder, whose pool is not started yet.
+    embedder = HuggingFaceEmbedder(_Awd(),
+                                   embedding_chunk_size=256,
+                                   processes=2,
+                                   multi_process_min_texts=4)
+    model.pools = 0
+    threads = [threading.Thread(target=embedder.embedding_fn, args=(texts, embedder.model_name))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert model.pools == 1
+
+
+def test_quantized_embeddings_parity(resdir):
+    pytest.importorskip('torch')
+    pytest.importorskip('sentence_transformers')
+
+    class _Awd:
+        def get_embedding_cache(self):
+            return None
+
+        def get_query_embedding_cache(self):
+            return None
+
+    min_cosine_similarity = 0.95
+
+    with open(f'{resdir}/local/butterfly-biology.md', encoding='utf-8') as fin:
+        texts = [line for line in fin.read().split('\n') if line.strip()]
+
+    embeddings = HuggingFaceEmbedder(_Awd(),
+                                     embedding_chunk_size=256).get_embeddings(texts)
+    quantized_embeddings = QuantizedHuggingFaceEmbedder(
+        _Awd(),
+        embedding_chunk_size=256,
+        base_model_name='multi-qa-mpnet-base-dot-v1').get_embeddings(texts)
+
+    cosine_similarity = (np.sum(embeddings * quantized_embeddings, axis=1) /
+                         np.linalg.norm(embeddings, axis=1) /
+                         np.linalg.norm(quantized_embeddings, axis=1))
+    assert cosine_similarity.min() > min_cosine_similarity
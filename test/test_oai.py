@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import threading
+
+from aword.apis import oai
+
+
+def test_concurrent_embeddings_keep_order(monkeypatch):
+    in_flight = []
+    max_in_flight = []
+    lock = threading.Lock()
+
+    def _create(input, model):
+        with lock:
+            in_flight.append(1)
+            max_in_flight.append(len(in_flight))
+        time.sleep(random.uniform(0, 0.02))
+        with lock:
+            in_flight.pop()
+        return {'data': [{'embedding': [float(text)]} for text in input]}
+
+    monkeypatch.setattr(oai.openai.Embedding, 'create', _create)
+
+    texts = [str(k) for k in range(1050)]
+    embeddings = oai.get_embeddings(texts,
+                                    'test_model',
+                                    max_in_flight=4,
+                                    rate_limiter=oai.RateLimiter(requests_per_minute=60000),
+                                    count_tokens=len)
+    assert embeddings == [[float(k)] for k in range(1050)]
+    assert 1 < max(max_in_flight) <= 4
+
+
+def test_rate_limiter_waits_for_tokens():
+    # 6000 tokens per minute refill 100 tokens per second
+    rate_limiter = oai.RateLimiter(tokens_per_minute=6000)
+    rate_limiter.acquire(6000)
+
+    start = time.monotonic()
+    rate_limiter.acquire(20)
+    assert 0.15 < time.monotonic() - start < 0.5
+
+
+def test_token_budget_batches():
+    assert oai.make_batches([], 3, 10) == []
+    assert oai.make_batches([1] * 7, 3) == [range(0, 3), range(3, 6), range(6, 7)]
+    assert oai.make_batches([4, 4, 4, 20, 1, 1], 100, 10) == [range(0, 2),
+                                                             range(2, 3),
+                                                             range(3, 4),
+                                                             range(4, 6)]
+
+
+def test_oversized_batches_are_split(monkeypatch):
+    requests = []
+
+    def _create(input, model):
+        requests.append(len(input))
+        if len(input) > 2:
+            raise oai.openai.InvalidRequestError('Too many tokens in the request', 'input')
+        return {'data': [{'embedding': [float(text)]} for text in input]}
+
+    monkeypatch.setattr(oai.openai.Embedding, 'create', _create)
+
+    texts = [str(k) for k in range(6)]
+    assert oai.get_embeddings(texts, 'test_model') == [[float(k)] for k in range(6)]
+    assert requests == [6, 3, 1, 2, 3, 1, 2]
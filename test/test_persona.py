@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import json
+from datetime import datetime
+
+from pytz import utc
+
+from aword.app import Awd
+from aword.apis import oai
+from aword.model.persona import Persona
+from aword.segment import Segment
+
+
+class _Persona(Persona):
+
+    def tell(self, user_query, message_history, **_):
+        return {}
+
+
+def test_get_background(tmp_path, monkeypatch, byte_tokenizer):
+    monkeypatch.setattr(oai, 'get_tokenizer', lambda _: byte_tokenizer)
+    with open(tmp_path / 'config.ini', 'w', encoding='utf-8') as fout:
+        fout.write(f"""
+[cache]
+provider = edge
+db_file = {tmp_path / 'cache.db'}
+embedding_cache_size = 0
+
+[vector]
+provider = numpy
+default_namespace = test-persona
+
+[embedding]
+model_name = hash
+embedding_chunk_size = 200
+dimensions = 16
+""")
+    with open(tmp_path / 'models.json', 'w', encoding='utf-8') as fout:
+        json.dump({'hash': {'provider': 'hash'}}, fout)
+
+    awd = Awd(config_dir=str(tmp_path))
+    for source_unit_id, body in (('1', 'Butterflies lay their eggs on leaves.'),
+                                 ('2', 'Moths fly at night.')):
+        awd.get_source_unit_cache().add_or_update(
+            source='test',
+            source_unit_id=source_unit_id,
+            uri=f'file://test/{source_unit_id}',
+            created_by='test',
+            last_edited_by='test',
+            last_edited_timestamp=datetime.now(utc),
+            segments=[Segment(body)])
+    awd.embed_and_store()
+    bodies = {chunk.payload.source_unit_id: chunk.payload.body
+              for chunk in awd.get_chunk_cache().list_rows(source='test')}
+
+    store = awd.get_vector_store()
+    searches = []
+    search_batch = store.search_batch
+
+    def _search_batch(queries):
+        searches.append(search_batch(queries))
+        return searches[-1]
+
+    monkeypatch.setattr(store, 'search_batch', _search_batch)
+
+    persona = _Persona(awd, scopes=None, chunks_for_history=1, chunks_per_conversation=2)
+    background = persona.get_background(bodies['1'],
+                                        [{'role': 'user', 'content': bodies['2']}])
+    results = searches[-1]
+    assert results[0][0].body == bodies['1']
+    assert results[1][0].body == bodies['2']
+    assert background.index(bodies['2']) < background.index(bodies['1'])
+
+    # Only the query goes through the query cache.
+    assert awd.get_query_embedding_cache().stats()['size'] == 1
@@ -1,8 +1,44 @@
 # -*- coding: utf-8 -*-
 
+import logging
 
+import numpy as np
+import pytest
+from qdrant_client.http import models
+
+from aword.cache.edge import ChunkDB
+from aword.chunk import Chunk, Payload
 from aword.segment import Segment
 
+from aword.vector.store import QdrantStore
+from aword.vector.numpystore import NumpyStore
+
+
+class _Awd:
+    """Just what a vector store needs from Awd."""
+
+    logger = logging.getLogger('test_store')
+
+    def __init__(self, dimensions=4):
+        self.dimensions = dimensions
+
+    def get_embedding_dimensions(self):
+        return self.dimensions
+
+    def getenv(self, _):
+        return None
+
+
+def make_chunks(source_unit_id, n, dimensions=4, **payload):
+    rng = np.random.default_rng(len(source_unit_id) + n)
+    return [Chunk(payload=Payload(**{'body': f'Chunk {i} of {source_unit_id}',
+                                     'source': 'test',
+                                     'source_unit_id': source_unit_id,
+                                     'scope': 'public',
+                                     **payload}),
+                  vector=rng.standard_normal(dimensions).astype(np.float32))
+            for i in range(n)]
+
 
 # pylint: disable=unused-argument
 def test_store(awd, ensure_empty_vector_namespace, resdir):
@@ -98,3 +134,498 @@ def test_store(awd, ensure_empty_vector_namespace, resdir):
             assert len(store.fetch_all(categories='wedding')) == 5
             assert len(store.fetch_all(categories='present')) == 2
             assert len(store.fetch_all(categories=['present', 'regalo'])) == 3
+
+
+def test_batched_upserts(tmp_path, monkeypatch):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-batches',
+                        local_db=str(tmp_path / 'local.qdrant'),
+                        upsert_batch_size=3)
+
+    upserts = []
+    upsert = store.client.upsert
+
+    def _upsert(collection_name, points, wait):
+        upserts.append((len(points), wait))
+        return upsert(collection_name=collection_name, points=points, wait=wait)
+
+    monkeypatch.setattr(store.client, 'upsert', _upsert)
+
+    chunks = store.store_chunks('1', make_chunks('1', 10))
+    assert upserts == [(3, False), (3, False), (3, False), (1, True)]
+    assert all(chunk.vector_db_id for chunk in chunks)
+    assert store.count() == 10
+
+    store.store_chunks('1', make_chunks('1', 2), wait=False)
+    assert upserts[-1] == (2, False)
+    assert store.count() == 2
+
+
+def test_clean_source_unit_waits_without_chunks(tmp_path, monkeypatch):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-clean',
+                        local_db=str(tmp_path / 'local.qdrant'))
+    deletes = []
+    delete = store.client.delete
+
+    def _delete(collection_name, points_selector, wait):
+        deletes.append(wait)
+        return delete(collection_name=collection_name, points_selector=points_selector, wait=wait)
+
+    monkeypatch.setattr(store.client, 'delete', _delete)
+
+    store.store_chunks('1', make_chunks('1', 3))
+    assert deletes == [False]
+    assert store.store_chunks('1', [], wait=False) == []
+    assert deletes == [False, True]
+    assert store.count() == 0
+    store.clean_source_unit('1')
+    assert deletes[-1] is True
+
+
+def test_update_chunks(tmp_path):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-update',
+                        local_db=str(tmp_path / 'local.qdrant'))
+    stored_chunks = store.update_chunks(make_chunks('1', 4), [])
+    assert store.count() == 4
+
+    chunks = [chunk.copy() for chunk in stored_chunks[1:]] + make_chunks('1', 6)[5:]
+    for chunk in chunks:
+        chunk.vector = None
+    chunks[0].payload.scope = 'confidential'
+    assert store.reuse_stored_vectors(chunks, stored_chunks) == [chunks[-1]]
+    chunks[-1].vector = np.ones(4, dtype=np.float32)
+
+    upserted = []
+    upsert_chunks = store.upsert_chunks
+
+    def _upsert_chunks(chunks, wait=True):
+        upserted.extend(chunk.payload.body for chunk in chunks)
+        return upsert_chunks(chunks, wait=wait)
+
+    store.upsert_chunks = _upsert_chunks
+    updated_chunks = store.update_chunks(chunks, stored_chunks)
+    assert upserted == ['Chunk 1 of 1', 'Chunk 5 of 1']
+    assert [chunk.payload.body for chunk in updated_chunks] == [
+        'Chunk 1 of 1', 'Chunk 2 of 1', 'Chunk 3 of 1', 'Chunk 5 of 1']
+    assert store.count() == 4
+    assert store.count(scopes='confidential') == 1
+    assert {point.id for point in store.client.scroll('test-update')[0]} == {
+        chunk.vector_db_id for chunk in updated_chunks}
+
+
+def test_iter_points(tmp_path):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-scroll',
+                        local_db=str(tmp_path / 'local.qdrant'),
+                        distance='dot')
+    chunks = store.store_chunks('1', make_chunks('1', 7)) + store.store_chunks('2', make_chunks('2', 3))
+
+    points = list(store.iter_points(source_unit_ids='1',
+                                    payload_fields=['body'],
+                                    with_vectors=True,
+                                    per_page=2))
+    assert len(points) == 7
+    assert all(list(point['payload']) == ['body'] for point in points)
+
+    vectors = {chunk.vector_db_id: chunk.vector for chunk in chunks}
+    for point in points:
+        assert point['vector'].dtype == np.float32
+        assert np.allclose(point['vector'], vectors[point['id']])
+
+    assert len(store.fetch_all(per_page=3)) == 10
+
+
+def test_search_batch(tmp_path):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-search',
+                        local_db=str(tmp_path / 'local.qdrant'))
+    chunks = store.store_chunks('1', make_chunks('1', 7)) + store.store_chunks('2', make_chunks('2', 3))
+
+    queries = [{'query_vector': chunks[0].vector, 'limit': 3},
+               {'query_vector': chunks[8].vector, 'limit': 2, 'source_unit_ids': '1'},
+               {'query_vector': chunks[8].vector, 'limit': 1, 'source_unit_ids': ['2']}]
+    results = store.search_batch(queries)
+    assert [len(result) for result in results] == [3, 2, 1]
+    assert results == [store.search(**query) for query in queries]
+    assert results[0][0].body == chunks[0].payload.body
+    assert all(payload.source_unit_id == '1' for payload in results[1])
+    assert results[2][0].body == chunks[8].payload.body
+
+
+def test_numpy_store_matches_qdrant(tmp_path):
+    stores = [QdrantStore(_Awd(dimensions=8),
+                          vector_namespace='test-parity',
+                          local_db=str(tmp_path / 'local.qdrant')),
+              NumpyStore(_Awd(dimensions=8),
+                         vector_namespace='test-parity',
+                         initial_capacity=4,
+                         bootstrap_from_cache=False)]
+
+    units = [('1', 20, {'categories': ['a', 'b'], 'language': 'en'}),
+             ('2', 15, {'categories': ['b'], 'scope': 'confidential', 'language': 'es'}),
+             ('3', 10, {'categories': ['c'], 'context': 'historical', 'source': 'other'})]
+    for store in stores:
+        for source_unit_id, n, payload in units:
+            store.store_chunks(source_unit_id, make_chunks(source_unit_id, n, 8, **payload))
+        store.store_chunks('1', make_chunks('1', 12, 8, categories=['a'], language='en'))
+
+    filters = [{},
+               {'categories': 'b'},
+               {'categories': ['a', 'c']},
+               {'scopes': 'public', 'languages': ['en', 'es']},
+               {'sources': 'test', 'contexts': 'historical'},
+               {'source_unit_ids': ['2', '3'], 'categories': ['b', 'c']}]
+    query_vectors = np.random.default_rng(0).standard_normal((4, 8)).astype(np.float32)
+    for filter_args in filters:
+        counts = [store.count(**filter_args) for store in stores]
+        assert counts[0] == counts[1]
+        assert (sorted(p['body'] for p in stores[0].fetch_all(**filter_args)) ==
+                sorted(p['body'] for p in stores[1].fetch_all(**filter_args)))
+        for query_vector in query_vectors:
+            results = [[p.body for p in store.search(query_vector, limit=5, **filter_args)]
+                       for store in stores]
+            assert results[0] == results[1]
+
+    queries = [{'query_vector': query_vector, 'limit': 3, **filter_args}
+               for query_vector, filter_args in zip(query_vectors, filters)]
+    assert stores[1].search_batch(queries) == [stores[1].search(**query) for query in queries]
+
+
+def test_numpy_store_persistence(tmp_path):
+    store = NumpyStore(_Awd(), vector_namespace='test', data_dir=str(tmp_path),
+                       initial_capacity=2, bootstrap_from_cache=False)
+    chunks = store.store_chunks('1', make_chunks('1', 5)) + store.store_chunks('2', make_chunks('2', 3))
+    store.delete_points([chunks[0].vector_db_id])
+    store.store_chunks('3', make_chunks('3', 2), wait=False)
+    store.flush()
+
+    reopened = NumpyStore(_Awd(), vector_namespace='test', data_dir=str(tmp_path))
+    assert reopened.count() == 9
+    assert reopened.count(source_unit_ids='1') == 4
+    point = reopened.retrieve([chunks[1].vector_db_id], with_vectors=True)[0]
+    assert np.allclose(point['vector'], chunks[1].vector / np.linalg.norm(chunks[1].vector))
+    assert reopened.search(chunks[6].vector, limit=1)[0].body == chunks[6].payload.body
+
+    reopened.delete_namespace()
+    assert not (tmp_path / 'test').exists()
+
+
+def test_numpy_store_flush_min_points(tmp_path):
+    store = NumpyStore(_Awd(), vector_namespace='test', data_dir=str(tmp_path),
+                       bootstrap_from_cache=False, flush_min_points=5)
+    points_path = tmp_path / 'test' / 'points.json'
+    mtime = points_path.stat().st_mtime_ns
+    chunks = store.store_chunks('1', make_chunks('1', 3))
+    store.delete_points([chunks[0].vector_db_id])
+    assert points_path.stat().st_mtime_ns == mtime
+    store.delete_points([chunks[1].vector_db_id])
+    assert points_path.stat().st_mtime_ns != mtime
+    assert NumpyStore(_Awd(), vector_namespace='test', data_dir=str(tmp_path)).count() == 1
+
+
+def test_numpy_store_bootstrap(tmp_path):
+    chunk_cache = ChunkDB()
+    chunk_cache.reset_table()
+    chunk_cache.add(source='test', source_unit_id='1', chunks=make_chunks('1', 3),
+                    model_name='model')
+    chunk_cache.add(source='test', source_unit_id='2', chunks=make_chunks('2', 2, dimensions=8),
+                    model_name='other-model')
+    chunk_cache.add(source='test', source_unit_id='3', chunks=make_chunks('3', 4),
+                    model_name='other-model')
+    # From before models were recorded.
+    chunk_cache.add(source='test', source_unit_id='4', chunks=make_chunks('4', 1))
+
+    class _AwdWithCache(_Awd):
+        def get_chunk_cache(self):
+            return chunk_cache
+
+    store = NumpyStore(_AwdWithCache(), vector_namespace='test', data_dir=str(tmp_path),
+                       model_name='model')
+    assert store.count(source_unit_ids='1') == 3
+    assert store.count() == 4
+    assert NumpyStore(_Awd(), vector_namespace='test', data_dir=str(tmp_path)).count() == 4
+
+
+def test_hnsw_store(tmp_path):
+    pytest.importorskip('hnswlib')
+    from aword.vector.hnswstore import HnswStore
+
+    def _store():
+        return HnswStore(_Awd(dimensions=8),
+                         vector_namespace='test',
+                         data_dir=str(tmp_path),
+                         initial_capacity=16,
+                         exact_search_max_points=10,
+                         bootstrap_from_cache=False)
+
+    store = _store()
+    exact = NumpyStore(_Awd(dimensions=8),
+                       vector_namespace='test-exact',
+                       bootstrap_from_cache=False)
+    for source_unit_id, n in (('1', 40), ('2', 30), ('3', 5)):
+        for a_store in (store, exact):
+            a_store.store_chunks(source_unit_id, make_chunks(source_unit_id, n, 8))
+    store.store_chunks('2', make_chunks('2', 25, 8))
+    exact.store_chunks('2', make_chunks('2', 25, 8))
+    store.flush()
+
+    reopened = _store()
+    assert reopened.count() == exact.count() == 70
+    query_vectors = np.random.default_rng(0).standard_normal((5, 8)).astype(np.float32)
+    for filter_args in ({}, {'source_unit_ids': '2'}, {'source_unit_ids': '3'}):
+        for query_vector in query_vectors:
+            # The graph is exact with so few points
+            assert ([p.body for p in reopened.search(query_vector, 3, **filter_args)] ==
+                    [p.body for p in exact.search(query_vector, 3, **filter_args)])
+
+
+def test_slim_payloads(tmp_path):
+    chunk_cache = ChunkDB()
+    chunk_cache.reset_table()
+
+    class _AwdWithCache(_Awd):
+        def get_chunk_cache(self):
+            return chunk_cache
+
+    store = QdrantStore(_AwdWithCache(),
+                        vector_namespace='test-slim',
+                        local_db=str(tmp_path / 'local.qdrant'),
+                        slim_payloads=True)
+    chunks = store.store_chunks('1', make_chunks('1', 5, categories=['a']))
+    chunk_cache.add(source='test', source_unit_id='1', chunks=chunks[:4])
+
+    points = list(store.iter_points())
+    assert all(set(point['payload']) == {'source', 'source_unit_id', 'categories',
+                                         'scope', 'context', 'language'}
+               for point in points)
+    assert store.count(categories='a') == 5
+
+    payloads = store.search(chunks[0].vector, limit=5)
+    assert len(payloads) == 4
+    assert payloads[0] == chunks[0].payload
+    assert [len(result) for result in store.search_batch(
+        [{'query_vector': chunks[4].vector, 'limit': 1},
+         {'query_vector': chunks[1].vector, 'limit': 1}])] == [0, 1]
+
+
+def test_collection_config(tmp_path):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-config',
+                        local_db=str(tmp_path / 'local.qdrant'),
+                        quantization='scalar',
+                        quantization_rescore='false',
+                        on_disk='true',
+                        hnsw_m=8,
+                        hnsw_ef=32,
+                        optimizer_segments=2)
+    assert store.on_disk is True
+    assert isinstance(store.get_quantization_config(), models.ScalarQuantization)
+    params = store.get_search_params()
+    assert params.hnsw_ef == 32
+    assert params.quantization.rescore is False
+
+    chunks = store.store_chunks('1', make_chunks('1', 5))
+    assert store.search(chunks[0].vector, limit=1)[0] == chunks[0].payload
+
+    store.quantization = 'none'
+    store.migrate_namespace()
+    assert store.count() == 5
+
+    with pytest.raises(ValueError):
+        QdrantStore(_Awd(),
+                    vector_namespace='test-config',
+                    local_db=str(tmp_path / 'local.qdrant'),
+                    quantization='pq')
+
+
+def test_migrate_namespace_keeps_what_is_not_set(tmp_path, monkeypatch):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-config',
+                        local_db=str(tmp_path / 'local.qdrant'),
+                        hnsw_m=8)
+    assert store.on_disk is None and store.on_disk_payload is None
+    updates = []
+    monkeypatch.setattr(store.client, 'update_collection', lambda **kw: updates.append(kw))
+
+    store.migrate_namespace()
+    assert updates[-1]['vectors_config'] is None
+    assert updates[-1]['collection_params'] is None
+    assert updates[-1]['hnsw_config'].m == 8
+
+    store.on_disk_payload = False
+    store.migrate_namespace()
+    assert updates[-1]['vectors_config'] is None
+    assert updates[-1]['collection_params'].on_disk_payload is False
+
+
+def test_rebuild_from_cache(tmp_path):
+    chunk_cache = ChunkDB()
+    chunk_cache.reset_table()
+
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-rebuild',
+                        local_db=str(tmp_path / 'local.qdrant'))
+    for source_unit_id in '123':
+        chunks = store.store_chunks(source_unit_id, make_chunks(source_unit_id, 3))
+        chunk_cache.add(source='test', source_unit_id=source_unit_id, chunks=chunks)
+    ids = sorted(point['id'] for point in store.iter_points())
+
+    upsert_chunks = store.upsert_chunks
+    calls = []
+
+    def failing_upsert_chunks(chunks, wait=True):
+        calls.append(len(chunks))
+        if len(calls) == 3:
+            raise RuntimeError('Interrupted')
+        return upsert_chunks(chunks, wait=wait)
+
+    store.upsert_chunks = failing_upsert_chunks
+    with pytest.raises(RuntimeError):
+        store.rebuild_from_cache(chunk_cache, dimensions=4, batch_size=4)
+    assert store.count() == 8
+    assert chunk_cache.get_rebuild_checkpoint('test-rebuild')['n_points'] == 8
+
+    store.upsert_chunks = upsert_chunks
+    assert store.rebuild_from_cache(chunk_cache, dimensions=4, batch_size=4) == 9
+    assert sorted(point['id'] for point in store.iter_points()) == ids
+    assert chunk_cache.get_rebuild_checkpoint('test-rebuild') is None
+
+    assert store.rebuild_from_cache(chunk_cache, dimensions=4, batch_size=4) == 9
+    assert store.count() == 9
+
+
+def test_switch_to_shadow(tmp_path):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-alias',
+                        local_db=str(tmp_path / 'local.qdrant'))
+    chunks = store.store_chunks('1', make_chunks('1', 3))
+
+    shadow = store.create_shadow(dimensions=8, distance='dot')
+    assert shadow.client is store.client
+    assert store.count() == 3
+    assert shadow.count() == 0
+
+    shadow_chunks = shadow.store_chunks('1', make_chunks('1', 2, dimensions=8))
+    store.switch_to(shadow)
+    assert store.get_aliased_collection() == shadow.collection_name
+    assert store.count() == 2
+    assert store.search(shadow_chunks[0].vector, limit=1)[0] == shadow_chunks[0].payload
+
+    # The namespace is an alias now, and the alias is moved.
+    other = store.create_shadow(dimensions=4)
+    other.store_chunks('1', chunks)
+    store.switch_to(other)
+    assert store.count() == 3
+    assert store.collect_garbage() == [shadow.collection_name]
+    assert [collection.name for collection
+            in store.client.get_collections().collections] == [other.collection_name]
+
+
+def test_recreate_aliased_namespace(tmp_path):
+    chunk_cache = ChunkDB()
+    chunk_cache.reset_table()
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-alias',
+                        local_db=str(tmp_path / 'local.qdrant'))
+    shadow = store.create_shadow(dimensions=4)
+    chunks = shadow.store_chunks('1', make_chunks('1', 3))
+    chunk_cache.add(source='test', source_unit_id='1', chunks=chunks)
+    store.switch_to(shadow)
+
+    # A new collection behind the alias, loaded from the cache.
+    assert store.rebuild_from_cache(chunk_cache, dimensions=4) == 3
+    aliased_collection = store.get_aliased_collection()
+    assert aliased_collection not in (None, shadow.collection_name)
+    assert [collection.name for collection
+            in store.client.get_collections().collections] == [aliased_collection]
+    assert store.search(chunks[0].vector, limit=1)[0] == chunks[0].payload
+
+    store.delete_namespace()
+    assert store.get_aliased_collection() is None
+    assert store.client.get_collections().collections == []
+    store.create_namespace(dimensions=4)
+    assert store.count() == 0
+
+
+def test_replace_chunk_cache():
+    chunk_cache = ChunkDB()
+    chunk_cache.reset_table()
+    shadow_chunk_cache = ChunkDB(table_name='chunk_reindex')
+    shadow_chunk_cache.reset_table()
+
+    chunk_cache.add(source='test', source_unit_id='1', chunks=make_chunks('1', 3))
+    shadow_chunk_cache.add(source='test', source_unit_id='1',
+                           chunks=make_chunks('1', 2, dimensions=8))
+    chunk_cache.replace_with(shadow_chunk_cache)
+    assert chunk_cache.count_rows() == 2
+    assert shadow_chunk_cache.count_rows() == 0
+    assert all(len(chunk.vector) == 8 for chunk in chunk_cache.list_rows())
+
+
+def test_bulk_load(tmp_path):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-bulk',
+                        local_db=str(tmp_path / 'local.qdrant'))
+    with store.bulk_load() as timings:
+        chunks = store.store_chunks('1', make_chunks('1', 5))
+    assert set(timings) == {'load', 'indexing'}
+    assert store.count() == 5
+    assert store.search(chunks[2].vector, limit=1)[0] == chunks[2].payload
+    optimizer_config = store.client.get_collection('test-bulk').config.optimizer_config
+    assert optimizer_config.indexing_threshold == 20000
+
+
+def test_bulk_load_restores_payload_schema(tmp_path, monkeypatch):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-bulk',
+                        local_db=str(tmp_path / 'local.qdrant'))
+    # The local qdrant does not keep payload indexes.
+    collection = store.client.get_collection('test-bulk')
+    collection.payload_schema = {
+        'source': models.PayloadIndexInfo(data_type=models.PayloadSchemaType.KEYWORD, points=0),
+        'position': models.PayloadIndexInfo(data_type=models.PayloadSchemaType.INTEGER, points=0)}
+    monkeypatch.setattr(store.client, 'get_collection', lambda **_: collection)
+    created = {}
+    monkeypatch.setattr(store.client, 'create_payload_index',
+                        lambda collection_name, field_name, field_schema:
+                        created.update({field_name: field_schema}))
+
+    with store.bulk_load():
+        assert created == {}
+    assert created == {'source': models.PayloadSchemaType.KEYWORD,
+                       'position': models.PayloadSchemaType.INTEGER}
+
+
+def test_search_cache(tmp_path):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-search-cache',
+                        local_db=str(tmp_path / 'local.qdrant'),
+                        search_cache_size=1024)
+    chunks = store.store_chunks('1', make_chunks('1', 5, categories=['a']))
+
+    payloads = store.search(chunks[0].vector, limit=2, categories=['a'])
+    assert store.search(chunks[0].vector + 1e-6, limit=2, categories='a') == payloads
+    assert store.search_cache.stats()['hits'] == 1
+    assert store.search(chunks[0].vector, limit=3, categories=['a']) != payloads
+
+    queries = [{'query_vector': chunks[0].vector, 'limit': 2, 'categories': ['a']},
+               {'query_vector': chunks[1].vector, 'limit': 2}]
+    assert store.search_batch(queries)[0] == payloads
+    assert store.search_cache.stats()['hits'] == 2
+    assert store.search_batch(queries) == store.search_batch(queries)
+    assert store.search_cache.stats() == {'size': 3, 'hits': 6, 'misses': 3, 'hit_rate': 2 / 3}
+
+    # Writes make the cached results stale.
+    store.clean_source_unit('1')
+    store.upsert_chunks(chunks[1:])
+    assert store.search(chunks[0].vector, limit=2, categories=['a'])[0] != chunks[0].payload
+    assert store.search_cache.stats()['misses'] == 4
+
+
+def test_search_cache_disabled(tmp_path):
+    store = QdrantStore(_Awd(),
+                        vector_namespace='test-search-cache',
+                        local_db=str(tmp_path / 'local.qdrant'))
+    assert store.search_cache is None
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Benchmark Embedder.split_in_chunks on multi-megabyte inputs.
+
+It times the indexed chunker on the full input and the decode-scan
+chunker on a prefix of it (it is too slow to run on megabytes), and
+checks that both produce the same chunks on the prefix.
+"""
+
+import os
+import re
+import time
+import argparse
+
+from aword.apis import oai
+from aword.model.embedder import Embedder, scan_chunk_boundaries
+
+
+def make_text(resdir: str, megabytes: float) -> str:
+    texts = []
+    for dirpath, _, filenames in os.walk(resdir):
+        for filename in sorted(filenames):
+            with open(os.path.join(dirpath, filename), encoding='utf-8') as fin:
+                texts.append(fin.read())
+    sample = '\n'.join(texts)
+    return (sample * (int(megabytes * 1e6 / len(sample)) + 1))[:int(megabytes * 1e6)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--megabytes', type=float, default=4)
+    parser.add_argument('--scan-kilobytes', type=float, default=100)
+    parser.add_argument('--chunk-size', type=int, default=400)
+    parser.add_argument('--encoding', type=str, default='cl100k_base')
+    parser.add_argument('--resdir', type=str, default='test/res/local')
+    args = parser.parse_args()
+
+    tokenizer = oai.get_tokenizer(args.encoding)
+    embedder = Embedder(tokenizer=tokenizer,
+                        embedding_fn=None,
+                        chunk_size=args.chunk_size,
+                        model_name=args.encoding,
+                        max_sequence_length=8191,
+                        dimensions=0)
+
+    text = make_text(args.resdir, args.megabytes)
+    start = time.perf_counter()
+    chunks = list(embedder.split_in_chunks(text, args.chunk_size))
+    elapsed = time.perf_counter() - start
+    print(f'indexed: {len(text) / 1e6:.1f} MB, {len(chunks)} chunks, '
+          f'{elapsed:.2f} s, {len(text) / 1e6 / elapsed:.2f} MB/s')
+
+    prefix = text[:int(args.scan_kilobytes * 1e3)]
+    tokens = embedder.encode(re.sub(r'[ \t]+', ' ', prefix))
+    start = time.perf_counter()
+    scanned = list(scan_chunk_boundaries(tokenizer, tokens, args.chunk_size))
+    elapsed = time.perf_counter() - start
+    print(f'scanned: {len(prefix) / 1e6:.1f} MB, {len(scanned)} chunks, '
+          f'{elapsed:.2f} s, {len(prefix) / 1e6 / elapsed:.2f} MB/s')
+
+    assert scanned == list(embedder.split_in_chunks(prefix, args.chunk_size))
+
+
+if __name__ == '__main__':
+    main()
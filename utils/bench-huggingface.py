@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the HuggingFace embedder throughput, in chunks per second,
+against the number of processes.
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+from aword.model.embedder import HuggingFaceEmbedder
+
+
+class _Awd:
+    """The embedder only needs the embedding caches from awd."""
+
+    def get_embedding_cache(self):
+        return None
+
+    def get_query_embedding_cache(self):
+        return None
+
+
+def make_chunks(resdir: str, n_chunks: int, chunk_words: int):
+    words = []
+    for dirpath, _, filenames in os.walk(resdir):
+        for filename in sorted(filenames):
+            with open(os.path.join(dirpath, filename), encoding='utf-8') as fin:
+                words += fin.read().split()
+    rng = np.random.default_rng(0)
+    chunks = []
+    for _ in range(n_chunks):
+        length = int(rng.integers(chunk_words // 4, chunk_words + 1))
+        start = int(rng.integers(0, len(words) - length))
+        chunks.append(' '.join(words[start:start + length]))
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--model-name', type=str, default='multi-qa-mpnet-base-dot-v1')
+    parser.add_argument('--chunks', type=int, default=2000)
+    parser.add_argument('--chunk-words', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--resdir', type=str, default='test/res/local')
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.resdir, args.chunks, args.chunk_words)
+
+    processes = [1]
+    while processes[-1] * 2 <= (os.cpu_count() or 1):
+        processes.append(processes[-1] * 2)
+    if processes[-1] != (os.cpu_count() or 1):
+        processes.append(os.cpu_count())
+
+    reference = None
+    for n_processes in processes:
+        embedder = HuggingFaceEmbedder(_Awd(),
+                                       embedding_chunk_size=256,
+                                       model_name=args.model_name,
+                                       batch_size=args.batch_size,
+                                       processes=n_processes,
+                                       multi_process_min_texts=args.batch_size)
+        # Warm up, starting the pool if there is one.
+        embedder.get_embeddings(chunks[:args.batch_size * n_processes])
+
+        start = time.perf_counter()
+        embeddings = embedder.get_embeddings(chunks)
+        elapsed = time.perf_counter() - start
+        print(f'{n_processes} processes: {len(chunks) / elapsed:.1f} chunks/s')
+
+        if reference is None:
+            reference = embeddings
+        else:
+            print(f'    max difference with 1 process: '
+                  f'{np.abs(embeddings - reference).max():.2e}')
+
+
+if __name__ == '__main__':
+    main()